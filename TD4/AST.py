@@ -72,6 +72,25 @@ def restore():
     lvars = []
     lvars_line = {}
 
+# Errors found by the type checker
+check_errors = (TypeError, ValueError, SyntaxError)
+
+def checked(diag, node, check, *args, **kwargs):
+    # Run check(*args, **kwargs) on behalf of node. Without a diagnostics sink errors are raised as usual,
+    # otherwise they are recorded in diag (at the location of node) and the caller carries on with its next check.
+    if diag is None:
+        return check(*args, **kwargs)
+    try:
+        return check(*args, **kwargs)
+    except check_errors as e:
+        diag.error(getattr(e, 'sloc', None) or node.sloc, str(e))
+
+def fail(diag, node, err):
+    # Raise err, or record it in diag when the errors are collected
+    if diag is None:
+        raise err
+    diag.error(getattr(err, 'sloc', None) or node.sloc, str(err))
+
 # ================================================================================
 # Base Node Class 
 class Node:
@@ -81,12 +100,17 @@ class Node:
     def __init__(self, sloc):
         self.sloc = sloc
 
+    def located(self, err):
+        # err, to be reported at the location of the node rather than at the statement it is checked in
+        err.sloc = self.sloc
+        return err
+
     def lookup_variable_type(self, var, var_types):
         #print("TYPE CHECKING IS BACK:", var_types[0])
         for scope in reversed(var_types):
             if var in scope:
                 return scope[var]
-        raise ValueError(f'Variable {var} not in scope at line {self.sloc.lineno}')
+        raise self.located(ValueError(f'Variable {var} not in scope'))
 
 
 class Expression(Node):
@@ -177,7 +201,7 @@ class ExpressionUniOp(Expression):
         elif self.operator in {'-.', '~',} and (self.argument.type == Type.BOOL ):
             self.type = Type.INT
         else:
-            raise TypeError(f'Operator {self.operator} not defined for argument {self.argument} with type {self.argument.type} at line {self.sloc.lineno}')
+            raise self.located(TypeError(f'Operator {self.operator} not defined for argument {self.argument} with type {self.argument.type}'))
 
     def syntax_check(self, fname):
         self.argument.syntax_check(fname)
@@ -238,7 +262,7 @@ class ExpressionBinOp(Expression):
             self.type = Type.BOOL
         elif self.operator in {'&&', '||', '=='} and (self.left.type == Type.BOOL): self.type = Type.BOOL
         else:
-            raise TypeError(f'Operator {self.operator} not defined for argument {self.left} with type {self.left.type} at line {self.sloc.lineno}')
+            raise self.located(TypeError(f'Operator {self.operator} not defined for argument {self.left} with type {self.left.type}'))
 
         self.right.type_check(var_types)
         if self.operator in {'+', '-', '*', '/','%', '&', '|', '^','<<', '>>',} and (self.right.type == Type.INT ):
@@ -248,7 +272,7 @@ class ExpressionBinOp(Expression):
         elif self.operator in {'&&', '||', '=='} and (self.right.type == Type.BOOL): 
             self.type = Type.BOOL
         else:
-            raise TypeError(f'Operator {self.operator} not defined for argument {self.right} with type {self.right.type} at line {self.sloc.lineno}')
+            raise self.located(TypeError(f'Operator {self.operator} not defined for argument {self.right} with type {self.right.type}'))
 
 
     def syntax_check(self, fname):
@@ -310,13 +334,15 @@ class Statement(Node):
     def __init__(self, sloc):
         super().__init__(sloc)
 
-    def type_check(self, var_types):
+    # diag is the diagnostics sink (None to raise on the first error), only compound statements use it
+    def type_check(self, var_types, diag=None):
         pass
 
 class Block(Statement):
-    def __init__(self, sloc, stmts):
+    def __init__(self, sloc, stmts, end=None):
         super().__init__(sloc)
         self.stmts = stmts
+        self.end = end      #offset just after the closing bracket
         for i in range(len(self.stmts)):
             if isinstance(self.stmts[i], list): 
                 offset = len(self.stmts[i])
@@ -325,10 +351,10 @@ class Block(Statement):
                 self.stmts.pop(i+offset)
 
 
-    def type_check(self, var_types):
+    def type_check(self, var_types, diag=None):
         var_types.append(dict())
         for stmt in self.stmts:
-            stmt.type_check(var_types)
+            checked(diag, stmt, stmt.type_check, var_types, diag)
         #leaving scope
         var_types.pop()
 
@@ -346,11 +372,11 @@ class Block(Statement):
                     rets += stmt.check_path(proc_type)
             if isinstance(self.stmts[-1], Return):
                 if self.stmts[-1].expression.type != proc_type:
-                    raise TypeError(f"Invalid return statement has expression of type {self.stmts[-1].expression.type} at line {self.stmts[-1].sloc.lineno}")
+                    raise self.stmts[-1].located(TypeError(f"Invalid return statement has expression of type {self.stmts[-1].expression.type}"))
                 rets += [self.stmts[-1]]
-            else: raise SyntaxError(f"Expected return statement in block at line {self.sloc.lineno} but got none")
+            else: raise self.located(SyntaxError(f"Expected return statement in block but got none"))
         else: 
-            raise SyntaxError(f"Expected return statement in block at line {self.sloc.lineno} but got none")
+            raise self.located(SyntaxError(f"Expected return statement in block but got none"))
         return rets
 
     def check_no_path(self):
@@ -360,7 +386,7 @@ class Block(Statement):
             if isinstance(stmt, IfElse):
                 stmt.check_no_path()
             if isinstance(stmt, Return) and stmt.expression is not None:
-                raise SyntaxError(f"Found invalid return statement in subroutine block at line {self.sloc.lineno}")
+                raise self.located(SyntaxError(f"Found invalid return statement in subroutine block"))
 
     @property
     def js_obj(self):
@@ -379,9 +405,16 @@ class Vardecl(Statement):
         self.expr = expr
         self.type = type 
 
-    def type_check(self, var_types, glob=False):
+    def type_check(self, var_types, diag=None, glob=False):
+        try:
+            self.check_init(var_types, glob)
+        finally:
+            # declared even if its initialisation is wrong, so that its uses are not reported as errors too
+            var_types[-1].setdefault(self.var.name, self.var.type)
+
+    def check_init(self, var_types, glob):
         if self.type != Type.INT and self.type != Type.BOOL:
-            raise TypeError(f'Variable of dissalowed type:{self.type}')
+            raise self.located(TypeError(f'Variable of dissalowed type:{self.type}'))
         self.expr.type_check(var_types)
         if glob:
             if self.type == Type.INT:
@@ -389,15 +422,14 @@ class Vardecl(Statement):
                     pass
                 else:
                     if not isinstance(self.expr, ExpressionInt):
-                        raise ValueError(f"Declaration of global variable of type int can only be to an integer value")
+                        raise self.located(ValueError(f"Declaration of global variable of type int can only be to an integer value"))
             if self.type == Type.BOOL:
                 if not isinstance(self.expr, Bool):
-                    raise ValueError(f"Declaration of global variable of type bool can only be to a boolean value")
+                    raise self.located(ValueError(f"Declaration of global variable of type bool can only be to a boolean value"))
         if self.expr.type != self.type:
-            raise TypeError(f'assignement has wrong type, expected {self.type} and got {self.expr.type}')
+            raise self.located(TypeError(f'assignement has wrong type, expected {self.type} and got {self.expr.type}'))
         if self.var.name in var_types[-1]:
-          raise ValueError(f'Variable {self.var.name} already declared at line {self.sloc.lineno}')
-        var_types[-1][self.var.name] = self.var.type
+          raise self.located(ValueError(f'Variable {self.var.name} already declared'))
 
 
     def syntax_check(self, fname):
@@ -452,11 +484,11 @@ class Assign(Statement):
         self.lhs = lhs
         self.rhs = rhs
 
-    def type_check(self, var_types):
+    def type_check(self, var_types, diag=None):
         var_type = self.lookup_variable_type(self.lhs.name, var_types)
         self.rhs.type_check(var_types)
         if var_type != self.rhs.type:
-            raise TypeError(f"Assignment of variable '{self.lhs.name}' of type '{var_type}' to expr of type '{self.rhs.type}' at line {self.sloc.lineno}")
+            raise self.located(TypeError(f"Assignment of variable '{self.lhs.name}' of type '{var_type}' to expr of type '{self.rhs.type}'"))
 
     def syntax_check(self, fname):
         self.lhs.syntax_check(fname)
@@ -502,10 +534,10 @@ class Print(Statement):
         super().__init__(sloc)
         self.arg = arg
 
-    def type_check(self, var_types):
+    def type_check(self, var_types, diag=None):
         self.expr.type_check(var_types)
         if self.expr.type != 'int':
-            raise TypeError(f'Can only print INT, not {self.expr.type}, at line {self.sloc}')
+            raise self.located(TypeError(f'Can only print INT, not {self.expr.type}'))
 
     def syntax_check(self, fname):
       self.arg.syntax_check(fname)
@@ -557,14 +589,17 @@ class IfElse(Statement):
         self.block = block          #list of statements
         self.ifrest = ifrest        #else blocks
 
-    def type_check(self, var_types):
+    def type_check(self, var_types, diag=None):
         #ar_types[-1]["loop"] = True
+        checked(diag, self, self.check_condition, var_types)
+        self.block.type_check(var_types, diag)
+        if self.ifrest is not None:
+            self.ifrest.type_check(var_types, diag)
+
+    def check_condition(self, var_types):
         self.condition.type_check(var_types)
         if self.condition.type != Type.BOOL:
-            raise TypeError(f'IfElse cannot be of type {self.condition.type} at line {self.sloc},  must be of type bool')
-        self.block.type_check(var_types)
-        if self.ifrest is not None:
-            self.ifrest.type_check(var_types)
+            raise self.located(TypeError(f'IfElse cannot be of type {self.condition.type}, must be of type bool'))
 
     def syntax_check(self, fname):
         self.block.syntax_check(fname)
@@ -596,12 +631,15 @@ class While(Statement):
         self.condition = condition
         self.block = block
 
-    def type_check(self, var_types):
+    def type_check(self, var_types, diag=None):
         var_types[-1]["loop"] = True
+        checked(diag, self, self.check_condition, var_types)
+        self.block.type_check(var_types, diag)
+
+    def check_condition(self, var_types):
         self.condition.type_check(var_types)
         if self.condition.type != Type.BOOL:
-            raise TypeError(f'WHILE cannot be of type {self.condition.type} at line {self.sloc}, must be of type BOOL')
-        self.block.type_check(var_types)
+            raise self.located(TypeError(f'WHILE cannot be of type {self.condition.type}, must be of type BOOL'))
 
     def syntax_check(self, fname):
         self.block.syntax_check(fname)
@@ -627,7 +665,7 @@ class Jump(Statement):
         super().__init__(sloc)
         self.operator = operator
 
-    def type_check(self, var_types):
+    def type_check(self, var_types, diag=None):
         for scope in reversed(var_types):
             if ('loop', True) in scope.items():
                 return 
@@ -649,7 +687,7 @@ class Eval(Statement):
         super().__init__(sloc)
         self.expression = expression
 
-    def type_check(self, var_types):
+    def type_check(self, var_types, diag=None):
         self.expression.type_check(var_types)
 
 class Call(Expression):
@@ -680,7 +718,7 @@ class Return(Statement):
         self.operator = operator, 
         self.expression = expression
 
-    def type_check(self, var_types):
+    def type_check(self, var_types, diag=None):
         if self.expression is not None: 
             self.expression.type_check(var_types)
 
@@ -703,6 +741,15 @@ class ProcDecl(Node):
     def add_param_to_scope(self, p, var_types):
             var_types[-1][p.name] = p.type
 
+    def source_text(self):
+        # Text of the declaration, from 'def' to the closing bracket of its body
+        text = self.sloc.source.data[self.sloc.lexpos:self.block.end]
+        return text if isinstance(text, str) else text.decode('utf-8', errors='replace')
+
+    @property
+    def signature(self):
+        return (str(self.type), [str(p.type) for param in self.params for p in param])
+
 
     def check_path(self):
         return self.block.check_path(self.type)
@@ -710,23 +757,28 @@ class ProcDecl(Node):
     def check_no_path(self):
         self.block.check_no_path()
 
-    def type_check(self, var_types):
+    def type_check(self, var_types, diag=None):
         if self.name == "main" and self.type is not Type.VOID:
-            raise TypeError(f"Subroutine @main must return void value")
-
+            fail(diag, self, TypeError(f"Subroutine @main must return void value"))
 
+        errors = len(diag.errors) if diag is not None else 0
         var_types.append(dict())
         for param in self.params:
             for p in param:
                 self.add_param_to_scope(p, var_types)
-        self.block.type_check(var_types)
+        self.block.type_check(var_types, diag)
 
+        # return paths are only meaningful once the body is well typed
+        if diag is None or len(diag.errors) == errors:
+            checked(diag, self, self.check_returns)
+        #leaving the scope of the parameters
+        var_types.pop()
 
+    def check_returns(self):
         if self.type != Type.VOID:
             self.rets = self.check_path()
         else:
             self.check_no_path()
-        var_types = var_types[:-1]
 
 class Program(Node):
   def __init__(self, sloc, decls):
@@ -753,24 +805,26 @@ class Program(Node):
     
 
 
-  def type_check(self, var_scopes):
+  def type_check(self, var_scopes, diag=None):
+    # With a diagnostics sink (lex_pars.Diagnostics) every error is recorded and checking goes on with the next
+    # declaration, statement or procedure; without one the first error is raised.
     var_scopes.append(dict())
     #Global var type checking
     for var in self.global_vars:
-        var.type_check(var_scopes, True)
+        checked(diag, var, var.type_check, var_scopes, glob=True)
 
     names = []
     #Proc type checking 
     for proc in self.procs:
         names.append(proc.name)
         if proc.name in var_scopes[0].keys():
-            raise SyntaxError(f"Procedure {proc.name} already declared")
+            fail(diag, proc, SyntaxError(f"Procedure {proc.name} already declared"))
         var_scopes[0][proc.name] = proc.type
     for proc in self.procs:
-        proc.type_check(var_scopes)
+        proc.type_check(var_scopes, diag)
     
     if 'main' not in names:
-        raise SyntaxError(f"Subroutine @main not found in file")
+        fail(diag, self, SyntaxError(f"Subroutine @main not found in file"))
 
 
   def syntax_check(self, fname):
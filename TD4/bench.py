@@ -0,0 +1,942 @@
+"""
+Benchmarks of the compiler passes.
+Usage: python3 bench.py <benchmark> [--corpus DIR] [--repeat N] [--size MB]
+Every benchmark prints its measurements as a small table on stdout.
+"""
+import argparse
+import contextlib
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from lex_pars import Lexer, FastLexer, Parser, Source, Sloc
+
+
+def corpus_files(corpus):
+    return sorted(Path(corpus).rglob('*.bx'))
+
+
+def synthetic_program(size_mb):
+    """
+    A large valid BX program: many procedures made of loops, conditions, calls and comments.
+    """
+    proc = """
+def f{i}(n, k : int) : int {{
+    // iterate and accumulate
+    var acc = 0, j = 0 : int;
+    var done = false : bool;
+    while (j < n && !done) {{
+        if (j % 3 == 0 || (j & 7) >= 5) {{
+            acc = acc + j * k - (acc >> 2);
+        }} else {{
+            acc = acc ^ (j << 1) | ~k;
+        }}
+        j = j + 1;
+        done = acc > 1000000;
+    }}
+    return acc;
+}}
+"""
+    chunks, size, i = [], 0, 0
+    while size < size_mb * 1024 * 1024:
+        chunk = proc.format(i=i)
+        chunks.append(chunk)
+        size += len(chunk)
+        i += 1
+    chunks.append('def main() { print(f0(10, 3)); }\n')
+    return ''.join(chunks)
+
+
+def compilable_program(procs):
+    """
+    A BX program of many procedures that goes through the whole compiler (int procedures can only return at the
+    end of every block, so the procedures are subroutines accumulating into a global).
+    """
+    proc = """
+def f{i}(n, k : int) {{
+    var acc = 0, j = 0 : int;
+    while (j < n) {{
+        if (j % 3 == 0 || (j & 7) >= 5) {{
+            acc = acc + j * k - (acc >> 2);
+        }} else {{
+            acc = acc ^ (j << 1) | ~k;
+        }}
+        j = j + 1;
+    }}
+    total = total + acc;
+}}
+"""
+    calls = ''.join(f'    f{i}({i % 50}, {i});\n' for i in range(procs))
+    return ('var total = 0 : int;\n' + ''.join(proc.format(i=i) for i in range(procs)) +
+            f'def main() {{\n{calls}    print(total);\n}}\n')
+
+
+def large_procedure(loops):
+    """
+    A BX main procedure made of many loops (about 50 TAC instructions each).
+    """
+    loop = """
+    j = 0;
+    while (j < {n}) {{
+        if (j % 3 == 0 || (j & 7) >= 5) {{
+            acc = acc + j * {n} - (acc >> 2);
+        }} else {{
+            acc = acc ^ (j << 1) | ~acc;
+        }}
+        j = j + 1;
+    }}
+"""
+    return ('def main() {\n    var acc = 0, j = 0 : int;\n' + ''.join(loop.format(n=i % 17) for i in range(loops)) +
+            '    print(acc);\n}\n')
+
+
+# Total number of collatz steps of the integers below 300000
+loop_kernel = """
+def main() {
+    var n = 1, total = 0, c = 0 : int;
+    while (n < 300000) {
+        c = n;
+        while (c != 1) {
+            if (c % 2 == 0) { c = c / 2; } else { c = 3 * c + 1; }
+            total = total + 1;
+        }
+        n = n + 1;
+    }
+    print(total);
+}
+"""
+
+
+def per_file_ms(files, action, repeat):
+    """
+    Average latency (ms) of action(provenance, data) over every file of the corpus.
+    """
+    sources = [(str(fn), fn.read_text()) for fn in files]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for provenance, data in sources:
+            action(provenance, data)
+    return 1000 * (time.perf_counter() - start) / (repeat * len(sources))
+
+# ================================================================================
+
+def bench_frontend(args):
+    """
+    Per-file front end latency: fresh Lexer/Parser per file (with and without table cache) vs the shared pair.
+    """
+    files = corpus_files(args.corpus)
+
+    def cold(provenance, data):
+        Parser.tables.clear()
+        Parser(Lexer(provenance, data)).parse()
+
+    def fresh(provenance, data):
+        Parser(Lexer(provenance, data)).parse()
+
+    def pooled(provenance, data):
+        Parser.shared(provenance, data).parse()
+
+    # no table cache at all: yacc regenerates the tables for every file
+    cache_dir, Parser.cache_dir = Parser.cache_dir, None
+    results = [('fresh, tables rebuilt', per_file_ms(files, cold, 1))]
+    Parser.cache_dir = cache_dir
+    results.append(('fresh, tables cached', per_file_ms(files, fresh, args.repeat)))
+    results.append(('shared + reset', per_file_ms(files, pooled, args.repeat)))
+
+    print(f'{len(files)} files from {args.corpus}')
+    for name, ms in results:
+        print(f'{name:<24} {ms:8.3f} ms/file')
+
+
+def bench_lexer(args):
+    """
+    Lexer throughput (MB/s) of the PLY and fast engines on a large synthetic program.
+    """
+    data = synthetic_program(args.size)
+    mb = len(data) / (1024 * 1024)
+    print(f'synthetic program: {mb:.1f} MB')
+    for name, lexer_class in (('ply', Lexer), ('fast', FastLexer)):
+        start = time.perf_counter()
+        lexer = lexer_class('<synthetic>', data)
+        count = 0
+        while lexer.lexer.token() is not None:
+            count += 1
+        elapsed = time.perf_counter() - start
+        print(f'{name:<6} {count} tokens {elapsed:7.3f} s {mb / elapsed:7.2f} MB/s')
+
+
+def bench_stream(args):
+    """
+    Peak RSS of lexing growing synthetic programs (ending with an illegal character) read in memory vs memory mapped.
+    Every measure runs in a fresh process.
+    """
+    child = """
+import sys
+from lex_pars import FastLexer, Source
+data = Source.read(sys.argv[1], sys.argv[2] == 'stream')
+lexer = FastLexer(sys.argv[1], data)
+while lexer.token() is not None:
+    pass
+# peak RSS of this process image (ru_maxrss would include the parent's, it is kept across exec)
+with open('/proc/self/status') as fp:
+    print(int(fp.read().split('VmHWM:')[1].split()[0]) // 1024)
+"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'synthetic.bx')
+        print(f'{"size":>8} {"read":>10} {"stream":>10}')
+        for size in (args.size / 4, args.size / 2, args.size):
+            with open(fn, 'w') as fp:
+                fp.write(synthetic_program(size) + '$\n')
+            rss = {}
+            for mode in ('read', 'stream'):
+                out = subprocess.run([sys.executable, '-c', child, fn, mode], cwd=here, check=True,
+                                     capture_output=True, text=True).stdout
+                rss[mode] = int(out.split()[-1])
+            print(f'{size:>6.0f}MB {rss["read"]:>8}MB {rss["stream"]:>8}MB')
+
+
+def bench_diagnostics(args):
+    """
+    Rendering 10k error messages located all over one large file, before (whole source printed, column found
+    with rfind) and now (newline index + bisection, snippet of the offending line).
+    """
+    data = synthetic_program(args.size)
+    count = 10000
+    step = len(data) // count
+    positions = [i * step for i in range(count)]
+    linenos = []
+    lineno, last = 1, 0
+    for pos in positions:
+        lineno += data.count('\n', last, pos)
+        linenos.append(lineno)
+        last = pos
+
+    def legacy(source, lineno, lexpos):
+        eol = source.data.rfind('\n', 0, lexpos)
+        colno = lexpos - eol
+        print(f'\n{source.data}\nLine:{lineno}.Column:{colno}:\n' + 'ERROR ' + 'error')
+
+    def indexed(source, lineno, lexpos):
+        Sloc(source, lineno, lexpos).print_error_message('error', 3)
+
+    print(f'{count} errors in a {len(data) / (1024 * 1024):.1f} MB file')
+    # the legacy renderer is far too slow for all the errors: measured on a sample and extrapolated
+    for name, render, sample in (('before', legacy, 20), ('now', indexed, count)):
+        source = Source('<synthetic>', data)
+        with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+            start = time.perf_counter()
+            for lineno, lexpos in list(zip(linenos, positions))[:: count // sample]:
+                render(source, lineno, lexpos)
+            elapsed = (time.perf_counter() - start) * count / sample
+        print(f'{name:<7} {elapsed:9.3f} s ({1e6 * elapsed / count:9.1f} us/error)')
+
+
+def bench_incremental(args):
+    """
+    Rebuild time of a synthetic program with the procedure cache: cold, unchanged, and with one procedure edited.
+    """
+    from proc_cache import ProcCache, compile_bx
+    data = compilable_program(args.procs)
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'synthetic.bx')
+        cache = ProcCache(os.path.join(tmp, 'cache'))
+        print(f'{data.count("def ")} procedures, {len(data) / 1024:.0f} KB')
+        edited = data.replace('total = total + acc;', 'total = total - acc;', 1)
+        for name, source in (('cold', data), ('unchanged', data), ('one edited', edited)):
+            with open(fn, 'w') as fp:
+                fp.write(source)
+            hits, misses = cache.hits, cache.misses
+            with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                start = time.perf_counter()
+                compile_bx(fn, cache)
+                elapsed = time.perf_counter() - start
+            print(f'{name:<11} {elapsed:8.3f} s {cache.hits - hits:6} hits {cache.misses - misses:6} misses')
+
+
+def bench_pipeline(args):
+    """
+    Per-phase time of compiling a synthetic program through json files on disk (as bxcc did) and in memory.
+    gcc is left out, it is the same in both cases.
+    """
+    import bx2tac
+    import tac2x64
+    import tac_cfopt
+    data = compilable_program(args.procs)
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'synthetic.bx')
+        with open(fn, 'w') as fp:
+            fp.write(data)
+
+        def on_disk():
+            tac = bx2tac.bx_to_json(fn)
+            yield 'front end'
+            optimized = tac_cfopt.optimization(tac)
+            yield 'optimization'
+            tac2x64.compile_tac(optimized)
+            yield 'assembly'
+            for path in (tac, optimized, optimized[:-9] + '.s'):
+                os.remove(path)
+            yield 'cleanup'
+
+        def in_memory():
+            gvars, procs = bx2tac.bx_to_tac(fn)
+            yield 'front end'
+            procs = tac_cfopt.optimize_program(procs)
+            yield 'optimization'
+            '\n'.join(tac2x64.program_to_asm(gvars, procs))
+            yield 'assembly'
+            yield 'cleanup'
+
+        Parser.shared(fn, data).parse()     # warm the parser: both pipelines share it
+        times = {}
+        for name, pipeline in (('disk', on_disk), ('memory', in_memory)):
+            times[name] = {}
+            for _ in range(args.repeat):
+                with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                    start = time.perf_counter()
+                    for phase in pipeline():
+                        now = time.perf_counter()
+                        times[name][phase] = times[name].get(phase, 0) + (now - start) / args.repeat
+                        start = now
+
+    print(f'{args.procs} procedures, {len(data) / 1024:.0f} KB')
+    print(f'{"phase":<14} {"disk":>10} {"memory":>10}')
+    for phase in times['disk']:
+        print(f'{phase:<14} {1000 * times["disk"][phase]:8.1f}ms {1000 * times["memory"][phase]:8.1f}ms')
+    print(f'{"total":<14} {1000 * sum(times["disk"].values()):8.1f}ms {1000 * sum(times["memory"].values()):8.1f}ms')
+
+
+def bench_build(args):
+    """
+    Wall time of building the corpus (copied --repeat times) with one bxcc process per file, and with bxcc -j N
+    over the whole directory.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    bxcc = os.path.join(here, 'bxcc.py')
+    files = corpus_files(args.corpus)
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(args.repeat):
+            for fn in files:
+                with open(os.path.join(tmp, f'{fn.stem}_{i}.bx'), 'w') as fp:
+                    fp.write(fn.read_text())
+        with open(os.path.join(tmp, 'bx_runtime.c'), 'w') as fp:
+            fp.write(Path(here, 'bx_runtime.c').read_text())
+        sources = sorted(str(fn) for fn in Path(tmp).glob('*.bx'))
+
+        def run(*commands):
+            start = time.perf_counter()
+            for command in commands:
+                subprocess.run([sys.executable, bxcc] + command, cwd=tmp, check=True, capture_output=True)
+            return time.perf_counter() - start
+
+        print(f'{len(sources)} files, {os.cpu_count()} CPUs')
+        results = [('process per file', run(*[[fn] for fn in sources]))]
+        for jobs in sorted({1, 2, 4, os.cpu_count()}):
+            results.append((f'-j {jobs}', run(['-j', str(jobs), tmp])))
+    for name, elapsed in results:
+        print(f'{name:<18} {elapsed:8.2f} s')
+
+
+def bench_runtime(args):
+    """
+    Run time of the executables of a few corpus programs compiled at every optimization level (mean of --repeat
+    runs, output discarded), and the number of stack operands (n(%rbp)) in their assembly.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    bxcc = os.path.join(here, 'bxcc.py')
+    levels = [['--no_opt'], ['-O0'], ['-O1'], ['-O2']]
+    # the corpus programs run in microseconds, process start up dominates: a longer loop shows the code itself
+    programs = [(name, Path(args.corpus, f'{name}.bx').read_text(), args.repeat)
+                for name in ('fib20', 'collatz', 'bigcondition1', 'bigcondition2')]
+    programs.append(('collatz_sum', loop_kernel, max(1, args.repeat // 50)))
+    print(f'{"program":<15}' + ''.join(f'{" ".join(level):>22}' for level in levels))
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'bx_runtime.c'), 'w') as fp:
+            fp.write(Path(here, 'bx_runtime.c').read_text())
+        for name, source, runs in programs:
+            fn = os.path.join(tmp, f'{name}.bx')
+            with open(fn, 'w') as fp:
+                fp.write(source)
+            row = f'{name:<15}'
+            for level in levels:
+                subprocess.run([sys.executable, bxcc, '--keep_asm', fn] + level, cwd=tmp, check=True,
+                               capture_output=True)
+                operands = Path(tmp, f'{name}.s').read_text().count('(%rbp)')
+                start = time.perf_counter()
+                for _ in range(runs):
+                    subprocess.run([os.path.join(tmp, name)], check=True, stdout=subprocess.DEVNULL)
+                elapsed = (time.perf_counter() - start) / runs
+                row += f'{1e6 * elapsed:10.0f}us {operands:5} mem'
+            print(row)
+
+
+def bench_regalloc(args):
+    """
+    Spills and moves eliminated by the register allocators over the procedures of the corpus, and their run time.
+    """
+    import regalloc
+    from bx2tac import bx_to_tac
+    from tac_cfopt import optimize_program
+    procs = []
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        for fn in corpus_files(args.corpus):
+            try:
+                procs.extend((fn.stem, proc) for proc in optimize_program(bx_to_tac(str(fn))[1]))
+            except SystemExit:
+                continue
+    print(f'{"procedure":<32}{"temps":>6}' + ''.join(f'{f"-O{level} spills":>12}{"moves":>12}' for level in (1, 2)))
+    totals = {}
+    for file, proc in procs:
+        row = f'{file + ":" + proc.name[1:]:<32}'
+        for level in (1, 2):
+            start = time.perf_counter()
+            alloc = regalloc.allocators[level](proc)
+            elapsed = time.perf_counter() - start
+            stats = regalloc.report(proc, alloc)
+            total = totals.setdefault(level, dict.fromkeys(('temps', 'spills', 'moves', 'eliminated', 'time'), 0))
+            for key in stats:
+                total[key] += stats[key]
+            total['time'] += elapsed
+            if level == 1:
+                row += f'{stats["temps"]:6}'
+            row += f'{stats["spills"]:12}{stats["eliminated"]:>7}/{stats["moves"]:<4}'
+        print(row)
+    for level, total in totals.items():
+        print(f'-O{level}: {total["temps"]} temps, {total["spills"]} spills, {total["eliminated"]} of {total["moves"]} '
+              f'moves eliminated, {1000 * total["time"]:.1f} ms')
+
+
+def bench_dataflow(args):
+    """
+    Time of the dataflow analyses on procedures of growing size (time per instruction in us/instr).
+    """
+    import bx2tac
+    import dataflow
+    print(f'{"instrs":>8} {"blocks":>7} {"liveness":>10} {"reaching":>10} {"available":>10} {"us/instr":>9}')
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'large.bx')
+        for loops in (250, 500, 1000, 2000):
+            with open(fn, 'w') as fp:
+                fp.write(large_procedure(loops))
+            body = bx2tac.bx_to_tac(fn)[1][0].body
+            times = []
+            start = time.perf_counter()
+            graph = dataflow.FlowGraph(body)
+            for analysis in (dataflow.Liveness, dataflow.ReachingDefinitions, dataflow.AvailableExpressions):
+                analysis(graph)
+                times.append(time.perf_counter() - start)
+                start = time.perf_counter()
+            print(f'{len(body):8} {len(graph.blocks):7}' + ''.join(f'{1000 * t:8.1f}ms' for t in times) +
+                  f'{1e6 * sum(times) / len(body):9.2f}')
+
+
+def bench_cfg(args):
+    """
+    Time of the control flow optimization of tac_cfopt on procedures of growing size, up to 100k instructions: the
+    construction of the basic blocks (CFG.block_inference), the worklist simplification (CFG.simplify) and the dead
+    code elimination, then the instructions and blocks left (time per instruction in us/instr).
+    """
+    import bx2tac
+    import tac_cfopt
+    print(f'{"instrs":>8} {"blocks":>7} {"inference":>10} {"simplify":>10} {"dce":>10} {"us/instr":>9} '
+          f'{"instrs":>8} {"blocks":>7}')
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'large.bx')
+        for loops in (125, 250, 500, 1000, 2000):
+            with open(fn, 'w') as fp:
+                fp.write(large_procedure(loops))
+            proc = bx2tac.bx_to_tac(fn)[1][0]
+            # the instructions as tac_cfopt.optimize_proc gives them to the CFG
+            tac = [bx2tac.Instruction(instr.opcode, (list(instr.args) + [None, None])[:2], instr.result)
+                   for instr in proc.body]
+            start = time.perf_counter()
+            cfg = tac_cfopt.CFG(tac, proc.name)
+            times = [time.perf_counter() - start]
+            blocks = len(cfg.block)
+            for step in (cfg.simplify, cfg.dead_code_elimination):
+                start = time.perf_counter()
+                step()
+                times.append(time.perf_counter() - start)
+            left = sum(len(block.instrs) for block in cfg.block.values())
+            print(f'{len(tac):8} {blocks:7}' + ''.join(f'{1000 * t:8.1f}ms' for t in times) +
+                  f'{1e6 * sum(times) / len(tac):9.2f} {left:8} {len(cfg.block):7}')
+
+
+def bench_ssa(args):
+    """
+    Time of the construction (dominators, phis and renaming) and destruction of the SSA form on procedures of
+    growing size.
+    """
+    import bx2tac
+    import dataflow
+    import ssa
+    print(f'{"instrs":>8} {"blocks":>7} {"phis":>6} {"dominators":>11} {"to_ssa":>10} {"from_ssa":>10} {"us/instr":>9}')
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'large.bx')
+        for loops in (250, 500, 1000, 2000):
+            with open(fn, 'w') as fp:
+                fp.write(large_procedure(loops))
+            proc = bx2tac.bx_to_tac(fn)[1][0]
+            start = time.perf_counter()
+            graph = dataflow.FlowGraph(proc.body)
+            ssa.DominatorTree(graph)
+            dominators = time.perf_counter() - start
+            start = time.perf_counter()
+            form = ssa.to_ssa(proc)
+            construction = time.perf_counter() - start
+            start = time.perf_counter()
+            ssa.from_ssa(form)
+            destruction = time.perf_counter() - start
+            phis = sum(1 for instr in form.body if instr.opcode == 'phi')
+            total = construction + destruction
+            print(f'{len(proc.body):8} {len(graph.blocks):7} {phis:6} {1000 * dominators:9.1f}ms'
+                  f'{1000 * construction:8.1f}ms{1000 * destruction:8.1f}ms{1e6 * total / len(proc.body):9.2f}')
+
+
+def tac_size(procs):
+    # (instructions, basic blocks) of TAC procedures
+    import dataflow
+    instrs = sum(len(proc.body) for proc in procs)
+    blocks = sum(len(dataflow.FlowGraph(proc.body).blocks) for proc in procs)
+    return instrs, blocks
+
+
+def bench_sccp(args):
+    """
+    Instructions and basic blocks of the optimized TAC of the corpus without and with the sparse conditional
+    constant propagation, and what it changed.
+    """
+    import ssa_opt
+    from bx2tac import bx_to_tac
+    from tac_cfopt import optimize_program
+    print(f'{"file":<24}{"instrs":>8}{"sccp":>8}{"blocks":>8}{"sccp":>8}')
+    totals = [0, 0, 0, 0]
+    ssa_opt.stats.clear()
+    for fn in corpus_files(args.corpus):
+        with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+            try:
+                procs = bx_to_tac(str(fn))[1]
+            except SystemExit:
+                continue
+            instrs, blocks = tac_size(optimize_program(procs, passes=[]))
+            sccp_instrs, sccp_blocks = tac_size(optimize_program(procs, passes=[ssa_opt.sccp]))
+        row = (instrs, sccp_instrs, blocks, sccp_blocks)
+        totals = [total + n for total, n in zip(totals, row)]
+        print(f'{fn.stem:<24}' + ''.join(f'{n:8}' for n in row))
+    print(f'{"total":<24}' + ''.join(f'{n:8}' for n in totals))
+    print(f'eliminated: {totals[0] - totals[1]} instructions, {totals[2] - totals[3]} blocks')
+    for name, count in sorted(ssa_opt.stats.items()):
+        print(f'{name}: {count}')
+
+
+def frame_bytes(asm):
+    # total size of the stack frames allocated by the prologues
+    return sum(int(line.split('$')[1].split(',')[0]) for line in asm if line.startswith('\tsubq $'))
+
+
+def bench_dce(args):
+    """
+    Instructions of the optimized TAC of the corpus and size of the stack frames of its assembly (-O0: every
+    temporary in the frame) without and with the dead code elimination. The SSA passes are left out: the constant
+    propagation already removes the constants it folds.
+    """
+    import tac2x64
+    from bx2tac import bx_to_tac
+    from tac_cfopt import optimize_program
+    print(f'{"file":<24}{"instrs":>8}{"dce":>8}{"frames":>8}{"dce":>8}')
+    totals = [0, 0, 0, 0]
+    for fn in corpus_files(args.corpus):
+        with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+            try:
+                gvars, procs = bx_to_tac(str(fn))
+            except SystemExit:
+                continue
+            row = []
+            for dce in (False, True):
+                optimized = optimize_program(procs, passes=[], dce=dce)
+                row.append((tac_size(optimized)[0], frame_bytes(tac2x64.program_to_asm(gvars, optimized))))
+        row = [row[0][0], row[1][0], row[0][1], row[1][1]]
+        totals = [total + n for total, n in zip(totals, row)]
+        print(f'{fn.stem:<24}' + ''.join(f'{n:8}' for n in row))
+    print(f'{"total":<24}' + ''.join(f'{n:8}' for n in totals))
+
+
+def bench_copyprop(args):
+    """
+    Instructions (and copies) executed by the TAC of a few corpus programs, run by tac_interp, optimized without
+    (-O0) and with (-O1) the copy propagation.
+    """
+    import ssa_opt
+    import tac_interp
+    from bx2tac import bx_to_tac
+    from tac_cfopt import optimize_program
+    print(f'{"program":<15}{"executed":>10}{"copyprop":>10}{"copies":>10}{"copyprop":>10}')
+    ssa_opt.stats.clear()
+    for name in ('fib20', 'collatz'):
+        with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+            gvars, procs = bx_to_tac(str(Path(args.corpus, f'{name}.bx')))
+            counts = [tac_interp.run(gvars, optimize_program(procs, passes=ssa_opt.passes[level]))[1]
+                      for level in (0, 1)]
+        print(f'{name:<15}{sum(counts[0].values()):10}{sum(counts[1].values()):10}'
+              f'{counts[0]["copy"]:10}{counts[1]["copy"]:10}')
+    for name, count in sorted(ssa_opt.stats.items()):
+        print(f'{name}: {count}')
+
+
+# Loop recomputing x * y in its condition and its assignments
+redundant_kernel = """
+def main() {
+    var i = 0, s = 0, x = 3, y = 0 : int;
+    while (i < 20000) {
+        y = i % 7;
+        if (x * y + i > s % 1000) { s = s + (x * y + i); } else { s = s - x * y; }
+        i = i + 1;
+    }
+    print(s);
+}
+"""
+
+
+def bench_gvn(args):
+    """
+    Instructions of the TAC and instructions executed (tac_interp) of a loop with common subexpressions and of the
+    corpus programs without and with the global value numbering, then the time spent in each pass optimizing a
+    program of --procs procedures at -O1.
+    """
+    import ssa
+    import ssa_opt
+    import tac_interp
+    from bx2tac import bx_to_tac
+    from tac_cfopt import optimize_program
+    without = [p for p in ssa_opt.passes[1] if p is not ssa_opt.gvn]
+    print(f'{"program":<24}{"instrs":>8}{"gvn":>8}{"executed":>10}{"gvn":>10}')
+    with tempfile.TemporaryDirectory() as tmp:
+        programs = [Path(tmp, 'redundant.bx')] + corpus_files(args.corpus)
+        programs[0].write_text(redundant_kernel)
+        for fn in programs:
+            with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                try:
+                    gvars, procs = bx_to_tac(str(fn))
+                except SystemExit:
+                    continue
+                optimized = [optimize_program(procs, passes=passes) for passes in (without, ssa_opt.passes[1])]
+            executed = [sum(tac_interp.run(gvars, version)[1].values()) for version in optimized]
+            print(f'{fn.stem:<24}{tac_size(optimized[0])[0]:8}{tac_size(optimized[1])[0]:8}'
+                  f'{executed[0]:10}{executed[1]:10}')
+        fn = Path(tmp, 'procs.bx')
+        fn.write_text(compilable_program(args.procs))
+        with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+            procs = bx_to_tac(str(fn))[1]
+            ssa.timings.clear()
+            optimize_program(procs)
+        print(f'\npasses on {len(procs)} procedures, {tac_size(procs)[0]} instructions:')
+        ssa.print_timings(ssa.timings)
+
+
+# Loop computing from the parameters of its procedure at every iteration
+invariant_kernel = """
+def f(a, b : int) {
+    var i = 0, s = 0 : int;
+    while (i < 20000) {
+        s = s + (a * b + (a << 3)) % 1000 + i / 4;
+        i = i + 1;
+    }
+    print(s);
+}
+def main() { f(7, 9); }
+"""
+
+
+def bench_licm(args):
+    """
+    Instructions executed (tac_interp) by a loop with invariant computations and by the corpus programs optimized
+    at -O1 without and with the loop invariant code motion, and what it moved.
+    """
+    import ssa_opt
+    import tac_interp
+    from bx2tac import bx_to_tac
+    from tac_cfopt import optimize_program
+    without = [p for p in ssa_opt.passes[1] if p is not ssa_opt.licm]
+    print(f'{"program":<24}{"executed":>10}{"licm":>10}')
+    ssa_opt.stats.clear()
+    totals = [0, 0]
+    with tempfile.TemporaryDirectory() as tmp:
+        programs = [Path(tmp, 'invariant.bx')] + corpus_files(args.corpus)
+        programs[0].write_text(invariant_kernel)
+        for fn in programs:
+            with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                try:
+                    gvars, procs = bx_to_tac(str(fn))
+                except SystemExit:
+                    continue
+                optimized = [optimize_program(procs, passes=passes) for passes in (without, ssa_opt.passes[1])]
+            executed = [sum(tac_interp.run(gvars, version)[1].values()) for version in optimized]
+            totals = [total + n for total, n in zip(totals, executed)]
+            print(f'{fn.stem:<24}{executed[0]:10}{executed[1]:10}')
+    print(f'{"total":<24}{totals[0]:10}{totals[1]:10}')
+    print(f"licm: {ssa_opt.stats['licm: instructions hoisted']} instructions hoisted, "
+          f"{ssa_opt.stats['licm: preheaders inserted']} preheaders")
+
+
+# Sum over a table of rows indexed by i * width + j, kept in a global
+indexing_kernel = """
+var total = 0 : int;
+def sweep(rows, width : int) {
+    var i = 0, j = 0, cell = 0 : int;
+    while (i < rows) {
+        j = 0;
+        while (j < width) {
+            cell = i * width + j;
+            total = total + (cell << 2) + cell / 8 + cell % 16;
+            j = j + 1;
+        }
+        i = i + 1;
+    }
+}
+def main() {
+    var n = 0 : int;
+    while (n < 30) { sweep(1000, 1000); n = n + 1; }
+    print(total);
+}
+"""
+
+
+def bench_induction(args):
+    """
+    Run time (best of --repeat runs, at most 5) of loop kernels compiled at -O1 and -O2 without and with the
+    strength reduction of the induction variables and of the powers of two.
+    """
+    import regalloc
+    import ssa_opt
+    import tac2x64
+    from bx2tac import bx_to_tac
+    from tac_cfopt import optimize_program
+    reductions = (ssa_opt.induction_variables, ssa_opt.strength_reduction)
+    here = os.path.dirname(os.path.abspath(__file__))
+    print(f'{"program":<15}' + ''.join(f'{f"-O{level}":>10}{"reduced":>10}' for level in (1, 2)))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, source in (('collatz_sum', loop_kernel), ('indexing', indexing_kernel)):
+            fn = os.path.join(tmp, f'{name}.bx')
+            with open(fn, 'w') as fp:
+                fp.write(source)
+            with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                gvars, procs = bx_to_tac(fn)
+            row = f'{name:<15}'
+            for level in (1, 2):
+                for passes in ([p for p in ssa_opt.passes[level] if p not in reductions], ssa_opt.passes[level]):
+                    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                        optimized = optimize_program(procs, passes=passes)
+                        asm = '\n'.join(tac2x64.program_to_asm(gvars, optimized, regalloc.allocators[level]))
+                    exe = os.path.join(tmp, name)
+                    subprocess.run(['gcc', '-o', exe, '-x', 'assembler', '-', '-x', 'none',
+                                    os.path.join(here, 'bx_runtime.c')], input=asm + '\n', text=True, check=True,
+                                   capture_output=True)
+                    times = []
+                    for _ in range(min(args.repeat, 5)):
+                        start = time.perf_counter()
+                        subprocess.run([exe], check=True, stdout=subprocess.DEVNULL)
+                        times.append(time.perf_counter() - start)
+                    row += f'{1000 * min(times):8.0f}ms'
+            print(row)
+
+
+# Loop calling small procedures (a global counter, arithmetic helpers) and a recursive one
+call_kernel = """
+var calls = 0 : int;
+def square(x : int) : int {{ return x * x; }}
+def clamp(x, hi : int) : int {{ if (x > hi) {{ return hi; }} return x; }}
+def tick() {{ calls = calls + 1; }}
+def depth(n : int) : int {{ if (n > 0) {{ return depth(n / 2) + 1; }} return 0; }}
+def main() {{
+    var i = 0, s = 0 : int;
+    while (i < {n}) {{
+        tick();
+        s = s + clamp(square(i % 1000), 250000) + depth(i % 8);
+        i = i + 1;
+    }}
+    print(s); print(calls);
+}}
+"""
+
+
+def bench_inline(args):
+    """
+    Calls and instructions executed by the TAC of a call heavy kernel, run by tac_interp, and its run time (best of
+    --repeat runs, at most 5) compiled at -O1 and -O2, without and with the inlining.
+    """
+    import regalloc
+    import ssa_opt
+    import tac2x64
+    import tac_inline
+    import tac_interp
+    from bx2tac import bx_to_tac
+    from tac_cfopt import optimize_program
+    here = os.path.dirname(os.path.abspath(__file__))
+    tac_inline.stats.clear()
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in (10000, 30000000):
+            fn = os.path.join(tmp, 'calls.bx')
+            with open(fn, 'w') as fp:
+                fp.write(call_kernel.format(n=n))
+            with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                gvars, procs = bx_to_tac(fn)
+            if n < 1000000:
+                print(f'{"budget":<10}{"calls":>10}{"executed":>10}')
+                for budget in (0, tac_inline.budgets[1]):
+                    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                        optimized = optimize_program(tac_inline.inline_program(procs, budget))
+                    counts = tac_interp.run(gvars, optimized)[1]
+                    print(f'{budget:<10}{counts["call"]:10}{sum(counts.values()):10}')
+                continue
+            print(f'{"native":<10}' + ''.join(f'{f"-O{level}":>10}{"inlined":>10}' for level in (1, 2)))
+            row = f'{"":<10}'
+            for level in (1, 2):
+                for budget in (0, tac_inline.budgets[level]):
+                    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                        optimized = optimize_program(tac_inline.inline_program(procs, budget),
+                                                     passes=ssa_opt.passes[level])
+                        asm = '\n'.join(tac2x64.program_to_asm(gvars, optimized, regalloc.allocators[level]))
+                    exe = os.path.join(tmp, 'calls')
+                    subprocess.run(['gcc', '-o', exe, '-x', 'assembler', '-', '-x', 'none',
+                                    os.path.join(here, 'bx_runtime.c')], input=asm + '\n', text=True, check=True,
+                                   capture_output=True)
+                    times = []
+                    for _ in range(min(args.repeat, 5)):
+                        start = time.perf_counter()
+                        subprocess.run([exe], check=True, stdout=subprocess.DEVNULL)
+                        times.append(time.perf_counter() - start)
+                    row += f'{1000 * min(times):8.0f}ms'
+            print(row)
+    for name, count in sorted(tac_inline.stats.items()):
+        print(f'{name}: {count}')
+
+
+branch_kernel = """
+def main() {{
+    var i = 0, s = 0, rare = 0 : int;
+    while (i < {n}) {{
+        if (i % 64 == 0) {{
+            rare = rare + 1;
+        }} else {{
+            s = s + i % 7;
+        }}
+        if (s > 1000000) {{
+            s = s - 1000000;
+        }}
+        i = i + 1;
+    }}
+    print(s); print(rare);
+}}
+"""
+
+
+def branch_counts(profile):
+    # jumps and conditional jumps taken, and fall-throughs, in a profile written by a --count-branches program
+    counts = {'jump': 0, 'branch': 0, 'fall': 0}
+    with open(profile) as fp:
+        for line in fp:
+            kind, count = line.split()[3:]
+            counts[kind] += int(count)
+    return counts
+
+
+def bench_layout(args):
+    """
+    Branches executed by the programs of the corpus and a kernel with a biased branch, counted by the instrumented
+    code of tac2x64 (--count-branches), with the blocks in depth first order, laid out from static estimates and
+    from the profile of the static run; then the run time of the kernel (best of --repeat runs, at most 5).
+    """
+    import regalloc
+    import tac2x64
+    from bx2tac import bx_to_tac
+    from tac_cfopt import optimize_program, read_profile
+    here = os.path.dirname(os.path.abspath(__file__))
+    layouts = ('dfs', 'static', 'profile')
+    with tempfile.TemporaryDirectory() as tmp:
+        kernel = os.path.join(tmp, 'kernel.bx')
+        with open(kernel, 'w') as fp:
+            fp.write(branch_kernel.format(n=100000))
+        exe = os.path.join(tmp, 'prog')
+        profiles = {layout: os.path.join(tmp, f'{layout}.profile') for layout in layouts}
+
+        def build(fn, layout, count_branches):
+            with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                gvars, procs = bx_to_tac(fn)
+                profile = read_profile(profiles['static']) if layout == 'profile' else None
+                optimized = optimize_program(procs, profile=profile, layout=layout != 'dfs')
+                asm = '\n'.join(tac2x64.program_to_asm(gvars, optimized, regalloc.allocators[1], count_branches))
+            subprocess.run(['gcc', '-o', exe, '-x', 'assembler', '-', '-x', 'none', os.path.join(here, 'bx_runtime.c')],
+                           input=asm + '\n', text=True, check=True, capture_output=True)
+
+        print(f'{"taken / fall-through":<24}' + ''.join(f'{layout:>16}' for layout in layouts))
+        totals = {layout: [0, 0] for layout in layouts}
+        for fn in corpus_files(args.corpus) + [kernel]:
+            row = f'{os.path.basename(fn):<24}'
+            for layout in layouts:
+                try:
+                    build(fn, layout, True)
+                except (SystemExit, Exception):
+                    row = None
+                    break
+                if os.path.exists(profiles[layout]):
+                    os.remove(profiles[layout])
+                subprocess.run([exe], check=True, stdout=subprocess.DEVNULL,
+                               env=dict(os.environ, BX_PROFILE=profiles[layout]))
+                counts = branch_counts(profiles[layout])
+                taken = counts['jump'] + counts['branch']
+                totals[layout] = [totals[layout][0] + taken, totals[layout][1] + counts['fall']]
+                row += f'{taken:>10}/{counts["fall"]:<5}'
+            if row is not None:
+                print(row)
+        print(f'{"total":<24}' + ''.join(f'{taken:>10}/{fall:<5}' for taken, fall in totals.values()))
+
+        with open(kernel, 'w') as fp:
+            fp.write(branch_kernel.format(n=100000000))
+        row = f'{"kernel run time":<24}'
+        for layout in layouts:
+            build(kernel, layout, False)
+            times = []
+            for _ in range(min(args.repeat, 5)):
+                start = time.perf_counter()
+                subprocess.run([exe], check=True, stdout=subprocess.DEVNULL)
+                times.append(time.perf_counter() - start)
+            row += f'{1000 * min(times):14.0f}ms'
+        print(row)
+
+
+benchmarks = {
+    'frontend': bench_frontend,
+    'lexer': bench_lexer,
+    'stream': bench_stream,
+    'diagnostics': bench_diagnostics,
+    'incremental': bench_incremental,
+    'pipeline': bench_pipeline,
+    'build': bench_build,
+    'runtime': bench_runtime,
+    'regalloc': bench_regalloc,
+    'dataflow': bench_dataflow,
+    'cfg': bench_cfg,
+    'ssa': bench_ssa,
+    'sccp': bench_sccp,
+    'dce': bench_dce,
+    'copyprop': bench_copyprop,
+    'gvn': bench_gvn,
+    'licm': bench_licm,
+    'induction': bench_induction,
+    'inline': bench_inline,
+    'layout': bench_layout,
+}
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('benchmark', choices=sorted(benchmarks))
+    ap.add_argument('--corpus', default=os.path.join('..', 'TD3', 'examples'), help='Directory of .bx files')
+    ap.add_argument('--repeat', type=int, default=20, help='Number of passes over the corpus')
+    ap.add_argument('--size', type=float, default=4, help='Size (MB) of the synthetic programs')
+    ap.add_argument('--procs', type=int, default=200, help='Number of procedures of the compiled synthetic programs')
+    args = ap.parse_args(sys.argv[1:])
+    benchmarks[args.benchmark](args)
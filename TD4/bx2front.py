@@ -4,33 +4,79 @@ The Reader is composed of a lexer and a parser (from the PLY library).
 It takes as input a source file (.bx) and generates the corresponding ast in json format (json can be dumped in a file)
 """
 import json
+import mmap
 import sys
-from lex_pars import Lexer, Parser
+from lex_pars import Lexer, Parser, Source, Diagnostics, TooManyErrors
 
 """
 Part A of the file: Reader 
 The Reader classe encapsulates the Lexer and the Parser. 
 Thanks to this we only need to class the read(self) method in order to obtain the first node of the AST object. 
+Readers share a single Lexer/Parser pair, so reading a file costs time proportional to its size only.
 """
 # ================================================================================
 
 class Reader:
     def __init__(self, source_name: str, data: str):
-        self.lexer = Lexer(source_name, data)
-        self.parser = Parser(self.lexer)
+        # The lexer and parser are built once per process and reset for every file
+        self.parser = Parser.shared(source_name, data)
+        self.lexer = self.parser.lexer
+        self.data = data
 
     def read(self):
         return self.parser.parse()
 
+    @classmethod
+    def from_file(cls, fn: str, stream=False):
+        """
+        Reader of a source file. In streaming mode the file is memory mapped and tokens are produced lazily from it;
+        the mapping is closed with the reader (use it in a with statement).
+        """
+        return cls(fn, Source.read(fn, stream))
+
+    def close(self):
+        """
+        Unmap a memory mapped source, stopping the scan of the lexer if it is still on it. The slocs of the AST can
+        still be printed (the lexer indexed the newlines) but not their snippet, nor the source text of the nodes.
+        """
+        if isinstance(self.data, mmap.mmap):
+            if self.lexer.data is self.data:
+                self.lexer.stream.close()
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read_checked(self, max_errors=None):
+        """
+        Read and type check the source. The lexing and parsing errors, then the type errors, are collected in one
+        Diagnostics (at most max_errors of them); if there is any they are all printed and the compilation stops.
+        The type checker does not run on a source that failed to parse.
+        """
+        diag = Diagnostics(max_errors)
+        self.lexer.diag = diag
+        try:
+            ast_object = self.read()
+            if not diag.errors:
+                if not ast_object:
+                    raise SyntaxError(f"Error while parsing")
+                ast_object.type_check([], diag)
+        except TooManyErrors:
+            pass
+        finally:
+            self.lexer.diag = None
+        if diag.errors:
+            diag.report()
+            sys.exit(1)
+        return ast_object
+
 def main():
-    with open(bx_filename, 'r') as bx_file:
-        source = bx_file.read()
-        source_name = bx_filename
-        reader = Reader(source_name, source) # Creating the reader object
-        ast_object = reader.read()
-        if not ast_object:
-            raise SyntaxError(f"Error while parsing")
-        ast_object.type_check([]) 
+    source_name = bx_filename
+    with Reader.from_file(source_name) as reader: # Creating the reader object
+        reader.read_checked()
         
 
 
@@ -244,9 +244,11 @@ class ProcUnit:
                 self._emit('jmp', [Lf], None)
 
         elif isinstance(boolexpr, ast.ExpressionVar):
-            self.tmm_expr(boolexpr, self._freshtemp())
-            self._emit('je', [self._freshtemp(), Lf], None)
-            self._emit('jnz', [self._freshtemp(), Lt], None)
+            # the jump tests the temporary the variable was copied to
+            t = self._freshtemp()
+            self.tmm_expr(boolexpr, t)
+            self._emit('je', [t, Lf], None)
+            self._emit('jmp', [Lt], None)
 
         #no comprendo
         elif isinstance(boolexpr, ast.ExpressionUniOp):
@@ -432,47 +434,61 @@ from AST import Vardecl
 from AST import Bool
 import json
 
-def bx_to_json(fn):
-    assert fn.endswith('.bx')
+def program_gvars(ast):
     gvars = []
-    procs = []
-
-    file = open(fn, "r")
-    text = file.read()
-    file.close()
-    reader = bx2front.Reader(fn, text)
-    ast = reader.read()
-    ast.type_check([])
+    for decl in ast.global_vars:
+        if isinstance(decl, Vardecl):
+            if isinstance(decl.expr, Bool):
+                value = 1 if decl.expr.value else 0
+            elif isinstance(decl.expr, AST.ExpressionUniOp):
+                # -n, the only other initialisation allowed by the type checker
+                value = -decl.expr.argument.value
+            else:
+                value = decl.expr.value
+            gvars.append(GlobalVar(decl.var.name, value))
+    return gvars
 
-    def add_gvar(decl):
-        if isinstance(decl.expr, Bool):
-            value = 1 if decl.expr.value else 0
-        else:
-            value = decl.expr.value
-        gvar = GlobalVar(decl.var.name, value)
-        gvars.append(gvar)
+def bx_to_tac(fn, stream=False, max_errors=None):
+    """
+    TAC of a BX file: its global variables (GlobalVar) and procedures (Procedure).
+    """
+    with bx2front.Reader.from_file(fn, stream) as reader:
+        ast = reader.read_checked(max_errors)
 
     # Global Variables
-    for decl in ast.global_vars:
-        if isinstance(decl, Vardecl):
-            add_gvar(decl)
-            # transform into json
+    gvars = program_gvars(ast)
 
     # Function Declarations
+    procs = []
     for decl in ast.procs:
         if isinstance(decl, ProcDecl):
             proc_tac = ProcUnit(decl, gvars)
-            # convert tac into json
             procs.append(Procedure(proc_tac.name, proc_tac.args, proc_tac.body))
+    return gvars, procs
 
-    full = gvars + procs
-    full_json = []
-    for elem in full:
-        full_json.append(elem.js_obj)
-
-    tac = fn[:-2] + 'tac.json'
-    with open(tac, 'w') as fp:
-        json.dump(full_json, fp)
-    return tac
-
+def tac_to_json(gvars, procs):
+    return [elem.js_obj for elem in gvars + procs]
 
+def tac_from_json(js_obj):
+    """
+    Inverse of tac_to_json: global variables and procedures of a TAC program read from a tac.json file.
+    """
+    gvars = []
+    procs = []
+    for decl in js_obj:
+        if 'var' in decl:
+            gvars.append(GlobalVar(decl['var'][1:], decl['init']))
+        elif 'proc' in decl:
+            body = [Instruction(instr['opcode'], instr['args'], instr['result']) for instr in decl['body']]
+            procs.append(Procedure(decl['proc'][1:], decl['args'], body))
+    return gvars, procs
+
+def write_tac(fn, gvars, procs):
+    with open(fn, 'w') as fp:
+        json.dump(tac_to_json(gvars, procs), fp)
+    return fn
+
+def bx_to_json(fn, stream=False, max_errors=None):
+    assert fn.endswith('.bx')
+    gvars, procs = bx_to_tac(fn, stream, max_errors)
+    return write_tac(fn[:-2] + 'tac.json', gvars, procs)
@@ -1,5 +1,6 @@
 #include <stdio.h>
 #include <stdint.h>
+#include <stdlib.h>
 /* Note: TAC int == C int64_t
    This is because C int is usually only 32 bits. */
 void __bx_print_int(int64_t x)
@@ -12,3 +13,17 @@ void __bx_print_bool(int64_t b)
     printf(b == 0 ? "false\n" : "true\n");
 }
 
+
+/* Branch counters of a procedure compiled with bxcc --count-branches, called at exit:
+   appends a line "procedure source target kind count" per edge to the file named by
+   BX_PROFILE (default bx.profile), read back by bxcc --profile. */
+void __bx_write_profile(const char *edges[], const int64_t counts[], int64_t n)
+{
+  const char *path = getenv("BX_PROFILE");
+  FILE *fp = fopen(path ? path : "bx.profile", "a");
+  if (fp == NULL)
+    return;
+  for (int64_t i = 0; i < n; i++)
+    fprintf(fp, "%s %lld\n", edges[i], (long long) counts[i]);
+  fclose(fp);
+}
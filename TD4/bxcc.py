@@ -2,92 +2,292 @@
 Going from .bx to x64 (currently stops at tac...)
 """
 import argparse
+import contextlib
+import glob
+import io
 import json
 import os
+import subprocess
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from bx2front import Reader
+from lex_pars import Parser, lexers
 from bx2tac import Prog
 import bx2tac
 import tac2x64 as x64
 import sys 
 import tac_cfopt
+import tac_inline
+import regalloc
+import ssa
+import ssa_opt
+from proc_cache import ProcCache, compile_bx
+
+def link(filename: str, asm_text: str, options, capture=False):
+    """
+    Assemble and link the program with the runtime. The assembly is piped to gcc, the .s file is only written
+    when --keep_asm or --stop_asm asks for it. Returns an error message, or None when the executable was produced.
+    With capture the output of gcc is part of the error message instead of being printed.
+    """
+    if options.keep_asm or options.stop_asm:
+        with open(f'{filename}.s', 'w') as fp:
+            fp.write(asm_text)
+        if options.stop_asm:
+            return None
+    gcc = subprocess.run(['gcc', '-o', filename, '-x', 'assembler', '-', '-x', 'none', 'bx_runtime.c'],
+                         input=asm_text, text=True, capture_output=capture)
+    if gcc.returncode != 0:
+        return f'gcc exited abnormally\n{gcc.stderr}' if capture else 'gcc exited abnormally'
+    return None
+
+
+def allocator(options):
+    # Register allocator of the optimization level; --no_opt keeps every temporary on the stack
+    if options.no_opt or regalloc.allocators[options.opt_level] is None:
+        return None
+    if options.regalloc_report:
+        return regalloc.reporting(regalloc.allocators[options.opt_level])
+    return regalloc.allocators[options.opt_level]
+
+
+def inline_budget(options):
+    # --inline-budget, or the inlining budget of the optimization level
+    return tac_inline.budgets[options.opt_level] if options.inline_budget is None else options.inline_budget
+
+
+def read_profile(options):
+    # Edge counts of --profile for the block layout, None for the static estimates; read once for all the files
+    if not options.profile:
+        return None
+    try:
+        return tac_cfopt.read_profile(options.profile)
+    except OSError as e:
+        error = e.strerror
+    except ValueError as e:
+        error = e
+    print(f'Cannot read the profile {options.profile}: {error}')
+    sys.exit(1)
+
+
+def backend(filename: str, gvars: list, procs: list, options):
+    # Inlining, optimization and instruction selection of a TAC program (bx2tac GlobalVar and Procedure objects).
+    # Returns the assembly, or None when stopping at the TAC.
+    if not options.no_opt:
+        procs = tac_inline.inline_program(procs, inline_budget(options))
+        procs = tac_cfopt.optimize_program(procs, options.dump_ssa, ssa_opt.passes[options.opt_level],
+                                           profile=options.edge_counts)
+    if options.keep_tac or options.stop_tac:
+        bx2tac.write_tac(f'{filename}.optimized_tac.json', gvars, procs)
+        if options.stop_tac:
+            return None
+    return '\n'.join(x64.program_to_asm(gvars, procs, allocator(options), options.count_branches)) + '\n'
+
 
 # We use this function that takes as input a tac.json file 
-def accept_tac(tac_filename: str, opt=None):
-    tac_optimize = tac_cfopt.optimization(tac_filename)
-    if options.stop_tac:
+def accept_tac(tac_filename: str, options):
+    with open(tac_filename) as fp:
+        gvars, procs = bx2tac.tac_from_json(json.load(fp))
+    filename = tac_filename[:-9]
+    asm = backend(filename, gvars, procs, options)
+    if asm is None:
         sys.exit(0)
-
-    asm_rname = x64.compile_tac(tac_optimize)
+    error = link(filename, asm, options)
     if options.stop_asm:
         sys.exit(0)
-    #At this point we have created the asm file, we call gcc to finish compilation
-    filename = tac_filename[:-9]
-    shell_command = f"gcc -o {filename} {asm_rname} bx_runtime.c"
-    gcc_stat = os.system(shell_command)
-    if not (os.WIFEXITED(gcc_stat) and os.WEXITSTATUS(gcc_stat) == 0):
-        print(f'gcc exited abnormally')
-    
-    if not options.keep_asm:
-        shell_command_2 = f"rm {asm_rname}"
-        os.system(shell_command_2)
+    if error:
+        print(error)
+    print(f"{tac_filename} -> {filename}")
 
-    #Cleanup 
-    shell_command_3 = f"rm {tac_filename} {tac_optimize}"
-    os.system(shell_command_3)
 
-    print(f"{tac_filename} -> {filename}")
+def compile_cached(bx_filename: str, options):
+    # Incremental build: only the procedures missing from the cache are compiled, then everything is relinked.
+    # Returns the assembly (None when stopping at the TAC) and the cache, for its statistics.
+    salt = ['no_opt'] if options.no_opt else [f'O{options.opt_level}', f'inline{inline_budget(options)}']
+    if options.count_branches:
+        salt.append('count_branches')
+    cache = ProcCache(options.cache_dir, options.cache_size * 1024 * 1024, salt)
+    if options.keep_tac:
+        # the cache only holds the optimized TAC, the front end output is produced again for the tac.json file
+        bx2tac.write_tac(f'{bx_filename[:-3]}.tac.json', *bx2tac.bx_to_tac(bx_filename, options.stream, options.max_errors))
+    asm, tac = compile_bx(bx_filename, cache, not options.no_opt, allocator(options), options.stream,
+                          options.max_errors, options.dump_ssa, ssa_opt.passes[options.opt_level], inline_budget(options),
+                          options.edge_counts, options.count_branches)
+    if options.keep_tac or options.stop_tac:
+        with open(f'{bx_filename[:-3]}.optimized_tac.json', 'w') as fp:
+            json.dump(tac, fp)
+        if options.stop_tac:
+            return None, cache
+    return '\n'.join(asm) + '\n', cache
+
+
+def compile_file(bx_filename: str, options):
+    """
+    Front end, optimization and instruction selection of a BX file. Returns its assembly (None when stopping at the
+    TAC) and the procedure cache used, if any. Errors in the program end the process (SystemExit).
+    """
+    if options.cache_dir:
+        return compile_cached(bx_filename, options)
+
+    #Main program driver: the passes exchange the TAC in memory, files are only written on request
+    filename = bx_filename[:-3]
+    gvars, procs = bx2tac.bx_to_tac(bx_filename, options.stream, options.max_errors)
+    if options.keep_tac:
+        bx2tac.write_tac(f'{filename}.tac.json', gvars, procs)
+    return backend(filename, gvars, procs, options), None
+
+# ================================================================================
+# Parallel build of many files
+
+def source_files(names):
+    """
+    The .bx files named on the command line: directories stand for the .bx files they contain and glob patterns
+    are expanded (both sorted), so the order of the build never depends on the file system.
+    """
+    files = []
+    for name in names:
+        if os.path.isdir(name):
+            files.extend(sorted(glob.glob(os.path.join(name, '*.bx'))))
+        elif any(c in name for c in '*?['):
+            files.extend(sorted(glob.glob(name)))
+        else:
+            files.append(name)
+    return files
+
+
+def configure(options):
+    if options.parser_cache_dir:
+        Parser.cache_dir = options.parser_cache_dir
+    Parser.lexer_class = lexers[options.lexer]
+
+
+def init_worker(options):
+    # Every worker process builds its Lexer/Parser pair once and reuses it for all the files it compiles
+    configure(options)
+    Parser.shared('<warm-up>', '')
+
+
+def compile_job(bx_filename: str, options):
+    """
+    compile_file in a worker process. Returns (assembly, error message, cache statistics, time spent in each
+    optimization pass); what the compiler prints is only kept to explain a failure.
+    """
+    out = io.StringIO()
+    ssa.timings.clear()
+    try:
+        with contextlib.redirect_stdout(out):
+            if not bx_filename.endswith('.bx'):
+                raise ValueError(f'File {bx_filename} does not have .bx extension')
+            asm, cache = compile_file(bx_filename, options)
+    except SystemExit:
+        return None, out.getvalue().strip('\n') or 'compilation failed', None, None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}', None, None
+    stats = (cache.hits, cache.misses, cache.evictions) if cache else None
+    return asm, None, stats, dict(ssa.timings)
+
+
+def build(files, options):
+    """
+    Compile files over options.jobs processes and link them with at most options.jobs gcc at a time, each file
+    being linked as soon as it is compiled. The report lists the files in command line order with the errors of
+    each failed file. Returns the number of failures.
+    """
+    errors = {}
+    stats = [0, 0, 0]
+    timings = Counter()
+    with ProcessPoolExecutor(options.jobs, initializer=init_worker, initargs=(options,)) as pool, \
+         ThreadPoolExecutor(options.jobs) as linker:
+        jobs = [pool.submit(compile_job, fn, options) for fn in files]
+        links = {}
+        for fn, job in zip(files, jobs):
+            asm, error, cache_stats, pass_timings = job.result()
+            timings.update(pass_timings or {})
+            if cache_stats:
+                stats = [total + n for total, n in zip(stats, cache_stats)]
+            if error:
+                errors[fn] = error
+            elif asm is not None:
+                links[fn] = linker.submit(link, fn[:-3], asm, options, True)
+        for fn, job in links.items():
+            error = job.result()
+            if error:
+                errors[fn] = error
+
+    for fn in files:
+        if fn in errors:
+            print(f'{fn}: FAILED')
+            print('\n'.join('    ' + line for line in errors[fn].splitlines()))
+        elif fn in links and not options.stop_asm:
+            print(f"{fn} -> {fn[:-3]}")
+    if options.cache_dir and options.cache_stats:
+        cache = ProcCache(options.cache_dir, options.cache_size * 1024 * 1024)
+        cache.hits, cache.misses, cache.evictions = stats
+        cache.report()
+    if options.time_passes:
+        ssa.print_timings(timings)
+    print(f'{len(files) - len(errors)} of {len(files)} files compiled, {len(errors)} failed')
+    return len(errors)
 
 
 def main(options):
-    bx_filename = options.fname[0]
+    configure(options)
+    options.edge_counts = read_profile(options)
+    files = source_files(options.fname)
+    if options.jobs > 1 or len(files) != 1 or files[0] != options.fname[0]:
+        if options.accept_tac_json:
+            print('--accept.tac.json takes a single file')
+            sys.exit(1)
+        sys.exit(1 if build(files, options) else 0)
+
+    bx_filename = files[0]
     if options.accept_tac_json:
         accept_tac(bx_filename, options)
+        return
     if not bx_filename.endswith('.bx'):
         print(f'File {bx_filename} does not have .bx extension')
         sys.exit(1)
-    
-    #Main program driver 
-    tac_filename = bx2tac.bx_to_json(bx_filename)  
-    if options.no_opt:
-        #If called with no optimization we use the regular tac file for x64 creation
-        asm_rname = x64.compile_tac(tac_filename)
-        
-    tac_optimize = tac_cfopt.optimization(tac_filename)
-    if options.stop_tac:
-        sys.exit(0)
 
-    asm_rname = x64.compile_tac(tac_optimize)
+    asm, cache = compile_file(bx_filename, options)
+    if cache and options.cache_stats:
+        cache.report()
+    if options.time_passes:
+        ssa.print_timings(ssa.timings)
+    if asm is None:
+        sys.exit(0)
+    error = link(bx_filename[:-3], asm, options)
     if options.stop_asm:
         sys.exit(0)
-    #At this point we have created the asm file, we call gcc to finish compilation
-    filename = bx_filename[:-3]
-    shell_command = f"gcc -o {filename} {asm_rname} bx_runtime.c"
-    gcc_stat = os.system(shell_command)
-    if not (os.WIFEXITED(gcc_stat) and os.WEXITSTATUS(gcc_stat) == 0):
-        print(f'gcc exited abnormally')
-    
-    if not options.keep_asm:
-        shell_command_2 = f"rm {asm_rname}"
-        os.system(shell_command_2)
-
-    #Cleanup 
-    shell_command_3 = f"rm {tac_filename} {tac_optimize}"
-    os.system(shell_command_3)
-
-    print(f"{bx_filename} -> {filename}")
+    if error:
+        print(error)
+    print(f"{bx_filename} -> {bx_filename[:-3]}")
     
 if __name__ == '__main__':
     #Adding command line arguments
     ap = argparse.ArgumentParser()
+    ap.add_argument('fname', nargs='+', help='The .bx files to compile (directories and glob patterns are expanded)')
+    ap.add_argument('-j', '--jobs', dest='jobs', type=int, default=1, help='Number of files compiled and linked in parallel')
     ap.add_argument('--keep_ast', dest = 'keep_ast', action='store_true', default=False, help= 'Keep the ast.json file')
     ap.add_argument('--keep_tac', dest = 'keep_tac', action='store_true', default=False, help= 'Keep the tac.json file')
     ap.add_argument('--keep_asm', dest = 'keep_asm', action='store_true', default=False, help= 'Keep the .s file')
     ap.add_argument('--stop_tac', dest = 'stop_tac', action='store_true', default=False, help= 'Stop at the tac.json file')
     ap.add_argument('--stop_asm', dest = 'stop_asm', action='store_true', default=False, help= 'Stop at the .s file')
     ap.add_argument('--accept.tac.json', dest = 'accept_tac_json', action='store_true', default=False, help='Accept the tac.json file')
+    ap.add_argument('-O', dest='opt_level', type=int, choices=sorted(regalloc.allocators), default=1, help='Optimization level: 0 keeps every temporary on the stack, 1 propagates the copies and allocates registers by linear scan, 2 by graph coloring with coalescing')
+    ap.add_argument('--inline-budget', dest='inline_budget', type=int, default=None, help='Largest procedure (in TAC instructions) inlined at its calls, 0 to inline nothing (default: 40 at -O1 and -O2, 0 at -O0)')
+    ap.add_argument('--profile', dest='profile', default=None, help='Lay out the blocks from the branch counts in this file (written by programs compiled with --count-branches) instead of static estimates')
+    ap.add_argument('--count-branches', dest='count_branches', action='store_true', default=False, help='Count the branches taken and the fall-throughs of every block; at exit the program appends them to the file named by BX_PROFILE (default bx.profile)')
+    ap.add_argument('--regalloc-report', dest='regalloc_report', action='store_true', default=False, help='Print the spills and moves eliminated by the register allocator for every procedure')
+    ap.add_argument('--dump-ssa', dest='dump_ssa', action='store_true', default=False, help='Print the SSA form of every procedure, before the SSA optimizations')
+    ap.add_argument('--time-passes', dest='time_passes', action='store_true', default=False, help='Print the time spent in each optimization pass')
     ap.add_argument('--no_opt', dest='no_opt', action='store_true', default=False, help='Perform compilation with no optimization')
-    p
+    ap.add_argument('--lexer', dest='lexer', choices=sorted(lexers), default='ply', help='Lexer engine used by the front end')
+    ap.add_argument('--stream', dest='stream', action='store_true', default=False, help='Memory map the source and lex it lazily (uses the fast lexer)')
+    ap.add_argument('--max-errors', dest='max_errors', type=int, default=None, help='Stop type checking after this many errors')
+    ap.add_argument('--cache-dir', dest='cache_dir', default=None, help='Compile incrementally, reusing the procedures cached in this directory')
+    ap.add_argument('--cache-size', dest='cache_size', type=int, default=64, help='Maximum size (MB) of the procedure cache')
+    ap.add_argument('--cache-stats', dest='cache_stats', action='store_true', default=False, help='Print the hits, misses and size of the procedure cache')
+    ap.add_argument('--parser-cache-dir', dest='parser_cache_dir', default=None, help='Directory where the parser tables are cached')
 
     options = ap.parse_args(sys.argv[1:])
     main(options)
@@ -0,0 +1,427 @@
+"""
+Dataflow analyses of TAC procedures.
+A FlowGraph splits a procedure body (or the blocks of a tac_cfopt.CFG) in basic blocks; a bit vector problem
+(gen/kill sets per block, direction and meet) is solved over it by a worklist. Sets are Python ints used as bit
+vectors over a numbering of their elements, so a whole set is joined, masked or compared in one operation; the
+worklist solves the loops one after the other, so that each block is visited a few times only.
+Clients: liveness of temporaries, reaching definitions and available expressions.
+"""
+import heapq
+
+# Conditional jumps of the TAC
+jumps = {'je', 'jnz', 'jl', 'jle', 'jg', 'jge', 'jnl', 'jnle', 'jz'}
+
+# Operators whose result only depends on their arguments
+pure_ops = {'add', 'sub', 'mul', 'div', 'mod', 'and', 'or', 'xor', 'shl', 'shr', 'neg', 'not'}
+
+# ================================================================================
+
+def is_temp(arg):
+    # Temporaries are %-names; labels (%.L...) and the discarded result %_ are not
+    return isinstance(arg, str) and arg.startswith('%') and not arg.startswith('%.') and arg != '%_'
+
+
+def use_positions(instr):
+    """
+    Positions in instr.args of the operands read by a TAC instruction (temporaries or not).
+    """
+    opcode = instr.opcode
+    if opcode in ('label', 'jmp', 'nop', 'call', 'const'):
+        return range(0)
+    elif opcode in jumps:
+        return range(1)
+    elif opcode == 'param':
+        return range(1, 2)
+    # copy, ret, unary and binary operators (and the phis of ssa, whose labels are not temporaries)
+    return range(len(instr.args))
+
+
+def uses_defs(instr):
+    """
+    Temporaries read and written by a TAC instruction.
+    """
+    args = instr.args
+    uses = [args[i] for i in use_positions(instr) if i < len(args) and is_temp(args[i])]
+    return uses, [instr.result] if is_temp(instr.result) else []
+
+
+class Universe:
+    """
+    Numbering of the elements of the sets of an analysis, to encode them as bit vectors.
+    """
+    def __init__(self):
+        self.index = {}
+        self.elements = []
+
+    def bit(self, element):
+        i = self.index.get(element)
+        if i is None:
+            i = self.index[element] = len(self.elements)
+            self.elements.append(element)
+        return 1 << i
+
+    def bits(self, elements):
+        bits = 0
+        for element in elements:
+            bits |= self.bit(element)
+        return bits
+
+    def decode(self, bits):
+        elements = self.elements
+        result = set()
+        while bits:
+            low = bits & -bits
+            result.add(elements[low.bit_length() - 1])
+            bits ^= low
+        return result
+
+
+def strongly_connected(succs):
+    """
+    Strongly connected components of the graph whose node v has the successors succs[v], by Tarjan's algorithm
+    without recursion: component[v] is the number of the component of node v, components being numbered in
+    topological order (the edges between two components go to the higher number).
+    """
+    n = len(succs)
+    index, low = [None] * n, [0] * n
+    on_stack = [False] * n
+    stack, found = [], []
+    component = [0] * n
+    counter = 0
+    for root in range(n):
+        if index[root] is not None:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        dfs = [(root, iter(succs[root]))]
+        while dfs:
+            b, children = dfs[-1]
+            for s in children:
+                if index[s] is None:
+                    index[s] = low[s] = counter
+                    counter += 1
+                    stack.append(s)
+                    on_stack[s] = True
+                    dfs.append((s, iter(succs[s])))
+                    break
+                elif on_stack[s]:
+                    low[b] = min(low[b], index[s])
+            else:
+                dfs.pop()
+                if dfs:
+                    parent = dfs[-1][0]
+                    low[parent] = min(low[parent], low[b])
+                if low[b] == index[b]:
+                    # Tarjan finds the components in reverse topological order
+                    while True:
+                        c = stack.pop()
+                        on_stack[c] = False
+                        component[c] = len(found)
+                        if c == b:
+                            break
+                    found.append(b)
+    return [len(found) - 1 - c for c in component]
+
+
+class FlowGraph:
+    """
+    Basic blocks of a procedure body: blocks[b] is the list of (index in body, instruction) of block b, succs[b] and
+    preds[b] the numbers of its successors and predecessors. Block 0 is the entry.
+    """
+    def __init__(self, body):
+        self.body = body
+        labels = {instr.args[0]: i for i, instr in enumerate(body) if instr.opcode == 'label'}
+
+        # leaders: the first instruction, labels, and what follows a jump or a return
+        leaders = {0} if body else set()
+        for i, instr in enumerate(body):
+            if instr.opcode == 'label':
+                leaders.add(i)
+            elif (instr.opcode in ('jmp', 'ret') or instr.opcode in jumps) and i + 1 < len(body):
+                leaders.add(i + 1)
+        starts = sorted(leaders)
+        block_of = {}
+        self.blocks = []
+        for b, start in enumerate(starts):
+            end = starts[b + 1] if b + 1 < len(starts) else len(body)
+            self.blocks.append([(i, body[i]) for i in range(start, end)])
+            block_of[start] = b
+
+        self.succs = []
+        for b, block in enumerate(self.blocks):
+            i, last = block[-1]
+            succs = []
+            if last.opcode == 'jmp':
+                succs.append(block_of[labels[last.args[0]]])
+            elif last.opcode in jumps:
+                succs.append(block_of[labels[last.args[1]]])
+            if last.opcode not in ('jmp', 'ret') and i + 1 < len(body):
+                succs.append(b + 1)
+            self.succs.append(list(dict.fromkeys(succs)))
+        self.preds = [[] for _ in self.blocks]
+        for b, succs in enumerate(self.succs):
+            for s in succs:
+                self.preds[s].append(b)
+
+    @classmethod
+    def from_cfg(cls, cfg):
+        """
+        Flow graph of a tac_cfopt.CFG. Its blocks end with an explicit jmp or ret but may leave earlier through a
+        conditional jump: they are split there.
+        """
+        return cls([instr for block in cfg.block.values() for instr in block.instrs])
+
+    def postorder(self, reachable=False):
+        # iterative depth first search from the entry; unreachable blocks come last, unless only the reachable
+        # blocks are asked for
+        order, seen = [], set()
+        for root in range(min(1, len(self.blocks)) if reachable else len(self.blocks)):
+            if root in seen:
+                continue
+            seen.add(root)
+            stack = [(root, iter(self.succs[root]))]
+            while stack:
+                b, children = stack[-1]
+                for s in children:
+                    if s not in seen:
+                        seen.add(s)
+                        stack.append((s, iter(self.succs[s])))
+                        break
+                else:
+                    stack.pop()
+                    order.append(b)
+        return order
+
+    def reverse_postorder(self):
+        # the blocks the entry reaches, in reverse postorder
+        return self.postorder(reachable=True)[::-1]
+
+    def components(self):
+        """
+        Strongly connected components (loops) of the graph: component[b] is the number of the component of block b,
+        components being numbered in topological order (the edges between two components go to the higher number).
+        """
+        return strongly_connected(self.succs)
+
+# ================================================================================
+
+def solve(graph, gen, kill, forward, meet_union=True, boundary=0, top=0):
+    """
+    Worklist solver of the bit vector problem out = gen | (in & ~kill) over the blocks of a flow graph, where in is
+    the meet (union or intersection) of the neighbours before the block (predecessors when forward, successors
+    otherwise). boundary is the value entering the entry (forward) or leaving the exits (backward), top the initial
+    value of the other blocks (the full set for intersection problems). Returns (ins, outs) in the direction of the
+    analysis: for a backward problem ins are the values at the end of the blocks and outs at their start.
+    """
+    n = len(graph.blocks)
+    before = graph.preds if forward else graph.succs
+    after = graph.succs if forward else graph.preds
+    ins = [0] * n
+    outs = [top] * n
+    # the pending block visited first is the one of the first loop (component) in the direction of the analysis,
+    # then the first in (reverse) postorder: every loop is solved before the blocks after it are visited, so they
+    # are not visited again each time a loop before them changes
+    postorder = graph.postorder()
+    component = graph.components()
+    if forward:
+        position = {b: r for r, b in enumerate(reversed(postorder))}
+        order = sorted(range(n), key=lambda b: (component[b], position[b]))
+    else:
+        position = {b: r for r, b in enumerate(postorder)}
+        order = sorted(range(n), key=lambda b: (-component[b], position[b]))
+    rank = [0] * n
+    for r, b in enumerate(order):
+        rank[b] = r
+    pending = list(range(n))
+    queued = [True] * n
+    while pending:
+        b = order[heapq.heappop(pending)]
+        queued[b] = False
+        neighbours = before[b]
+        if not neighbours or (forward and b == 0):
+            value = boundary
+            for p in neighbours:
+                value = value | outs[p] if meet_union else value & outs[p]
+        elif meet_union:
+            value = 0
+            for p in neighbours:
+                value |= outs[p]
+        else:
+            value = outs[neighbours[0]]
+            for p in neighbours[1:]:
+                value &= outs[p]
+        ins[b] = value
+        out = gen[b] | (value & ~kill[b])
+        if out != outs[b]:
+            outs[b] = out
+            for s in after[b]:
+                if not queued[s]:
+                    queued[s] = True
+                    heapq.heappush(pending, rank[s])
+    return ins, outs
+
+# ================================================================================
+
+class Liveness:
+    """
+    Live temporaries at the start (live_in) and end (live_out) of every block, as bit vectors of self.temps.
+    Only the temporaries read in a block before being written there can be live at the start of a block: the
+    others (most temporaries of the TAC, used in the block that computes them) are left out of the bit vectors,
+    which stay short on large procedures.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        self.temps = Universe()
+        self.uses_defs = {}
+        exposed, defined = [], []
+        for block in graph.blocks:
+            used, written = set(), set()
+            for i, instr in reversed(block):
+                uses, defs = self.uses_defs[i] = uses_defs(instr)
+                used.difference_update(defs)
+                used.update(uses)
+                written.update(defs)
+            exposed.append(used)
+            defined.append(written)
+        for used in exposed:
+            self.temps.bits(used)
+        index = self.temps.index
+        gen = [self.temps.bits(used) for used in exposed]
+        kill = [self.temps.bits(temp for temp in written if temp in index) for written in defined]
+        self.live_out, self.live_in = solve(graph, gen, kill, forward=False)
+
+    def instructions(self):
+        """
+        Live temporaries after every instruction of the body, as sets.
+        """
+        result = [set() for _ in self.graph.body]
+        for b, block in enumerate(self.graph.blocks):
+            # sets inside a block: an operation on a bit vector costs the size of the whole universe
+            live = self.temps.decode(self.live_out[b])
+            for i, instr in reversed(block):
+                result[i] = set(live)
+                uses, defs = self.uses_defs[i]
+                live.difference_update(defs)
+                live.update(uses)
+        return result
+
+
+def liveness(body):
+    """
+    Temporaries live after every instruction of a procedure body.
+    """
+    return Liveness(FlowGraph(body)).instructions()
+
+
+class ReachingDefinitions:
+    """
+    Definitions (indices in the body of instructions writing a temporary) reaching the start (reach_in) and end
+    (reach_out) of every block, as bit vectors of self.defs.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        self.defs = Universe()
+        by_temp = {}
+        for i, instr in enumerate(graph.body):
+            for temp in uses_defs(instr)[1]:
+                by_temp.setdefault(temp, 0)
+                by_temp[temp] |= self.defs.bit(i)
+        gen, kill = [], []
+        for block in graph.blocks:
+            g, k = 0, 0
+            for i, instr in block:
+                for temp in uses_defs(instr)[1]:
+                    k |= by_temp[temp]
+                    g = (g & ~by_temp[temp]) | self.defs.bit(i)
+            gen.append(g)
+            kill.append(k)
+        self.reach_in, self.reach_out = solve(graph, gen, kill, forward=True)
+
+    def reaching(self, b):
+        # indices of the definitions reaching the start of block b
+        return self.defs.decode(self.reach_in[b])
+
+
+class AvailableExpressions:
+    """
+    Expressions (opcode, arguments) of the pure operators computed on every path to the start (avail_in) and end
+    (avail_out) of every block and not invalidated since, as bit vectors of self.exprs.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        self.exprs = Universe()
+        for instr in graph.body:
+            if instr.opcode in pure_ops:
+                self.exprs.bit(self.expression(instr))
+        # expressions invalidated by a write of each temporary
+        reads = {}
+        for expr in self.exprs.elements:
+            for arg in expr[1]:
+                if is_temp(arg):
+                    reads[arg] = reads.get(arg, 0) | self.exprs.bit(expr)
+        gen, kill = [], []
+        for block in graph.blocks:
+            g, k = 0, 0
+            for i, instr in block:
+                if instr.opcode in pure_ops:
+                    g |= self.exprs.bit(self.expression(instr))
+                for temp in uses_defs(instr)[1]:
+                    invalid = reads.get(temp, 0)
+                    g &= ~invalid
+                    k |= invalid
+            gen.append(g)
+            kill.append(k)
+        full = (1 << len(self.exprs.elements)) - 1
+        self.avail_in, self.avail_out = solve(graph, gen, kill, forward=True, meet_union=False, top=full)
+
+    @staticmethod
+    def expression(instr):
+        return (instr.opcode, tuple(arg for arg in instr.args if arg is not None))
+
+    def available(self, b):
+        return self.exprs.decode(self.avail_in[b])
+
+
+def interference_graph(proc):
+    """
+    Interference graph of the temporaries of a procedure ({temporary: set of neighbours}) and its moves (copy
+    instructions, as (destination, source) pairs). A temporary written by an instruction interferes with every
+    other temporary live after it, except the source of a copy; the register parameters are all written at the
+    entry. The parameters passed on the stack stay out of the graph.
+    """
+    excluded = set(proc.args[6:])
+    graph = {}
+    moves = []
+
+    def add_edge(a, b):
+        if a != b and a not in excluded and b not in excluded:
+            graph[a].add(b)
+            graph[b].add(a)
+
+    live_out = liveness(proc.body)
+    for instr, out in zip(proc.body, live_out):
+        uses, defs = uses_defs(instr)
+        for temp in set(uses) | set(defs) | out:
+            if temp not in excluded:
+                graph.setdefault(temp, set())
+        source = uses[0] if instr.opcode == 'copy' and uses else None
+        if source is not None and defs and source not in excluded and defs[0] not in excluded:
+            moves.append((defs[0], source))
+        for d in defs:
+            for temp in out:
+                if temp != source:
+                    add_edge(d, temp)
+
+    params = [arg for arg in proc.args[:6]]
+    live_in = set()
+    if proc.body:
+        uses, defs = uses_defs(proc.body[0])
+        live_in = set(uses) | (live_out[0] - set(defs))
+    for p in params:
+        graph.setdefault(p, set())
+    for p in params:
+        for temp in live_in | set(params):
+            add_edge(p, temp)
+    return graph, moves
@@ -2,6 +2,15 @@
 This file contains the implementation of the Lexer and Parser classes used by the Reader class in bx2ast.py
 It makes extensive use of the PLY library in order to convert symbols into tokens, and then parse these tokens to generate the AST corresponding to a specific BX program. 
 """
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import re
+import types
+from array import array
+import ply
 import ply.lex as lex 
 import ply.yacc as yacc
 import AST as ast
@@ -11,8 +20,10 @@ Part A of the file: Source & Sloc
 In order to better keep track of error messages and their location (line and column numbers) we create two classes. 
 Source: object that holds two attributes: 
         -> provenance: name of source code file 
-        -> data: source code string representation
+        -> data: source code string representation (or, in streaming mode, a read-only memory map of the file)
 It will be given as an argument to the Lexer and then passed on to every Sloc instance. 
+The offsets of the newlines of data are indexed (by the FastLexer while scanning, otherwise on the first error message),
+so that printing an error only fetches the offending line instead of the whole source.
 
 Sloc: object that holds three attributes: 
         -> source: Source object as described above 
@@ -20,13 +31,84 @@ Sloc: object that holds three attributes:
         -> lexpos: position of the lexer
 A Sloc object is given as an input argument to every Node of the AST classes. This will be usefull when detecting errors after the Lexing & Parsing. 
 We will use the Sloc class to displat the error messages. 
+Line and column of a position are found by bisection in the newline index of the Source, so rendering a message (with
+a snippet of the offending line) costs O(log n) whatever the number of errors in the file.
 """
 # ================================================================================
 class Source:
     def __init__(self, provenance: str, data: str):
         self.provenance = provenance
         self.data = data
-    
+        self.newlines = None
+
+    @staticmethod
+    def read(fn: str, stream=False):
+        """
+        Contents of the file fn: a string, or in streaming mode a read-only memory map of the file (never copied in memory).
+        """
+        if not stream:
+            with open(fn, 'r') as fp:
+                return fp.read()
+        with open(fn, 'rb') as fp:
+            try:
+                return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files cannot be mapped
+                return b''
+
+    def new_index(self):
+        return array('I' if len(self.data) < 2**32 else 'Q')
+
+    def line_offsets(self):
+        """
+        Offsets of the newline characters of the source, computed once (unless the lexer already filled them in).
+        """
+        if self.newlines is None:
+            newline = '\n' if isinstance(self.data, str) else b'\n'
+            self.newlines = self.new_index()
+            pos = self.data.find(newline)
+            while pos >= 0:
+                self.newlines.append(pos)
+                pos = self.data.find(newline, pos + 1)
+        return self.newlines
+
+    def line(self, lineno: int):
+        """
+        Offset of the first character and text of line lineno (starting at 1).
+        """
+        newlines = self.line_offsets()
+        lineno = max(1, min(lineno, len(newlines) + 1))
+        start = newlines[lineno - 2] + 1 if lineno > 1 else 0
+        if lineno <= len(newlines):
+            end = newlines[lineno - 1]
+        else:
+            # last line, or the line being scanned when the lexer is still building the index
+            end = self.data.find('\n' if isinstance(self.data, str) else b'\n', start)
+            end = len(self.data) if end < 0 else end
+        text = self.data[start:end]
+        if not isinstance(text, str):
+            text = text.decode('utf-8', errors='replace')
+        return start, text
+
+    def locate(self, lexpos: int):
+        """
+        Line and column (both starting at 1) of the character at offset lexpos.
+        """
+        newlines = self.line_offsets()
+        i = bisect.bisect_left(newlines, lexpos)
+        return i + 1, lexpos - (newlines[i - 1] if i > 0 else -1)
+
+    def snippet(self, lexpos: int):
+        """
+        The line containing lexpos, with a caret under lexpos.
+        """
+        lineno, colno = self.locate(lexpos)
+        _, text = self.line(lineno)
+        # keep the tabs so that the caret is aligned
+        margin = ''.join(c if c == '\t' else ' ' for c in text[:colno - 1])
+        return f'{text}\n{margin}^'
+
+
 class Sloc:
     severity_map = ('Debug ', 'Info ', 'Warning ', "ERROR ")
 
@@ -34,6 +116,22 @@ class Sloc:
         self.source = source 
         self.lineno = lineno
         self.lexpos = lexpos
+
+    def position(self):
+        """
+        Line and column of the location.
+        """
+        if self.source is None:
+            return self.lineno, 0
+        return self.source.locate(self.lexpos)
+
+    def snippet(self):
+        return self.source.snippet(self.lexpos) if self.source is not None else ''
+
+    def __str__(self):
+        lineno, colno = self.position()
+        provenance = self.source.provenance if self.source is not None else '<unknown>'
+        return f'{provenance}:{lineno}:{colno}'
     
     def print_error_message(self, msg: str, severity=1, err=None):
         """
@@ -41,14 +139,47 @@ class Sloc:
         """
         err_msg = ''
         if self.source is not None:
-            eol = self.source.data.rfind('\n', 0, self.lexpos)
-            colno = self.lexpos - eol
-            err_msg = f'\n{self.source.data}\nLine:{self.lineno}.Column:{colno}:\n'
+            lineno, colno = self.position()
+            err_msg = f'\n{self.snippet()}\nLine:{lineno}.Column:{colno}:\n'
         severity = max(0, min(4, severity))
         err_msg += Sloc.severity_map[severity] + msg
         print(err_msg)
         if err: err
 
+    def error(self, msg: str, diag=None):
+        """
+        Lexing or parsing error: recorded in diag (a Diagnostics) when the errors of the file are collected,
+        printed right away otherwise.
+        """
+        if diag is None:
+            self.print_error_message(msg, 3, err=SyntaxError)
+        else:
+            diag.error(self, msg)
+
+class TooManyErrors(Exception):
+    pass
+
+class Diagnostics:
+    """
+    Sink threaded through AST.Program.type_check: the errors are recorded (with their Sloc) instead of stopping the
+    checker at the first one, so that one pass reports all the errors of a file. Recording more than max_errors
+    errors raises TooManyErrors.
+    """
+    def __init__(self, max_errors=None):
+        self.max_errors = max_errors
+        self.errors = []
+
+    def error(self, sloc: Sloc, msg: str):
+        self.errors.append((sloc, msg))
+        if self.max_errors is not None and len(self.errors) >= self.max_errors:
+            raise TooManyErrors(f'Stopping after {len(self.errors)} errors')
+
+    def report(self):
+        for sloc, msg in self.errors:
+            sloc.print_error_message(msg, 3)
+        capped = self.max_errors is not None and len(self.errors) >= self.max_errors
+        print(f'{len(self.errors)} error(s){" (limit reached)" if capped else ""}')
+
 # ================================================================================
 """
 Part B of the file: Lexer
@@ -58,15 +189,38 @@ our own Lexer class. This is easier in order to manage the different parts of th
 # ================================================================================
 
 class Lexer:
+    # Lexer shared by the whole process, see Lexer.shared
+    instance = None
+
     def __init__(self, provenance: str, data: str):
         """
         Initialisation of the lexer object (from ply library).
         """
+        self.lexer = lex.lex(module=self)
+        self.reset(provenance, data)
+
+    def reset(self, provenance: str, data: str):
+        """
+        Rebind the lexer to a new source without recompiling the master regex. 
+        """
         self.source = Source(provenance, data)
         self.data = data 
-        self.lexer = lex.lex(module=self)
         self.lexer.input(self.data)
+        self.lexer.lineno = 1
         self.iseof = False 
+        # Diagnostics collecting the lexing and parsing errors (see Reader.read_checked), None to print them
+        self.diag = None
+
+    @classmethod
+    def shared(cls, provenance: str, data: str):
+        """
+        Process-wide lexer, built on first use and reset for every following source.
+        """
+        if cls.instance is None:
+            cls.instance = cls(provenance, data)
+        else:
+            cls.instance.reset(provenance, data)
+        return cls.instance
 
     # =============== PLY used variables ==================
 
@@ -143,7 +297,7 @@ class Lexer:
         t.value = int(t.value)
         if not (-9223372036854775808 <= t.value < 9223372036854775808):
             msg = f'Number value {t.value} out supported range [-2^63, 2^63)'
-            Sloc(self.source, t.lineno, t.lexpos).print_error_message(msg, 3, err=SyntaxError)
+            Sloc(self.source, t.lineno, t.lexpos).error(msg, self.diag)
         return t
     
     def t_eof(self, t):
@@ -156,7 +310,7 @@ class Lexer:
         if not t:
             return 
         msg = f"Illegal character ’{t.value[0]}’"
-        Sloc(self.source, t.lineno, t.lexpos).print_error_message(msg, 3, err=SyntaxError)
+        Sloc(self.source, t.lineno, t.lexpos).error(msg, self.diag)
         t.lexer.skip(1)
 
     def t_newline(self, t):
@@ -188,6 +342,140 @@ class Lexer:
 
 # ================================================================================
 
+"""
+Part B bis of the file: FastLexer
+A drop-in replacement of the PLY lexer (bxcc.py --lexer=fast). Instead of going through PLY's callbacks for every
+token, a single master regex whose alternatives cover every possible character is run once over the data, and the
+token type is read from the group that matched. It produces exactly the same tokens (type, value, lineno, lexpos)
+and error messages as the Lexer above, so the Parser is used unchanged.
+"""
+# ================================================================================
+
+class FastLexer:
+    # Lexer shared by the whole process, see FastLexer.shared
+    instance = None
+
+    # Operators and punctuation, the two characters ones first so that matching is maximal munch (as in PLY)
+    operators = {
+        '||': 'OR', '&&': 'AND', '<<': 'BIT_LSHIFT', '>>': 'BIT_RSHIFT', 
+        '==': 'EQ', '!=': 'NEQ', '<=': 'LTEQ', '>=': 'GTEQ',
+        '+': 'PLUS', '-': 'MINUS', '*': 'TIMES', '/': 'DIVIDE', '%': 'MODULUS', 
+        '|': 'BIT_OR', '&': 'BIT_AND', '^': 'BIT_XOR', '~': 'BIT_NEGATION', 
+        '<': 'LT', '>': 'GT', '!': 'NOT', 
+        '(': 'LPAREN', ')': 'RPAREN', '{': 'LBRACKET', '}': 'RBRACKET', 
+        ';': 'SEMICOLON', ':': 'COLON', ',': 'COMMA', '=': 'ASSIGN',
+    }
+
+    # Same rules as the PLY lexer, each match is one token (or newline, comment, illegal character) preceded by the
+    # ignored characters; the last alternative catches illegal characters so that no character is ever skipped
+    rules = [
+        r'(?P<ident>[A-Za-z_][A-Za-z0-9_]*)',
+        r'(?P<number>0|[1-9][0-9]*)',
+        r'(?P<newline>\n+)',
+        r'(?P<comment>//[^\n]*\n?)',
+        '(?P<op>' + '|'.join(re.escape(op) for op in operators) + ')',
+    ]
+    master = re.compile(r'[ \t\f\v]*(?:' + '|'.join(rules + [r'(?P<error>[\s\S])']) + ')')
+    # Same on bytes for memory mapped sources, an illegal character is a whole UTF-8 sequence
+    master_bytes = re.compile((r'[ \t\f\v]*(?:' + '|'.join(rules + [r'(?P<error>[\xc0-\xff][\x80-\xbf]*|[\s\S])']) + ')').encode())
+    # Index of the groups above, m.lastindex is cheaper than m.lastgroup
+    IDENT, NUMBER, NEWLINE, COMMENT, OP = 1, 2, 3, 4, 5
+    # Memory mapped sources: the pages already scanned are handed back to the OS every window bytes
+    window = 16 * 1024 * 1024
+
+    def __init__(self, provenance: str, data: str):
+        # The PLY parser pulls its tokens from self.lexer.token()
+        self.lexer = self
+        self.reset(provenance, data)
+
+    def reset(self, provenance: str, data: str):
+        self.source = Source(provenance, data)
+        self.data = data 
+        self.lineno = 1
+        self.lexpos = 0
+        self.iseof = False 
+        self.diag = None
+        self.stream = self.scan()
+
+    @classmethod
+    def shared(cls, provenance: str, data: str):
+        if cls.instance is None:
+            cls.instance = cls(provenance, data)
+        else:
+            cls.instance.reset(provenance, data)
+        return cls.instance
+
+    def token(self):
+        return next(self.stream, None)
+
+    def scan(self):
+        """
+        Generator of the tokens of the source, followed by the EOF token.
+        """
+        reserved = Lexer.reserved
+        operators = FastLexer.operators
+        IDENT, NUMBER, NEWLINE, COMMENT, OP = FastLexer.IDENT, FastLexer.NUMBER, FastLexer.NEWLINE, FastLexer.COMMENT, FastLexer.OP
+        LexToken = lex.LexToken
+        data = self.data
+        text = isinstance(data, str)
+        release = None if text else getattr(data, 'madvise', None)
+        released = 0
+        # the newline index of the source is built on the way, error messages never scan the source again
+        newlines = self.source.newlines = self.source.new_index()
+        lineno = 1
+        for m in (FastLexer.master if text else FastLexer.master_bytes).finditer(data):
+            kind = m.lastindex
+            if kind == NEWLINE:
+                newlines.extend(range(m.start(kind), m.end()))
+                lineno += m.end() - m.start(kind)
+                if release is not None and m.start() - released >= FastLexer.window:
+                    pos = m.start() - m.start() % mmap.PAGESIZE
+                    release(mmap.MADV_DONTNEED, released, pos - released)
+                    released = pos
+                continue
+            if kind == COMMENT:
+                if data[m.end() - 1] in (10, '\n'):
+                    newlines.append(m.end() - 1)
+                lineno += 1
+                continue
+            value = m.group(kind)
+            if not text:
+                value = value.decode('utf-8', errors='replace')
+            t = LexToken()
+            t.value = value
+            t.lineno = lineno
+            t.lexpos = m.start(kind)
+            if kind == IDENT:
+                t.type = reserved.get(value, 'IDENT')
+            elif kind == OP:
+                t.type = operators[value]
+            elif kind == NUMBER:
+                t.type = 'NUMBER'
+                t.value = int(value)
+                if not (-9223372036854775808 <= t.value < 9223372036854775808):
+                    msg = f'Number value {t.value} out supported range [-2^63, 2^63)'
+                    Sloc(self.source, lineno, t.lexpos).error(msg, self.diag)
+            else:
+                msg = f"Illegal character ’{value}’"
+                Sloc(self.source, lineno, t.lexpos).error(msg, self.diag)
+                continue
+            self.lineno = lineno
+            self.lexpos = m.end()
+            yield t
+
+        t = LexToken()
+        t.type = 'EOF'
+        t.value = ''
+        t.lineno = self.lineno = lineno
+        t.lexpos = self.lexpos = len(self.data)
+        self.iseof = True
+        yield t
+
+# Lexer engines selectable for the shared Parser
+lexers = {'ply': Lexer, 'fast': FastLexer}
+
+# ================================================================================
+
 """
 Part C of the file: Parser
 Similar to the Lexer, we encapsulate the PLY parser in our own Parser class
@@ -195,9 +483,129 @@ in order to better manage which part of the program is acting on what input.
 """
 
 class Parser: 
+    # Directory where the LALR tables are persisted (next to the package by default, None to disable)
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__')
+    # Tables already loaded in this process, keyed by grammar signature
+    tables = {}
+    # Bumped whenever the layout of the persisted tables changes
+    table_format = 1
+
+    # Parser shared by the whole process, see Parser.shared
+    instance = None
+    # Lexer engine used by the shared parser, one of the classes of lexers
+    lexer_class = Lexer
+
     def __init__(self, lexer: Lexer):
         self.lexer = lexer
-        self.parser = yacc.yacc(module=self, start='program')
+        self.parser = self.build()
+
+    def reset(self, provenance: str, data: str):
+        """
+        Prepare the parser to read a new source, the grammar tables and the lexer are kept. 
+        """
+        self.lexer.reset(provenance, data)
+
+    @classmethod
+    def shared(cls, provenance: str, data: str):
+        """
+        Process-wide parser (on top of the shared lexer), built on first use and reset for every following source.
+        Only one source can be read at a time through it. Memory mapped sources can only be read by the FastLexer.
+        """
+        lexer_class = cls.lexer_class if isinstance(data, str) else FastLexer
+        if cls.instance is None or type(cls.instance.lexer) is not lexer_class:
+            cls.instance = cls(lexer_class.shared(provenance, data))
+        else:
+            cls.instance.reset(provenance, data)
+        return cls.instance
+
+    # =========== LALR table cache ======================
+
+    @classmethod
+    def signature(cls):
+        """
+        Hash of everything the LALR tables depend on: start symbol, precedence, tokens and the grammar rules (in definition order).
+        """
+        rules = [(name, func.__doc__) for name, func in vars(cls).items()
+                 if name.startswith('p_') and name != 'p_error']
+        parts = [Parser.table_format, ply.__version__, 'program', cls.precedence, cls.tokens, rules]
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    @classmethod
+    def table_path(cls, signature: str):
+        return os.path.join(cls.cache_dir, f'parsetab_{signature[:16]}.json')
+
+    @classmethod
+    def load_tables(cls, signature: str):
+        """
+        Read the persisted tables for this signature, returns None if they are missing, unreadable or stale.
+        """
+        if cls.cache_dir is None:
+            return None
+        try:
+            with open(cls.table_path(signature), 'r') as fp:
+                data = json.load(fp)
+            if data['signature'] != signature:
+                return None
+            # JSON only has string keys, states are ints
+            action = {int(state): acts for state, acts in data['action'].items()}
+            goto = {int(state): gotos for state, gotos in data['goto'].items()}
+            productions = [(name, syms, func) for name, syms, func in data['productions']]
+            for _, _, func in productions:
+                if func is not None and not hasattr(cls, func):
+                    return None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return action, goto, productions
+
+    @classmethod
+    def store_tables(cls, signature: str, tables):
+        """
+        Atomically write the tables to the cache directory and remove the ones left by older grammars.
+        Failing to write is not an error, the tables are simply rebuilt by the next process.
+        """
+        if cls.cache_dir is None:
+            return
+        action, goto, productions = tables
+        data = {'signature': signature, 'action': action, 'goto': goto, 'productions': productions}
+        path = cls.table_path(signature)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(cls.cache_dir, exist_ok=True)
+            with open(tmp, 'w') as fp:
+                json.dump(data, fp)
+            os.replace(tmp, path)
+            for fn in os.listdir(cls.cache_dir):
+                if fn.startswith('parsetab_') and fn.endswith('.json') and fn != os.path.basename(path):
+                    os.remove(os.path.join(cls.cache_dir, fn))
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def build(self):
+        """
+        Create the PLY parser. The tables are generated at most once per grammar: they are looked up in the process
+        cache, then on disk, and only generated by yacc when both miss.
+        """
+        signature = Parser.signature()
+        tables = Parser.tables.get(signature)
+        if tables is None:
+            tables = Parser.load_tables(signature)
+            if tables is None:
+                parser = yacc.yacc(module=self, start='program')
+                tables = (parser.action, parser.goto,
+                          [(p.name, list(p.prod), p.func) for p in parser.productions])
+                Parser.store_tables(signature, tables)
+                Parser.tables[signature] = tables
+                return parser
+            Parser.tables[signature] = tables
+
+        action, goto, productions = tables
+        lrtab = types.SimpleNamespace(lr_action=action, lr_goto=goto, lr_productions=[])
+        for number, (name, syms, func) in enumerate(productions):
+            prod = yacc.Production(number, name, syms, func=func)
+            prod.bind({func: getattr(self, func)} if func else {})
+            lrtab.lr_productions.append(prod)
+        return yacc.LRParser(lrtab, self.p_error)
 
     def sloc(self, p, n: int):
         """
@@ -281,7 +689,7 @@ class Parser:
                 | expr AND expr 
                 | expr OR expr
         """
-        p[0] = ast.ExpressionBinOp(self.sloc(p, 1), p[2], p[1], p[3])
+        p[0] = ast.ExpressionBinOp(self.sloc(p, 2), p[2], p[1], p[3])
 
 
     def p_expr_parens(self, p):
@@ -326,7 +734,7 @@ class Parser:
     def p_block(self, p):
         #  p[0]     p[1]    p[2]  p[3]
         """block : LBRACKET stmts RBRACKET"""
-        p[0] = ast.Block(self.sloc(p, 1), p[2])
+        p[0] = ast.Block(self.sloc(p, 1), p[2], p.lexpos(3) + 1)
 
     def p_stmt_assign(self, p):
         #  p[0]     p[1] p[2] p[3] p[4]
@@ -386,7 +794,7 @@ class Parser:
 
     def p_stmt_eval(self, p):
         """stmt : expr SEMICOLON"""
-        p[0] = ast.Eval(self.sloc(p, 1), p[1])
+        p[0] = ast.Eval(p[1].sloc, p[1])
 
 
 
@@ -524,7 +932,7 @@ class Parser:
         if not p:
             return 
         msg = f'Syntax error while parsing {p.type}'
-        Sloc(self.lexer.source, p.lineno, p.lexpos).print_error_message(msg, 3, err=SyntaxError)
+        Sloc(self.lexer.source, p.lineno, p.lexpos).error(msg, self.lexer.diag)
 
     # def error_message(self, lineno, lexpos, msg):
     #     token = lex.LexToken()
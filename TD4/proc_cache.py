@@ -0,0 +1,216 @@
+"""
+Incremental compilation: a cache of the compiled procedures of BX programs.
+A procedure is keyed on the hash of its source text, of the signatures of the globals and procedures it refers to
+and of the compiler itself, so editing one procedure of a file only recompiles that procedure.
+Every entry holds the optimized TAC and the assembly of one procedure; the entries live in a directory whose size
+is bounded, the least recently used entries being evicted first.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from collections import Counter
+
+import AST
+import bx2front
+import bx2tac
+import dataflow
+import regalloc
+import ssa
+import ssa_opt
+import tac2x64
+import tac_cfopt
+import tac_inline
+
+# Modules whose code determines the TAC and assembly produced for a procedure
+compiler_modules = [AST, bx2tac, tac_inline, tac_cfopt, ssa, ssa_opt, dataflow, regalloc, tac2x64]
+
+# ================================================================================
+
+def compiler_fingerprint():
+    h = hashlib.sha256()
+    for module in compiler_modules:
+        with open(module.__file__, 'rb') as fp:
+            h.update(fp.read())
+    return h.hexdigest()
+
+
+def referenced_names(node, names=None):
+    """
+    Names of the variables and procedures used anywhere below an AST node.
+    """
+    if names is None:
+        names = set()
+    if isinstance(node, list):
+        for child in node:
+            referenced_names(child, names)
+    elif isinstance(node, AST.Node):
+        if isinstance(node, (AST.ExpressionVar, AST.Call)):
+            names.add(node.name)
+        for child in vars(node).values():
+            if isinstance(child, (list, AST.Node)):
+                referenced_names(child, names)
+    return names
+
+
+class ProcCache:
+    """
+    On-disk store of compiled procedures, one json file per entry, of at most max_bytes.
+    An entry is touched every time it is used, its modification time orders the LRU eviction.
+    """
+    def __init__(self, cache_dir, max_bytes=64 * 1024 * 1024, options=()):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.salt = json.dumps([compiler_fingerprint(), list(options)])
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, proc, gvar_types, proc_sigs):
+        """
+        Key of a type checked ProcDecl, given the types of the global variables and the signatures of the procedures
+        of its program. Local names shadowing a global are conservatively counted as uses of the global.
+        """
+        deps = []
+        for name in sorted(referenced_names(proc.block)):
+            if name in gvar_types:
+                deps.append(['var', name, gvar_types[name]])
+            elif name in proc_sigs:
+                deps.append(['proc', name, proc_sigs[name]])
+        text = json.dumps([self.salt, proc.source_text(), proc.signature, deps])
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'r') as fp:
+                entry = json.load(fp)
+            os.utime(self.path(key))
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, tac, asm):
+        # Written to a temporary file then renamed, so that concurrent compilations never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({'tac': tac, 'asm': asm}, fp)
+        os.replace(tmp, self.path(key))
+
+    def entries(self):
+        # (mtime, size, path) of every entry, oldest first
+        entries = []
+        for fn in os.listdir(self.cache_dir):
+            if fn.endswith('.json'):
+                path = os.path.join(self.cache_dir, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        # Remove the least recently used entries until the cache fits in max_bytes
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            self.evictions += 1
+
+    def report(self):
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        lookups = self.hits + self.misses
+        rate = 100 * self.hits / lookups if lookups else 0
+        print(f'cache {self.cache_dir}: {self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate), '
+              f'{self.evictions} evictions')
+        print(f'cache {self.cache_dir}: {len(entries)} entries, {size / 1024:.1f} KB of {self.max_bytes / 1024:.0f} KB')
+
+# ================================================================================
+
+def inlining_keys(procs, keys):
+    """
+    Keys of the ProcDecls procs (given their own keys, by name) also covering the procedures they call directly or
+    not, whose bodies may be inlined into them.
+    """
+    callees = {proc.name: referenced_names(proc.block) & keys.keys() for proc in procs}
+    combined = {}
+    for proc in procs:
+        reached, work = set(), [proc.name]
+        while work:
+            for callee in callees[work.pop()]:
+                if callee not in reached:
+                    reached.add(callee)
+                    work.append(callee)
+        text = json.dumps([keys[proc.name]] + sorted(keys[name] for name in reached))
+        combined[proc.name] = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return combined
+
+
+def profiled_key(key, counts):
+    # key of a procedure whose blocks are laid out from the edge counts counts ((source, target) -> count)
+    text = json.dumps([key, sorted([source, target, n] for (source, target), n in counts.items())])
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def compile_bx(fn, cache, optimize=True, allocator=None, stream=False, max_errors=None, dump_ssa=False, passes=None,
+               inline_budget=0, profile=None, count_branches=False):
+    """
+    Assembly of a BX program; procedures found in the cache are not compiled again (nor their SSA form dumped).
+    When inlining (inline_budget, see tac_inline), the TAC of the whole program is inlined at the first procedure
+    missing from the cache. profile gives the edge counts of the block layout (see tac_cfopt.read_profile) and
+    count_branches instruments the branches (see tac2x64.tac_to_asm); the cache options must tell the latter apart.
+    Returns the assembly lines and the TAC program (as written in .optimized_tac.json files).
+    """
+    # the keys hash the source text of the procedures, the source is released once they are computed
+    with bx2front.Reader.from_file(fn, stream) as reader:
+        ast = reader.read_checked(max_errors)
+        gvars = bx2tac.program_gvars(ast)
+        gvar_names = [gvar.var for gvar in gvars]
+        gvar_types = {decl.var.name: str(decl.type) for decl in ast.global_vars}
+        proc_sigs = {proc.name: proc.signature for proc in ast.procs}
+        keys = {proc.name: cache.key(proc, gvar_types, proc_sigs) for proc in ast.procs}
+
+    inline_budget = inline_budget if optimize else 0
+    if inline_budget:
+        keys = inlining_keys(ast.procs, keys)
+    if optimize and profile is not None:
+        keys = {name: profiled_key(key, profile.get('@' + name, {})) for name, key in keys.items()}
+
+    asm = tac2x64.gvars_to_asm(gvars)
+    procs = []
+    inlined = None
+    for proc in ast.procs:
+        key = keys[proc.name]
+        entry = cache.get(key)
+        if entry is None:
+            if inline_budget:
+                if inlined is None:
+                    units = [bx2tac.ProcUnit(decl, gvars) for decl in ast.procs]
+                    program = [bx2tac.Procedure(unit.name, unit.args, unit.body) for unit in units]
+                    inlined = {tac.name: tac for tac in tac_inline.inline_program(program, inline_budget)}
+                tac = inlined['@' + proc.name]
+            else:
+                unit = bx2tac.ProcUnit(proc, gvars)
+                tac = bx2tac.Procedure(unit.name, unit.args, unit.body)
+            if optimize:
+                tac = tac_cfopt.optimize_proc(tac, dump_ssa, passes,
+                                              profile=None if profile is None else profile.get(tac.name, Counter()))
+            entry = {'tac': tac.js_obj, 'asm': tac2x64.proc_to_asm(tac, gvar_names, allocator, count_branches)}
+            cache.put(key, entry['tac'], entry['asm'])
+        procs.append(entry['tac'])
+        asm.extend(entry['asm'])
+    cache.evict()
+    return asm, [gvar.js_obj for gvar in gvars] + procs
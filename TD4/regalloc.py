@@ -0,0 +1,220 @@
+"""
+Register allocation of the temporaries of a TAC procedure, between the control flow optimization (tac_cfopt) and
+the instruction selection (tac2x64).
+An allocator maps a bx2tac.Procedure to a dict {temporary: register}; the temporaries it leaves out live in stack
+slots as before. %rax, %rdx, %rcx and %r11 are scratch registers of the instruction selection and the first six
+parameters are passed in %rdi, %rsi, %rdx, %rcx, %r8, %r9, so none of them is ever allocated.
+"""
+import bisect
+
+from dataflow import is_temp, uses_defs, liveness, interference_graph
+
+# Allocatable registers, callee-saved first: tac2x64 saves the ones a procedure uses in its prologue
+callee_saved = ['%rbx', '%r12', '%r13', '%r14', '%r15']
+# ... and caller-saved: tac2x64 saves them around the calls they are live across
+caller_saved = ['%r10']
+
+# ================================================================================
+
+def live_intervals(proc):
+    """
+    Live interval [start, end] (instruction indices) of every temporary of a procedure. The parameters passed in
+    registers are defined at the entry (index -1); the ones passed on the stack are never allocated.
+    """
+    intervals = {}
+
+    def extend(temp, i):
+        start, end = intervals.get(temp, (i, i))
+        intervals[temp] = (min(start, i), max(end, i))
+
+    for arg in proc.args[:6]:
+        extend(arg, -1)
+    for i, (instr, out) in enumerate(zip(proc.body, liveness(proc.body))):
+        uses, defs = uses_defs(instr)
+        for temp in uses + defs:
+            extend(temp, i)
+        for temp in out:
+            extend(temp, i)
+    for arg in proc.args[6:]:
+        intervals.pop(arg, None)
+    return intervals
+
+
+def call_sites(proc):
+    return [i for i, instr in enumerate(proc.body) if instr.opcode == 'call']
+
+
+def crosses_call(interval, calls):
+    # calls is sorted: is there a call strictly inside the interval?
+    start, end = interval
+    k = bisect.bisect_right(calls, start)
+    return k < len(calls) and calls[k] < end
+
+
+def caller_saves(proc, alloc):
+    """
+    Caller-saved registers to save around each call of a procedure: those of the temporaries live across it.
+    """
+    saves = {}
+    if not any(reg in caller_saved for reg in alloc.values()):
+        return saves
+    live_out = liveness(proc.body)
+    for i, instr in enumerate(proc.body):
+        if instr.opcode == 'call':
+            live = live_out[i] - set(uses_defs(instr)[1])
+            regs = sorted({alloc[temp] for temp in live if alloc.get(temp) in caller_saved})
+            if regs:
+                saves[i] = regs
+    return saves
+
+# ================================================================================
+
+def linear_scan(proc, registers=callee_saved + caller_saved):
+    """
+    Linear scan allocation (Poletto and Sarkar): intervals are visited by increasing start and get a free register,
+    callee-saved ones for the intervals live across a call. When none is left, the interval ending last (the
+    current one or an active one) is spilled to the stack.
+    """
+    intervals = live_intervals(proc)
+    calls = call_sites(proc)
+    alloc = {}
+    free = list(registers)
+    active = []     # (end, temp), sorted
+    for temp, interval in sorted(intervals.items(), key=lambda item: (item[1][0], item[0])):
+        start, end = interval
+        # expire the intervals that ended before this one starts
+        while active and active[0][0] < start:
+            free.append(alloc[active.pop(0)[1]])
+
+        if free:
+            across = crosses_call(interval, calls)
+            preferred = [reg for reg in registers if reg in free and (reg in callee_saved) == across]
+            reg = preferred[0] if preferred else next(reg for reg in registers if reg in free)
+            free.remove(reg)
+            alloc[temp] = reg
+            bisect.insort(active, (end, temp))
+        elif active[-1][0] > end:
+            # the active interval ending last gives its register to this one and goes to the stack
+            _, spilled = active.pop()
+            alloc[temp] = alloc.pop(spilled)
+            bisect.insort(active, (end, temp))
+    return alloc
+
+
+def live_across_calls(proc):
+    live_out = liveness(proc.body)
+    across = set()
+    for instr, out in zip(proc.body, live_out):
+        if instr.opcode == 'call':
+            across |= out - set(uses_defs(instr)[1])
+    return across
+
+
+def graph_coloring(proc, registers=callee_saved + caller_saved):
+    """
+    Chaitin/Briggs allocation: the interference graph is coalesced along the copies (Briggs' conservative test,
+    the copies between temporaries of the same register disappear from the assembly), simplified, then colored
+    optimistically with the registers. The temporaries left without a color stay on the stack, those with the
+    lowest number of uses per neighbour being the first candidates.
+    """
+    graph, moves = interference_graph(proc)
+    k = len(registers)
+
+    # Coalescing
+    alias = {}
+
+    def find(temp):
+        while temp in alias:
+            temp = alias[temp]
+        return temp
+
+    changed = True
+    while changed:
+        changed = False
+        for d, s in moves:
+            a, b = find(d), find(s)
+            if a == b or b in graph[a]:
+                continue
+            significant = sum(1 for n in graph[a] | graph[b] if len(graph[n]) >= k)
+            if significant < k:
+                for n in graph.pop(b):
+                    graph[n].discard(b)
+                    if n != a:
+                        graph[n].add(a)
+                        graph[a].add(n)
+                alias[b] = a
+                changed = True
+
+    # Spill costs: number of occurrences of the temporaries merged in each node
+    cost = dict.fromkeys(graph, 0)
+    for instr in proc.body:
+        uses, defs = uses_defs(instr)
+        for temp in uses + defs:
+            if find(temp) in cost:
+                cost[find(temp)] += 1
+
+    # Simplification
+    degree = {n: len(adj) for n, adj in graph.items()}
+    low = [n for n in sorted(graph) if degree[n] < k]
+    removed = set()
+    stack = []
+    while len(stack) < len(graph):
+        if low:
+            n = low.pop()
+            if n in removed:
+                continue
+        else:
+            n = min((n for n in graph if n not in removed), key=lambda n: (cost[n] / (degree[n] or 1), n))
+        removed.add(n)
+        stack.append(n)
+        for m in graph[n]:
+            if m not in removed:
+                degree[m] -= 1
+                if degree[m] == k - 1:
+                    low.append(m)
+
+    # Selection: callee-saved registers for the temporaries live across a call, caller-saved ones for the others
+    across = {find(temp) for temp in live_across_calls(proc)}
+    colors = {}
+    for n in reversed(stack):
+        taken = {colors[m] for m in graph[n] if m in colors}
+        free = [reg for reg in registers if reg not in taken]
+        if free:
+            preferred = [reg for reg in free if (reg in callee_saved) == (n in across)]
+            colors[n] = (preferred or free)[0]
+
+    temps = set(graph) | set(alias)
+    return {temp: colors[find(temp)] for temp in temps if find(temp) in colors}
+
+
+def report(proc, alloc):
+    """
+    Code quality of an allocation: temporaries, spilled temporaries, copies and copies eliminated (between
+    temporaries sharing a register).
+    """
+    graph, moves = interference_graph(proc)
+    eliminated = sum(1 for d, s in moves if d in alloc and alloc.get(s) == alloc[d])
+    return {'temps': len(graph), 'spills': len(graph) - len(alloc), 'moves': len(moves), 'eliminated': eliminated}
+
+
+def print_report(proc, alloc):
+    stats = report(proc, alloc)
+    print(f"{proc.name:<24} {stats['temps']:6} temps {stats['spills']:6} spills "
+          f"{stats['eliminated']:6} of {stats['moves']} moves eliminated")
+
+
+def reporting(allocator):
+    # allocator printing the report of every procedure it allocates
+    def allocate(proc):
+        alloc = allocator(proc)
+        print_report(proc, alloc)
+        return alloc
+    return allocate
+
+
+# Register allocator of each optimization level (-O); None keeps every temporary on the stack
+allocators = {
+    0: None,
+    1: linear_scan,
+    2: graph_coloring,
+}
@@ -0,0 +1,504 @@
+"""
+Static single assignment (SSA) form of TAC procedures, for the optimizations run before the control flow
+optimization (tac_cfopt.optimize_proc), which removes the branches they find dead.
+to_ssa renames the temporaries so that each one is written by a single instruction, with phi instructions where
+values merge: on the iterated dominance frontiers of the writes (dominators by the algorithm of Cooper, Harvey and
+Kennedy), and only where the temporary is live (pruned SSA). from_ssa replaces the phis by parallel copies at the
+end of the predecessors, splitting the critical edges. LoopForest finds the natural loops, and insert_preheaders
+gives each one a block entered from outside the loop, for the loop optimizations.
+
+A phi is the instruction {opcode: 'phi', args: [label1, temp1, label2, temp2, ...], result}: its value is temp_i
+when the block is entered from the block starting with label_i. In SSA form every block starts with a label and
+the entry block has no predecessor. Version k of a temporary %t is named %t.k; the value of %t at the entry of the
+procedure (a parameter, or undefined) keeps the name %t.
+"""
+import time
+from collections import Counter
+
+import dataflow
+from bx2tac import Instruction, Procedure
+from dataflow import FlowGraph, is_temp, use_positions
+
+# Seconds spent in each pass (by function name) since the start, or the last timings.clear()
+timings = Counter()
+
+# ================================================================================
+
+class DominatorTree:
+    """
+    Immediate dominators (idom[b], None for the entry and the unreachable blocks), dominator tree (children[b])
+    and dominance frontiers (frontier[b], a set) of the blocks of a flow graph.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        n = len(graph.blocks)
+        order = graph.reverse_postorder()
+        rank = [None] * n
+        for r, b in enumerate(order):
+            rank[b] = r
+        idom = [None] * n
+        if order:
+            idom[0] = 0
+
+        def intersect(a, b):
+            while a != b:
+                while rank[a] > rank[b]:
+                    a = idom[a]
+                while rank[b] > rank[a]:
+                    b = idom[b]
+            return a
+
+        changed = True
+        while changed:
+            changed = False
+            for b in order[1:]:
+                new = None
+                for p in graph.preds[b]:
+                    if idom[p] is not None:
+                        new = p if new is None else intersect(p, new)
+                if idom[b] != new:
+                    idom[b] = new
+                    changed = True
+
+        self.frontier = [set() for _ in range(n)]
+        for b in order:
+            preds = [p for p in graph.preds[b] if rank[p] is not None]
+            if len(preds) > 1 or (b == 0 and preds):
+                # the entry is also entered from outside: a jump to it joins two paths, up to the entry included
+                for p in preds:
+                    runner = p
+                    while runner is not None and runner != idom[b]:
+                        self.frontier[runner].add(b)
+                        runner = idom[runner] if runner != 0 else None
+                if b == 0:
+                    self.frontier[0].add(0)
+
+        self.children = [[] for _ in range(n)]
+        for b in order[1:]:
+            self.children[idom[b]].append(b)
+        if order:
+            idom[0] = None
+        self.idom = idom
+
+        # preorder and postorder numbers in the tree: a dominates b when b is numbered inside a
+        self.pre, self.post = [None] * n, [None] * n
+        self.preorder = []
+        counter = 0
+        stack = [(0, False)] if order else []
+        while stack:
+            b, done = stack.pop()
+            if done:
+                self.post[b] = counter
+            else:
+                self.pre[b] = counter
+                self.preorder.append(b)
+                stack.append((b, True))
+                stack.extend((c, False) for c in reversed(self.children[b]))
+            counter += 1
+
+    def dominates(self, a, b):
+        pre, post = self.pre, self.post
+        return pre[a] is not None and pre[b] is not None and pre[a] <= pre[b] and post[b] <= post[a]
+
+
+class LoopForest:
+    """
+    Natural loops of a flow graph: an edge to a block dominating its source (a back edge) closes the loop of that
+    header, made of the blocks reaching the source without going through the header; the loops of a header are
+    merged. body[h] is the set of blocks of the loop of header h, parent[h] the header of the loop just around it
+    (or None), innermost[b] the header of the innermost loop containing block b, and headers lists the headers
+    from the inner loops outwards.
+    """
+    def __init__(self, graph, dom):
+        self.body = {}
+        for b, succs in enumerate(graph.succs):
+            for h in succs:
+                if dom.dominates(h, b):
+                    blocks = self.body.setdefault(h, {h})
+                    work = [b]
+                    while work:
+                        x = work.pop()
+                        if x not in blocks:
+                            blocks.add(x)
+                            work.extend(graph.preds[x])
+        # natural loops are disjoint or nested: going from the outer loops inwards, the last loop seen containing a
+        # block is its innermost one
+        self.headers = sorted(self.body, key=lambda h: len(self.body[h]))
+        self.parent = {}
+        self.innermost = {}
+        for h in reversed(self.headers):
+            self.parent[h] = self.innermost.get(h)
+            for b in self.body[h]:
+                self.innermost[b] = h
+
+# ================================================================================
+
+def fresh_labels(body):
+    # labels %.Lssa<k> not used in body
+    used = {instr.args[0] for instr in body if instr.opcode == 'label'}
+    k = 0
+    while True:
+        label = f'%.Lssa{k}'
+        k += 1
+        if label not in used:
+            yield label
+
+
+def copy_body(body):
+    return [Instruction(instr.opcode, list(instr.args), instr.result) for instr in body]
+
+
+def prepare(body, labels):
+    """
+    Copy of a body keeping only the blocks reachable from the entry, where every block starts with a label and the
+    entry block is not the target of a jump.
+    """
+    graph = FlowGraph(body)
+    reachable = set(graph.postorder(reachable=True))
+    prepared = []
+    for b, block in enumerate(graph.blocks):
+        if b not in reachable:
+            continue
+        if block[0][1].opcode != 'label' or (b == 0 and graph.preds[0]):
+            prepared.append(Instruction('label', [next(labels), None], None))
+        prepared.extend(copy_body(instr for _, instr in block))
+    return prepared
+
+
+def to_ssa(proc):
+    """
+    SSA form of a procedure (bx2tac.Procedure), as a new Procedure.
+    """
+    body = prepare(proc.body, fresh_labels(proc.body))
+    if not body:
+        return Procedure(proc.name[1:], list(proc.args), body)
+    graph = FlowGraph(body)
+    dom = DominatorTree(graph)
+    live = dataflow.Liveness(graph)
+    block_label = [block[0][1].args[0] for block in graph.blocks]
+
+    # Phis, at the iterated dominance frontier of the blocks writing each temporary where it is live
+    sites = {}
+    for b, block in enumerate(graph.blocks):
+        for _, instr in block:
+            if is_temp(instr.result):
+                sites.setdefault(instr.result, set()).add(b)
+    phis = [[] for _ in graph.blocks]
+    for temp, blocks in sites.items():
+        mask = live.temps.bit(temp)
+        placed = set()
+        work = list(blocks)
+        while work:
+            for f in dom.frontier[work.pop()]:
+                if f not in placed and live.live_in[f] & mask:
+                    placed.add(f)
+                    args = [arg for p in graph.preds[f] for arg in (block_label[p], temp)]
+                    phis[f].append((temp, Instruction('phi', args, temp)))
+                    if f not in blocks:
+                        work.append(f)
+
+    # Renaming, walking the dominator tree: stacks[temp] holds the versions of temp visible in the current block
+    taken = set(proc.args) | set(sites)
+    taken.update(arg for instr in body for arg in instr.args if is_temp(arg))
+    count = {}
+    stacks = {}
+
+    def current(temp):
+        versions = stacks.get(temp)
+        return versions[-1] if versions else temp
+
+    def define(temp, pushed):
+        k = count.get(temp, 0) + 1
+        while f'{temp}.{k}' in taken:
+            k += 1
+        count[temp] = k
+        name = f'{temp}.{k}'
+        taken.add(name)
+        stacks.setdefault(temp, []).append(name)
+        pushed.append(temp)
+        return name
+
+    work = [(0, None)]
+    while work:
+        b, pushed = work.pop()
+        if pushed is not None:
+            # leaving the subtree of b
+            for temp in pushed:
+                stacks[temp].pop()
+            continue
+        pushed = []
+        for temp, phi in phis[b]:
+            phi.result = define(temp, pushed)
+        for _, instr in graph.blocks[b]:
+            for i in use_positions(instr):
+                if i < len(instr.args) and is_temp(instr.args[i]):
+                    instr.args[i] = current(instr.args[i])
+            if is_temp(instr.result):
+                instr.result = define(instr.result, pushed)
+        for s in graph.succs[b]:
+            for temp, phi in phis[s]:
+                for j, p in enumerate(graph.preds[s]):
+                    if p == b:
+                        phi.args[2 * j + 1] = current(temp)
+        work.append((b, pushed))
+        work.extend((c, None) for c in reversed(dom.children[b]))
+
+    ssa_body = []
+    for b, block in enumerate(graph.blocks):
+        ssa_body.append(block[0][1])
+        ssa_body.extend(phi for _, phi in phis[b])
+        ssa_body.extend(instr for _, instr in block[1:])
+    return Procedure(proc.name[1:], list(proc.args), ssa_body)
+
+def fresh_temps(proc, prefix):
+    # temporaries <prefix><k> not used in a procedure
+    taken = set(proc.args)
+    taken.update(instr.result for instr in proc.body if is_temp(instr.result))
+    taken.update(arg for instr in proc.body for arg in instr.args if is_temp(arg))
+    k = 0
+    while True:
+        temp = f'{prefix}{k}'
+        k += 1
+        if temp not in taken:
+            yield temp
+
+
+def insert_preheaders(proc):
+    """
+    Copy of a procedure in SSA form where the header of every loop is only entered from outside the loop through its
+    preheader, a new block laid out just before it. The arguments of the phis of the header coming from outside
+    move to the preheader (to a phi of its own when there are several). Returns the procedure and the preheader
+    label of every header label.
+    """
+    body = copy_body(proc.body)
+    graph = FlowGraph(body)
+    if not graph.blocks:
+        return Procedure(proc.name[1:], list(proc.args), body), {}
+    loops = LoopForest(graph, DominatorTree(graph))
+    labels = fresh_labels(body)
+    temps = fresh_temps(proc, '%pre')
+    label_of = [block[0][1].args[0] for block in graph.blocks]
+    block_of = {label: b for b, label in enumerate(label_of)}
+
+    preheaders = {}
+    before = {}     # header -> its preheader
+    retarget = {}   # block outside a loop -> {header label: preheader label}
+    for h, blocks in loops.body.items():
+        pre = next(labels)
+        preheaders[label_of[h]] = pre
+        before[h] = [Instruction('label', [pre, None], None)]
+        for _, phi in graph.blocks[h]:
+            if phi.opcode != 'phi':
+                continue
+            pairs = list(zip(phi.args[::2], phi.args[1::2]))
+            outside = [(label, temp) for label, temp in pairs if block_of[label] not in blocks]
+            inside = [(label, temp) for label, temp in pairs if block_of[label] in blocks]
+            if len({temp for _, temp in outside}) == 1:
+                value = outside[0][1]
+            else:
+                value = next(temps)
+                before[h].append(Instruction('phi', [arg for pair in outside for arg in pair], value))
+            phi.args = [arg for pair in inside for arg in pair] + [pre, value]
+        for p in graph.preds[h]:
+            if p not in blocks:
+                retarget.setdefault(p, {})[label_of[h]] = pre
+
+    result = []
+    for b, block in enumerate(graph.blocks):
+        if b in before:
+            last = graph.blocks[b - 1][-1][1]
+            if b - 1 in loops.body[b] and last.opcode not in ('jmp', 'ret'):
+                # a block of the loop falling through to the header jumps over the preheader
+                result.append(Instruction('jmp', [label_of[b], None], None))
+            result.extend(before[b])
+        for _, instr in block:
+            if b in retarget and instr.opcode == 'jmp':
+                instr.args[0] = retarget[b].get(instr.args[0], instr.args[0])
+            elif b in retarget and instr.opcode in dataflow.jumps:
+                instr.args[1] = retarget[b].get(instr.args[1], instr.args[1])
+            result.append(instr)
+    return Procedure(proc.name[1:], list(proc.args), result), preheaders
+
+# ================================================================================
+
+def sequentialize(copies, fresh):
+    """
+    Sequence of copies (destination, source) performing the parallel copy of copies at once; fresh() names a
+    temporary to break the cycles (as in a swap).
+    """
+    pending = {dest: src for dest, src in copies if dest != src}
+    sequence = []
+    while pending:
+        read = set(pending.values())
+        ready = [dest for dest in pending if dest not in read]
+        if ready:
+            for dest in ready:
+                sequence.append((dest, pending.pop(dest)))
+        else:
+            # only cycles are left: save one destination, and read the saved value instead
+            dest = next(iter(pending))
+            temp = fresh()
+            sequence.append((temp, dest))
+            pending = {d: temp if s == dest else s for d, s in pending.items()}
+    return sequence
+
+
+def copy_instr(dest, src):
+    if isinstance(src, int):
+        return Instruction('const', [src, None], dest)
+    return Instruction('copy', [src, None], dest)
+
+
+def from_ssa(proc):
+    """
+    Procedure without phis equivalent to a procedure in SSA form: the phis of a block become copies at the end of
+    its predecessors, or in a new block on the edge when the predecessor ends with a conditional jump.
+    """
+    body = copy_body(proc.body)
+    graph = FlowGraph(body)
+    labels = fresh_labels(body)
+    label_block = {block[0][1].args[0]: b for b, block in enumerate(graph.blocks) if block[0][1].opcode == 'label'}
+
+    taken = set(proc.args)
+    taken.update(instr.result for instr in body if is_temp(instr.result))
+    taken.update(arg for instr in body for arg in instr.args if is_temp(arg))
+    swaps = (f'%ssa{k}' for k in range(len(body) + len(taken) + 1) if f'%ssa{k}' not in taken)
+
+    edge_copies = {}
+    for s, block in enumerate(graph.blocks):
+        for _, instr in block:
+            if instr.opcode == 'phi':
+                for label, src in zip(instr.args[::2], instr.args[1::2]):
+                    edge_copies.setdefault((label_block[label], s), []).append((instr.result, src))
+
+    at_end = {}     # copies at the end of a block, before its jmp
+    after = {}      # block inserted after a block, on its fall through edge
+    appended = []   # blocks at the end of the body, on the edges of conditional jumps
+    inserted = []
+    for (p, s), copies in edge_copies.items():
+        sequence = [copy_instr(dest, src) for dest, src in sequentialize(copies, lambda: next(swaps))]
+        inserted.extend(sequence)
+        last = graph.blocks[p][-1][1]
+        if last.opcode not in dataflow.jumps:
+            at_end.setdefault(p, []).extend(sequence)
+            continue
+        if label_block[last.args[1]] == s:
+            label = next(labels)
+            appended.append(Instruction('label', [label, None], None))
+            appended.extend(sequence)
+            appended.append(Instruction('jmp', [last.args[1], None], None))
+            last.args[1] = label
+        if p + 1 == s:
+            sequence = copy_body(sequence)
+            inserted.extend(sequence)
+            after[p] = [Instruction('label', [next(labels), None], None)] + sequence
+
+    plain = []
+    for b, block in enumerate(graph.blocks):
+        instrs = [instr for _, instr in block if instr.opcode != 'phi']
+        if b in at_end:
+            k = len(instrs) - 1 if instrs[-1].opcode == 'jmp' else len(instrs)
+            instrs[k:k] = at_end[b]
+        plain.extend(instrs)
+        plain.extend(after.get(b, []))
+    plain.extend(appended)
+
+    # the labels added by to_ssa and the edge blocks entered by falling through are not needed in the assembly
+    targets = {instr.args[0] for instr in plain if instr.opcode == 'jmp'}
+    targets.update(instr.args[1] for instr in plain if instr.opcode in dataflow.jumps)
+    plain = [instr for instr in plain
+             if not (instr.opcode == 'label' and instr.args[0].startswith('%.Lssa') and instr.args[0] not in targets)]
+    return coalesce(Procedure(proc.name[1:], list(proc.args), plain), inserted)
+
+
+def coalesce(proc, copies):
+    """
+    Gives one name to the two temporaries of every copy of copies that do not interfere, the copy disappearing (the
+    versions of a temporary connected by a phi usually get their name back). The parameters keep their name.
+    """
+    graph, _ = dataflow.interference_graph(proc)
+    alias = {}
+
+    def find(temp):
+        while temp in alias:
+            temp = alias[temp]
+        return temp
+
+    for instr in copies:
+        if instr.opcode != 'copy':
+            continue
+        a, b = find(instr.result), find(instr.args[0])
+        if a == b or a not in graph or b not in graph or b in graph[a]:
+            continue
+        # a is renamed to b: the temporary with fewer neighbours, so that a temporary merged with many others is
+        # not copied every time; the parameters keep their name
+        if a in proc.args or (len(graph[a]) > len(graph[b]) and b not in proc.args):
+            a, b = b, a
+        if a in proc.args:
+            continue
+        for n in graph.pop(a):
+            graph[n].discard(a)
+            graph[n].add(b)
+            graph[b].add(n)
+        alias[a] = b
+    if not alias:
+        return proc
+
+    body = []
+    for instr in proc.body:
+        args = [find(arg) if is_temp(arg) else arg for arg in instr.args]
+        result = find(instr.result) if is_temp(instr.result) else instr.result
+        if not (instr.opcode == 'copy' and args[0] == result):
+            body.append(Instruction(instr.opcode, args, result))
+    return Procedure(proc.name[1:], list(proc.args), body)
+
+# ================================================================================
+
+def format_instr(instr):
+    args = [arg for arg in instr.args if arg is not None]
+    if instr.opcode == 'label':
+        return f'{args[0]}:'
+    if instr.opcode == 'phi':
+        text = 'phi ' + ', '.join(f'[{label}: {temp}]' for label, temp in zip(args[::2], args[1::2]))
+    else:
+        text = ' '.join([instr.opcode] + [', '.join(str(arg) for arg in args)] if args else [instr.opcode])
+    return f'    {instr.result} = {text}' if instr.result is not None else f'    {text}'
+
+
+def format_proc(proc):
+    # Readable listing of a procedure, as printed by --dump-ssa
+    return '\n'.join([f"{proc.name}({', '.join(proc.args)}):"] + [format_instr(instr) for instr in proc.body])
+
+
+def timed(function, *args):
+    # function(*args), its run time added to timings
+    start = time.perf_counter()
+    result = function(*args)
+    timings[function.__name__] += time.perf_counter() - start
+    return result
+
+
+def print_timings(timings):
+    # Table of the time spent in each pass, as printed by --time-passes
+    total = sum(timings.values())
+    for name, seconds in timings.most_common():
+        print(f'{name:<28}{1000 * seconds:10.2f} ms {100 * seconds / total:6.1f}%')
+    print(f'{"total":<28}{1000 * total:10.2f} ms')
+
+
+def optimize(proc, passes, dump=False):
+    """
+    Runs passes (functions from a procedure in SSA form to a procedure in SSA form, see ssa_opt) on a procedure
+    (bx2tac.Procedure) and returns it out of SSA form. With dump, its SSA form is printed first. The time spent in
+    each pass, and in and out of SSA form, is added to timings.
+    """
+    if not passes and not dump:
+        return proc
+    form = timed(to_ssa, proc)
+    if dump:
+        print(format_proc(form))
+    if not passes:
+        return proc
+    for ssa_pass in passes:
+        form = timed(ssa_pass, form)
+    return timed(from_ssa, form)
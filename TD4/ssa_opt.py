@@ -0,0 +1,601 @@
+"""
+Optimizations of TAC procedures in SSA form (see ssa), run by tac_cfopt before the control flow optimization.
+Every pass maps a procedure in SSA form to a new one, and counts what it changed in stats.
+"""
+from collections import Counter
+
+from bx2tac import Instruction, Procedure
+from dataflow import FlowGraph, is_temp, jumps, use_positions, uses_defs
+from ssa import DominatorTree, LoopForest, copy_body, fresh_temps, insert_preheaders
+
+# Number of changes made by each pass since the start (or the last stats.clear())
+stats = Counter()
+
+
+def wrap(value):
+    # 64 bit two's complement, as computed by the x64 instructions
+    value &= (1 << 64) - 1
+    return value - (1 << 64) if value >> 63 else value
+
+
+def divide(a, b):
+    # idivq: quotient rounded toward zero, remainder of the sign of the dividend; None when it traps
+    if b == 0 or (a == -(1 << 63) and b == -1):
+        return None
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
+fold = {
+    'add': lambda a, b: wrap(a + b),
+    'sub': lambda a, b: wrap(a - b),
+    'mul': lambda a, b: wrap(a * b),
+    'div': divide,
+    'mod': lambda a, b: None if divide(a, b) is None else wrap(a - divide(a, b) * b),
+    'and': lambda a, b: a & b,
+    'or': lambda a, b: a | b,
+    'xor': lambda a, b: a ^ b,
+    'shl': lambda a, b: wrap(a << (b & 63)),
+    'shr': lambda a, b: a >> (b & 63),
+    'neg': lambda a: wrap(-a),
+    'not': lambda a: ~a,
+}
+
+# Condition of the conditional jumps on the value of their temporary (compared to 0)
+taken = {
+    'je': lambda v: v == 0, 'jz': lambda v: v == 0,
+    'jnz': lambda v: v != 0,
+    'jl': lambda v: v < 0,
+    'jle': lambda v: v <= 0,
+    'jg': lambda v: v > 0, 'jnle': lambda v: v > 0,
+    'jge': lambda v: v >= 0, 'jnl': lambda v: v >= 0,
+}
+
+# ================================================================================
+
+# Lattice of sparse conditional constant propagation: a temporary missing from the values is not known yet (top),
+# an int is a constant, and VARYING (bottom) anything else
+VARYING = 'varying'
+
+
+def meet(a, b):
+    if a is None:
+        return b
+    if b is None or a == b:
+        return a
+    return VARYING
+
+
+def sccp(proc):
+    """
+    Sparse conditional constant propagation (Wegman and Zadeck). The temporaries found constant are written by a
+    const, the constant writes left unused disappear, and the conditional jumps on a constant become a jmp or fall
+    through: the blocks left unreachable are removed by the UCE of tac_cfopt afterwards.
+    """
+    body = copy_body(proc.body)
+    graph = FlowGraph(body)
+    n = len(graph.blocks)
+    labels = {block[0][1].args[0]: b for b, block in enumerate(graph.blocks) if block[0][1].opcode == 'label'}
+    block_of = {}
+    written = set()
+    users = {}
+    for b, block in enumerate(graph.blocks):
+        for i, instr in block:
+            block_of[i] = b
+            if is_temp(instr.result):
+                written.add(instr.result)
+            for temp in uses_defs(instr)[0]:
+                users.setdefault(temp, []).append(i)
+
+    values = {}
+    executable = [False] * n
+    edges = set()
+
+    def value(arg):
+        if isinstance(arg, int):
+            return arg
+        if is_temp(arg) and arg in written:
+            return values.get(arg)
+        # parameters, globals and temporaries never written
+        return VARYING
+
+    def evaluate(b, instr):
+        opcode, args = instr.opcode, [arg for arg in instr.args if arg is not None]
+        if opcode == 'const':
+            return args[0]
+        if opcode == 'copy':
+            return value(args[0])
+        if opcode == 'phi':
+            result = None
+            for label, temp in zip(args[::2], args[1::2]):
+                if (labels[label], b) in edges:
+                    result = meet(result, value(temp))
+            return result
+        if opcode in fold:
+            operands = [value(arg) for arg in args]
+            if VARYING in operands:
+                return VARYING
+            if None in operands:
+                return None
+            result = fold[opcode](*operands)
+            return VARYING if result is None else result
+        return VARYING
+
+    def successors(b):
+        # successors of block b reached for the values known so far
+        i, last = graph.blocks[b][-1]
+        if last.opcode == 'ret':
+            return []
+        if last.opcode == 'jmp':
+            return [labels[last.args[0]]]
+        if last.opcode in jumps:
+            condition = value(last.args[0])
+            if condition is None:
+                return []
+            target = [labels[last.args[1]]]
+            after = [b + 1] if b + 1 < n else []
+            if condition == VARYING:
+                return target + after
+            return target if taken[last.opcode](condition) else after
+        return [b + 1] if b + 1 < n else []
+
+    flow = [(None, 0)] if n else []
+    work = []
+
+    def visit(i):
+        instr = body[i]
+        b = block_of[i]
+        if instr.opcode in jumps:
+            flow.extend((b, s) for s in successors(b))
+        elif is_temp(instr.result):
+            new = evaluate(b, instr)
+            if new != values.get(instr.result):
+                values[instr.result] = new
+                work.extend(users.get(instr.result, []))
+
+    while flow or work:
+        while flow:
+            edge = flow.pop()
+            if edge in edges:
+                continue
+            edges.add(edge)
+            b = edge[1]
+            if not executable[b]:
+                executable[b] = True
+                for i, _ in graph.blocks[b]:
+                    visit(i)
+                flow.extend((b, s) for s in successors(b))
+            else:
+                for i, instr in graph.blocks[b]:
+                    if instr.opcode == 'phi':
+                        visit(i)
+        while work:
+            i = work.pop()
+            if executable[block_of[i]]:
+                visit(i)
+
+    # Rewriting
+    result = []
+    used = set()
+    for b, block in enumerate(graph.blocks):
+        for i, instr in block:
+            if not executable[b]:
+                result.append(instr)
+                continue
+            if instr.opcode == 'phi':
+                args = []
+                for label, temp in zip(instr.args[::2], instr.args[1::2]):
+                    if (labels[label], b) in edges:
+                        args.extend((label, temp))
+                instr.args = args
+            constant = values.get(instr.result) if is_temp(instr.result) else None
+            if isinstance(constant, int) and instr.opcode != 'const' and (instr.opcode in fold or
+                                                                           instr.opcode in ('copy', 'phi')):
+                instr = Instruction('const', [constant, None], instr.result)
+                stats['sccp: constants folded'] += 1
+            elif instr.opcode in jumps and isinstance(value(instr.args[0]), int):
+                stats['sccp: branches resolved'] += 1
+                if taken[instr.opcode](value(instr.args[0])):
+                    instr = Instruction('jmp', [instr.args[1], None], None)
+                else:
+                    continue
+            result.append(instr)
+            used.update(uses_defs(instr)[0])
+
+    # the constants nothing executable reads any more
+    kept = [instr for instr in result
+            if not (instr.opcode == 'const' and is_temp(instr.result) and instr.result not in used)]
+    stats['sccp: constants removed'] += len(result) - len(kept)
+    return Procedure(proc.name[1:], list(proc.args), kept)
+
+
+# ================================================================================
+
+def copy_propagation(proc):
+    """
+    Copy propagation: the temporaries written by a copy of a temporary, or by a phi whose arguments are all the same
+    temporary (or the result itself, around a loop), are replaced by that temporary and the copies and phis
+    disappear. In SSA form the source is never written again, so that every use reads the same value. The copies
+    of globals are kept: they read memory that the calls may change.
+    """
+    body = copy_body(proc.body)
+    source = {}
+
+    def find(temp):
+        while temp in source:
+            temp = source[temp]
+        return temp
+
+    changed = True
+    while changed:
+        # one pass finds the copies; the phis reading the copies are only found trivial afterwards
+        changed = False
+        for instr in body:
+            if not is_temp(instr.result) or instr.result in source:
+                continue
+            if instr.opcode == 'copy':
+                sources = {find(instr.args[0])}
+            elif instr.opcode == 'phi':
+                sources = {find(temp) for temp in instr.args[1::2]} - {instr.result}
+            else:
+                continue
+            if len(sources) == 1 and is_temp(next(iter(sources))):
+                source[instr.result] = sources.pop()
+                stats['copy propagation: copies removed' if instr.opcode == 'copy' else
+                      'copy propagation: phis removed'] += 1
+                changed = True
+
+    result = []
+    for instr in body:
+        if instr.result in source:
+            continue
+        for i in use_positions(instr):
+            if i < len(instr.args) and is_temp(instr.args[i]):
+                instr.args[i] = find(instr.args[i])
+        result.append(instr)
+    return Procedure(proc.name[1:], list(proc.args), result)
+
+
+# ================================================================================
+
+# Operations whose operands can be swapped
+commutative = {'add', 'mul', 'and', 'or', 'xor'}
+
+
+def gvn(proc):
+    """
+    Global value numbering on the dominator tree (Briggs, Cooper and Simpson): an operation of the same opcode and
+    operands (in any order for the commutative ones) as an operation of a dominating block computes the same value,
+    so it is removed and its result replaced by the earlier one; the same goes for the phis of a block. A load (a
+    copy of a global) is only reused in its block, up to the next write of the global or call, since the calls may
+    change every global. The constants are not merged: writing one again is cheaper than keeping it in a register.
+    """
+    body = copy_body(proc.body)
+    graph = FlowGraph(body)
+    if not graph.blocks:
+        return Procedure(proc.name[1:], list(proc.args), body)
+    dom = DominatorTree(graph)
+    constants = {instr.result: instr.args[0] for instr in body if instr.opcode == 'const' and is_temp(instr.result)}
+    number = {}     # temporary removed -> temporary with the same value
+    removed = set()
+
+    def find(temp):
+        while temp in number:
+            temp = number[temp]
+        return temp
+
+    def operand(arg):
+        # value of an operand: a constant, or the temporary first computing it
+        if not is_temp(arg):
+            return arg
+        arg = find(arg)
+        return ('const', constants[arg]) if arg in constants else arg
+
+    def remove(i, instr, value, kind):
+        number[instr.result] = value
+        removed.add(i)
+        stats[f'gvn: {kind} removed'] += 1
+
+    # Walk of the dominator tree: table holds the operations of the blocks dominating the current one
+    table = {}
+    work = [(0, None)]
+    while work:
+        b, added = work.pop()
+        if added is not None:
+            # leaving the subtree of b
+            for key in added:
+                del table[key]
+            continue
+        added = []
+        loads = {}
+        for i, instr in graph.blocks[b]:
+            opcode, result = instr.opcode, instr.result
+            if opcode == 'call':
+                loads.clear()
+            if isinstance(result, str) and result.startswith('@'):
+                loads.pop(result, None)
+                if opcode == 'copy' and is_temp(instr.args[0]):
+                    loads[result] = find(instr.args[0])
+                continue
+            if not is_temp(result):
+                continue
+            if opcode == 'copy':
+                src = instr.args[0]
+                if is_temp(src):
+                    remove(i, instr, find(src), 'copies')
+                elif src in loads:
+                    remove(i, instr, loads[src], 'loads')
+                elif isinstance(src, str) and src.startswith('@'):
+                    loads[src] = result
+                continue
+            if opcode == 'phi':
+                sources = {find(temp) for temp in instr.args[1::2]} - {result}
+                if len(sources) == 1 and is_temp(next(iter(sources))):
+                    remove(i, instr, sources.pop(), 'phis')
+                    continue
+                key = ('phi', b) + tuple(operand(temp) for temp in instr.args[1::2])
+            elif opcode in fold:
+                operands = [operand(arg) for arg in instr.args if arg is not None]
+                if any(isinstance(arg, str) and arg.startswith('@') for arg in operands):
+                    continue
+                if opcode in commutative:
+                    operands.sort(key=repr)
+                key = (opcode, *operands)
+            else:
+                continue
+            if key in table:
+                remove(i, instr, table[key], 'phis' if opcode == 'phi' else 'expressions')
+            else:
+                table[key] = result
+                added.append(key)
+        work.append((b, added))
+        work.extend((c, None) for c in reversed(dom.children[b]))
+
+    result = []
+    for b, block in enumerate(graph.blocks):
+        for i, instr in block:
+            if i in removed:
+                continue
+            for k in use_positions(instr):
+                if k < len(instr.args) and is_temp(instr.args[k]):
+                    instr.args[k] = find(instr.args[k])
+            result.append(instr)
+    return Procedure(proc.name[1:], list(proc.args), result)
+
+
+# ================================================================================
+
+def hoistable(instr, constants):
+    # Pure instructions writing a temporary with the same value wherever they are; a division only when it cannot trap
+    if not is_temp(instr.result):
+        return False
+    if instr.opcode in ('div', 'mod'):
+        return constants.get(instr.args[1]) not in (None, 0, -1)
+    return instr.opcode in fold or (instr.opcode == 'copy' and is_temp(instr.args[0]))
+
+
+def licm(proc):
+    """
+    Loop invariant code motion: every loop gets a preheader (see ssa.insert_preheaders), then the pure instructions
+    of the loop whose operands are all constants or written outside of it (or by instructions already moved) move
+    to the end of its preheader, from the inner loops outwards. The constants stay in the loop, as in gvn: those
+    read by a moved instruction are written again in the preheader. Divisions and modulos only move with a constant
+    divisor other than 0 and -1: otherwise they could stop the program where the loop would not have run them.
+    """
+    proc, preheaders = insert_preheaders(proc)
+    if not preheaders:
+        return proc
+    stats['licm: preheaders inserted'] += len(preheaders)
+    graph = FlowGraph(proc.body)
+    loops = LoopForest(graph, DominatorTree(graph))
+    block_of = {block[0][1].args[0]: b for b, block in enumerate(graph.blocks)}
+    instrs = [[instr for _, instr in block] for block in graph.blocks]
+    written = {}    # temporary -> block writing it
+    for b, block in enumerate(instrs):
+        for instr in block:
+            if is_temp(instr.result):
+                written[instr.result] = b
+    constants = {instr.result: instr.args[0] for instr in proc.body if instr.opcode == 'const'}
+    order = graph.reverse_postorder()
+    temps = fresh_temps(proc, '%licm')
+
+    for h in loops.headers:
+        blocks = loops.body[h]
+        pre = block_of[preheaders[graph.blocks[h][0][1].args[0]]]
+        for b in order:
+            if b not in blocks:
+                continue
+            kept = []
+            for instr in instrs[b]:
+                if hoistable(instr, constants) and \
+                        all(temp in constants or written.get(temp) not in blocks for temp in uses_defs(instr)[0]):
+                    # the constants it reads are written again in the preheader, the loop may use them as well
+                    for k in use_positions(instr):
+                        temp = instr.args[k]
+                        if temp in constants and written.get(temp) in blocks:
+                            instr.args[k] = next(temps)
+                            instrs[pre].append(Instruction('const', [constants[temp], None], instr.args[k]))
+                            written[instr.args[k]] = pre
+                            constants[instr.args[k]] = constants[temp]
+                    instrs[pre].append(instr)
+                    written[instr.result] = pre
+                    stats['licm: instructions hoisted'] += 1
+                else:
+                    kept.append(instr)
+            instrs[b] = kept
+    return Procedure(proc.name[1:], list(proc.args), [instr for block in instrs for instr in block])
+
+
+# ================================================================================
+
+def induction_variables(proc):
+    """
+    Strength reduction of the induction variables. A basic induction variable is a phi i of a loop header that goes
+    up (or down) by the same invariant step at every iteration; a product of i by an invariant k (or its left shift
+    by a constant) is a derived one, and becomes a phi of its own: it starts at start * k in the preheader and goes
+    up by k * step next to i, so that the multiplication at every iteration is replaced by an addition. Both wrap
+    around at 64 bits, so the derived variable is always i * k.
+    """
+    proc, preheaders = insert_preheaders(proc)
+    if not preheaders:
+        return proc
+    graph = FlowGraph(proc.body)
+    loops = LoopForest(graph, DominatorTree(graph))
+    block_of = {block[0][1].args[0]: b for b, block in enumerate(graph.blocks)}
+    instrs = [[instr for _, instr in block] for block in graph.blocks]
+    written = {}        # temporary -> block writing it
+    definition = {}     # temporary -> instruction writing it
+    for b, block in enumerate(instrs):
+        for instr in block:
+            if is_temp(instr.result):
+                written[instr.result] = b
+                definition[instr.result] = instr
+    constants = {instr.result: instr.args[0] for instr in proc.body if instr.opcode == 'const'}
+    order = graph.reverse_postorder()
+    temps = fresh_temps(proc, '%iv')
+    number = {}         # product removed -> derived induction variable
+
+    for h in loops.headers:
+        blocks = loops.body[h]
+        pre_label = preheaders[graph.blocks[h][0][1].args[0]]
+        pre = block_of[pre_label]
+
+        def invariant(arg):
+            return arg in constants or (is_temp(arg) and written.get(arg) not in blocks)
+
+        def in_preheader(arg):
+            # the value of an invariant in the preheader, writing again the constants of the loop
+            if arg in constants and written[arg] in blocks:
+                return constant(constants[arg])
+            return arg
+
+        def constant(value):
+            temp = next(temps)
+            instrs[pre].append(Instruction('const', [value, None], temp))
+            constants[temp] = value
+            return temp
+
+        def product(a, b):
+            # a * b in the preheader
+            if a in constants and b in constants:
+                return constant(wrap(constants[a] * constants[b]))
+            if constants.get(a) == 1 or constants.get(b) == 1:
+                return b if constants.get(a) == 1 else a
+            temp = next(temps)
+            instrs[pre].append(Instruction('mul', [a, b], temp))
+            return temp
+
+        # basic induction variables: i = phi [preheader: start], [latches: i +/- step]
+        basic = {}
+        for instr in instrs[h]:
+            if instr.opcode != 'phi':
+                continue
+            pairs = list(zip(instr.args[::2], instr.args[1::2]))
+            starts = [temp for label, temp in pairs if label == pre_label]
+            nexts = {temp for label, temp in pairs if label != pre_label}
+            if len(starts) != 1 or len(nexts) != 1:
+                continue
+            i, update = instr.result, definition.get(next(iter(nexts)))
+            if update is None or written[update.result] not in blocks or update.opcode not in ('add', 'sub'):
+                continue
+            a, b = update.args[0], update.args[1]
+            if a == i and invariant(b):
+                basic[i] = (starts[0], update, b, [label for label, _ in pairs if label != pre_label])
+            elif b == i and update.opcode == 'add' and invariant(a):
+                basic[i] = (starts[0], update, a, [label for label, _ in pairs if label != pre_label])
+
+        # derived induction variables: i * k, k * i and i << n; their phis and increments are added once all the
+        # blocks of the loop are rewritten, the header and the blocks of the updates being among them
+        phis, increments = [], []
+        for b in order:
+            if b not in blocks:
+                continue
+            kept = []
+            for instr in instrs[b]:
+                a, c = (instr.args + [None, None])[:2]
+                if instr.opcode == 'mul' and a in basic and invariant(c):
+                    i, k = a, in_preheader(c)
+                elif instr.opcode == 'mul' and c in basic and invariant(a):
+                    i, k = c, in_preheader(a)
+                elif instr.opcode == 'shl' and a in basic and c in constants:
+                    i, k = a, constant(wrap(1 << (constants[c] & 63)))
+                else:
+                    kept.append(instr)
+                    continue
+                start, update, step, latches = basic[i]
+                j, j1 = next(temps), next(temps)
+                increment, j0 = product(k, in_preheader(step)), product(in_preheader(start), k)
+                phis.append(Instruction('phi', [pre_label, j0] + [arg for label in latches for arg in (label, j1)], j))
+                increments.append((update, Instruction(update.opcode, [j, increment], j1)))
+                number[instr.result] = j
+                stats['induction variables: products reduced'] += 1
+            instrs[b] = kept
+        instrs[h][1:1] = phis
+        for update, instr in increments:
+            block = instrs[written[update.result]]
+            block.insert(block.index(update) + 1, instr)
+
+    body = []
+    for block in instrs:
+        for instr in block:
+            for k in use_positions(instr):
+                if k < len(instr.args) and instr.args[k] in number:
+                    instr.args[k] = number[instr.args[k]]
+            body.append(instr)
+    return Procedure(proc.name[1:], list(proc.args), body)
+
+
+def power_of_two(value):
+    # k when value is 2 ** k (1 <= k <= 62), else None
+    if isinstance(value, int) and value > 1 and value & (value - 1) == 0 and value < 1 << 63:
+        return value.bit_length() - 1
+    return None
+
+
+def strength_reduction(proc):
+    """
+    Multiplications, divisions and modulos by a constant power of two 2 ** k become shifts and masks. The divisions
+    round toward zero like idivq: a negative dividend is biased by 2 ** k - 1 (its sign, x >> 63, masked) before
+    the arithmetic shift, and the modulo is the dividend minus the quotient shifted back, which keeps its sign.
+    """
+    body = copy_body(proc.body)
+    constants = {instr.result: instr.args[0] for instr in body if instr.opcode == 'const'}
+    temps = fresh_temps(proc, '%sr')
+    result = []
+
+    def const(value):
+        temp = next(temps)
+        result.append(Instruction('const', [value, None], temp))
+        return temp
+
+    for instr in body:
+        a, b = (instr.args + [None, None])[:2]
+        k = power_of_two(constants.get(b))
+        if instr.opcode == 'mul' and k is None and power_of_two(constants.get(a)) is not None:
+            a, b, k = b, a, power_of_two(constants.get(a))
+        if k is None or instr.opcode not in ('mul', 'div', 'mod') or not is_temp(instr.result):
+            result.append(instr)
+            continue
+        stats[f'strength reduction: {instr.opcode} by 2 ** k'] += 1
+        if instr.opcode == 'mul':
+            result.append(Instruction('shl', [a, const(k)], instr.result))
+            continue
+        sign, bias, biased = next(temps), next(temps), next(temps)
+        result.append(Instruction('shr', [a, const(63)], sign))
+        result.append(Instruction('and', [sign, const((1 << k) - 1)], bias))
+        result.append(Instruction('add', [a, bias], biased))
+        if instr.opcode == 'div':
+            result.append(Instruction('shr', [biased, const(k)], instr.result))
+        else:
+            rounded = next(temps)
+            result.append(Instruction('and', [biased, const(-(1 << k))], rounded))
+            result.append(Instruction('sub', [a, rounded], instr.result))
+    return Procedure(proc.name[1:], list(proc.args), result)
+
+
+# SSA passes of tac_cfopt.optimize_proc at each optimization level (-O), in order
+passes = {
+    0: [sccp],
+    1: [sccp, copy_propagation, gvn, licm, induction_variables, strength_reduction],
+    2: [sccp, copy_propagation, gvn, licm, induction_variables, strength_reduction],
+}
@@ -11,7 +11,8 @@ Requires: a working gcc
 
 from cgitb import reset
 import json
-from bx2tac import Instruction
+from bx2tac import Instruction, tac_from_json
+import regalloc
 from typing import List
 import sys
 import os
@@ -73,6 +74,13 @@ param_map = [
         f'%r8',
         f'%r9']
 
+def is_register(operand):
+    return operand.startswith('%')
+
+def asm_label(name, label):
+    # TAC labels are numbered per procedure: qualify them with the procedure name
+    return f".L{name}_{label.lstrip('%.')}"
+
 def lookup_temp(var, temp_map, gvars, args, stack_size):
     #print("Reached lookup function", args)
     if var in gvars:
@@ -106,12 +114,45 @@ def lookup_temp(var, temp_map, gvars, args, stack_size):
     #     #returns the value of temp
     #     return temp_map.setdefault(temp, f'{-8 * (len(temp_map) + 1)}(%rbp)')
 
-def tac_to_asm(tac_instrs, gvars, name, proc_args, temp_map, stack_size):
+def branch_counters(name, edges):
+    """
+    Data of the branch counters of procedure name: edges maps (source, target, kind) to the number of its counter,
+    source being the label of the block the branch leaves. A function run at exit (.fini_array) appends a line
+    "procedure source target kind count" per edge to the profile file (__bx_write_profile of bx_runtime.c).
+    """
+    counts = f'.Lbranches_{name}'
+    asm = ["\t.data", "\t.balign 8", f"{counts}:", f"\t.zero {8 * len(edges)}", f".Ledges_{name}:"]
+    asm += [f'\t.quad .Ledge_{name}_{i}' for i in range(len(edges))]
+    asm.append("\t.section .rodata")
+    asm += [f'.Ledge_{name}_{i}: .string "@{name} {source} {target} {kind}"'
+            for (source, target, kind), i in edges.items()]
+    asm += ['\t.section .fini_array,"aw"', "\t.balign 8", f"\t.quad .Lreport_{name}",
+            "\t.text", f".Lreport_{name}:", "\tpushq %rbp", "\tmovq %rsp, %rbp",
+            f"\tleaq .Ledges_{name}(%rip), %rdi", f"\tleaq {counts}(%rip), %rsi", f"\tmovq ${len(edges)}, %rdx",
+            "\tcallq __bx_write_profile", "\tpopq %rbp", "\tretq", ""]
+    return asm
+
+def tac_to_asm(tac_instrs, gvars, name, proc_args, temp_map, stack_size, call_saves={}, count_branches=False):
         """
         Get the x64 instructions correspondign to the TAC instructions
+        temp_map may already map temporaries to registers (regalloc): the callee-saved ones are saved in the
+        prologue, and call_saves gives the caller-saved registers to save around the call at each index.
+        count_branches counts the jmps (jump), the conditional jumps taken (branch) and the fall-throughs into a
+        label (fall) leaving every block, for block layout and to measure it (see branch_counters).
         """
        # print(proc_args)
         asm = []
+        edges = {}          # (source, target, kind) -> number of its counter
+        trampolines = []    # conditional jumps taken: their counter is incremented on the way to the target
+        source, falls = '-', False
+
+        def count(target, kind):
+            i = edges.setdefault((source, target, kind), len(edges))
+            return f'\tincq .Lbranches_{name}+{8 * i}(%rip)'
+        saved = [reg for reg in regalloc.callee_saved if reg in temp_map.values()]
+        for reg in saved:
+            temp_map, stack_size, slot = lookup_temp(f'save {reg}', temp_map, gvars, proc_args, stack_size)
+            asm.append(f"\tmovq {reg}, {slot}")
         if proc_args != []:
             #print("Procedure has arguments")
             for i in range(min(len(proc_args), 6)):
@@ -119,7 +160,7 @@ def tac_to_asm(tac_instrs, gvars, name, proc_args, temp_map, stack_size):
                 temp_map, stack_size, res = lookup_temp(proc_args[i], temp_map, gvars, proc_args, stack_size)
                 asm.append(f"\tmovq {param_map[i]}, {res}")
 
-        for instr in tac_instrs:
+        for index, instr in enumerate(tac_instrs):
            # print(instr)
             opcode = instr.opcode
             args = instr.args
@@ -129,35 +170,57 @@ def tac_to_asm(tac_instrs, gvars, name, proc_args, temp_map, stack_size):
             elif opcode == 'const':
                 assert len(args) == 2 and isinstance(args[0], int) or len(args) == 1
                 temp_map, stack_size, res = lookup_temp(result, temp_map, gvars, proc_args, stack_size)
-                asm.append(f'movq ${args[0]}, {res}')
+                if -(1 << 31) <= args[0] < (1 << 31) or is_register(res):
+                    asm.append(f'movq ${args[0]}, {res}')
+                else:
+                    # only a register takes a 64 bit immediate
+                    asm.extend([f'movabsq ${args[0]}, %r11', f'movq %r11, {res}'])
             elif opcode == 'label':
                 assert (len(args) == 2 or len(args) == 1)
                 #Changes above assertion because of tac_cfoot.py
-                asm.append(f'{args[0][1:]}:')
+                if count_branches and falls:
+                    asm.append(count(args[0], 'fall'))
+                source = args[0]
+                asm.append(f'{asm_label(name, args[0])}:')
             elif opcode == 'jmp':
                # print("jmp arg",args[0][1:])
                 assert (len(args) == 2 or len(args) == 1)
                 #Changes above assertion because of tac_cfoot.py
-                asm.append(f'jmp {args[0][1:]}')
+                if count_branches:
+                    asm.append(count(args[0], 'jump'))
+                asm.append(f'jmp {asm_label(name, args[0])}')
             elif opcode in jcc:
                 assert len(args) == 2
                 assert result == None
                 temp_map, stack_size, arg1 = lookup_temp(args[0], temp_map, gvars, proc_args, stack_size)
-                asm.extend([f'\tmovq {arg1}, %r11', f'\tcmpq $0, %r11', f'\t{opcode} {args[1][1:]}'])
+                target = asm_label(name, args[1])
+                if count_branches:
+                    taken = f'.Ltaken_{name}_{index}'
+                    trampolines.extend([f'{taken}:', count(args[1], 'branch'), f'\tjmp {target}'])
+                    target = taken
+                asm.extend([f'\tmovq {arg1}, %r11', f'\tcmpq $0, %r11', f'\t{opcode} {target}'])
             elif opcode == 'copy':
                 #Made modif form len = 1 to len = 2 because of tac_cfoot.py
                 assert len(args) == 2 or len(args) == 1
                 temp_map, stack_size, arg = lookup_temp(args[0], temp_map, gvars, proc_args, stack_size)
                 temp_map, stack_size, res = lookup_temp(result, temp_map, gvars, proc_args, stack_size)
-                asm.append(f'movq {arg}, %r11')
-                asm.append(f'movq %r11, {res}')
+                if is_register(arg) or is_register(res):
+                    if arg != res:
+                        asm.append(f'movq {arg}, {res}')
+                else:
+                    asm.append(f'movq {arg}, %r11')
+                    asm.append(f'movq %r11, {res}')
             elif opcode in binops:
                 assert len(args) == 2
                 temp_map, stack_size, arg1 = lookup_temp(args[0], temp_map, gvars, proc_args, stack_size)
                 temp_map, stack_size, arg2 = lookup_temp(args[1], temp_map, gvars, proc_args, stack_size)
                 temp_map, stack_size, res = lookup_temp(result, temp_map, gvars, proc_args, stack_size)
                 proc = binops[opcode]
-                if isinstance(proc, str):
+                if isinstance(proc, str) and is_register(res) and res != arg2:
+                    if res != arg1:
+                        asm.append(f'movq {arg1}, {res}')
+                    asm.append(f'{proc} {arg2}, {res}')
+                elif isinstance(proc, str):
                     asm.extend([f'movq {arg1}, %r11',
                                 f'{proc} {arg2}, %r11',
                                 f'movq %r11, {res}'])
@@ -198,14 +261,21 @@ def tac_to_asm(tac_instrs, gvars, name, proc_args, temp_map, stack_size):
 
             elif opcode == "call":
                 #arg = self.lookup_temp(args[0], temp_map)
+                saves = []
+                for reg in call_saves.get(index, []):
+                    temp_map, stack_size, slot = lookup_temp(f'save {reg}', temp_map, gvars, proc_args, stack_size)
+                    saves.append((reg, slot))
+                asm.extend(f"\tmovq {reg}, {slot}" for reg, slot in saves)
                 asm.append(f"\tcallq {args[0][1:]}")
-                if result != '%_':
+                asm.extend(f"\tmovq {slot}, {reg}" for reg, slot in saves)
+                if result not in (None, '%_'):
                     temp_map, stack_size, res = lookup_temp(result, temp_map, gvars, proc_args, stack_size)
                     asm.append(f"\tmovq %rax, {res}")
             else:
                 assert False, f'unknown opcode: {opcode}'
+            if opcode != 'nop':
+                falls = opcode not in ('jmp', 'ret')
 
-        stack_size = len(temp_map)
         if stack_size % 2 != 0:
             stack_size += 1
         asm = [f"\t.globl {name}", "\t.text", f"{name}:", "\tpushq %rbp",
@@ -214,8 +284,13 @@ def tac_to_asm(tac_instrs, gvars, name, proc_args, temp_map, stack_size):
         if name == 'main':
             asm.append("\txorq %rax, %rax")
 
-        asm += [f".Lend_{name}:", "\tmovq %rbp, %rsp",
+        asm.append(f".Lend_{name}:")
+        for reg in saved:
+            asm.append(f"\tmovq {temp_map[f'save {reg}']}, {reg}")
+        asm += ["\tmovq %rbp, %rsp",
                 "\tpopq %rbp", "\tretq", "", ]
+        if count_branches:
+            asm += trampolines + [""] + branch_counters(name, edges)
 
         return asm, temp_map, stack_size
 
@@ -274,38 +349,45 @@ def tac_to_asm(tac_instrs, gvars, name, proc_args, temp_map, stack_size):
 #    return asm
 
 
+def gvars_to_asm(gvars):
+    # gvars: bx2tac.GlobalVar list
+    asm = []
+    for gvar in gvars:
+        asm.extend([f"\t.globl {gvar.var[1:]}",
+                    "\t.data",
+                    f"{gvar.var[1:]}: .quad {gvar.init}"])
+    return asm
+
+
+def proc_to_asm(proc, gvars, allocator=None, count_branches=False):
+    """
+    Assembly of one procedure (bx2tac.Procedure); gvars are the names of the global variables.
+    Every procedure gets its own stack frame, so the result only depends on proc and gvars.
+    allocator (see regalloc.allocators) puts temporaries in registers, the others live on the stack.
+    count_branches instruments the branches of the procedure (see tac_to_asm).
+    """
+    alloc = allocator(proc) if allocator else {}
+    call_saves = regalloc.caller_saves(proc, alloc)
+    proc_asm, _, _ = tac_to_asm(proc.body, gvars, proc.name[1:], proc.args, dict(alloc), 0, call_saves,
+                                count_branches)
+    return proc_asm
+
+
+def program_to_asm(gvars, procs, allocator=None, count_branches=False):
+    names = [gvar.var for gvar in gvars]
+    asm = gvars_to_asm(gvars)
+    for proc in procs:
+        asm.extend(proc_to_asm(proc, names, allocator, count_branches))
+    return asm
+
+
 def compile_tac(fname):
     tjs = None
     with open(fname, 'rb') as fp:
         tjs = json.load(fp)
     assert isinstance(tjs, list), tjs
 
-    gvars = []
-    asm = []
-    stack = dict()
-    stack_size = 0
-
-    # gvars
-    for decl in tjs:
-        if 'var' in decl:
-            name = decl['var']
-            value = decl['init']
-            gvars.append(name)
-            asm.extend([f"\t.globl {name[1:]}",
-                        "\t.data",
-                        f"{name[1:]}: .quad {value}"])
-
-    # procs decs
-    for decl in tjs:
-        if 'proc' in decl:
-            name = decl['proc']
-            args = decl['args']
-            body = [Instruction(instr["opcode"], instr["args"], instr["result"]) for instr in decl['body']]
-            #print("args of proc", args)
-            proc_asm, stack, stack_size = tac_to_asm(
-                body, gvars, name[1:], args, stack, stack_size)
-            asm.extend(proc_asm)
-
+    asm = program_to_asm(*tac_from_json(tjs))
     with open(fname[:-9] + '.s', 'w') as fn:
         print(*asm, file=fn, sep='\n')
-    return fname[:-9] + '.s'
\ No newline at end of file
+    return fname[:-9] + '.s'
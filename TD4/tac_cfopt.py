@@ -7,421 +7,664 @@ import argparse
 import json
 from bx2tac import Instruction, Prog
 import AST
+import dataflow
 import getopt
+import heapq
+import time
+from collections import Counter
+
+# Instructions removed when their result is dead: the pure operators but the divisions, that stop the program on a
+# division by zero
+removable = (dataflow.pure_ops - {'div', 'mod'}) | {'copy', 'const'}
+
+# Conditional jump taken exactly when the other is not, among those tac2x64 compiles
+negation = {'je': 'jnz', 'jz': 'jnz', 'jnz': 'je', 'jl': 'jge', 'jnl': 'jl', 'jge': 'jl', 'jle': 'jg', 'jnle': 'jle',
+            'jg': 'jle'}
+
+def jump_target(instr):
+    # label a jump goes to, None for the other instructions
+    if instr.opcode == 'jmp':
+        return instr.args[0]
+    if instr.opcode in dataflow.jumps:
+        return instr.args[1]
+    return None
 
 class Basicblock:
     def __init__(self, instrs):
         self.label = instrs[0].args[0]
         self.instrs = instrs
-        self.child = []
-        self.parent = []
+        # labels of the successors and predecessors: dicts used as sets ordered by insertion (the layout of
+        # serialize follows the order of the successors), the successors counting the jumps to them
+        self.child = {}
+        self.parent = {}
 
     def add_parent(self, p_label):
-        self.parent.append(p_label)
+        self.parent[p_label] = None
 
     def add_child(self, c_label):
-        self.child.append(c_label)
+        self.child[c_label] = self.child.get(c_label, 0) + 1
 
     def __str__(self):
         return f'Label: {self.label} ; Instructions: {self.instrs}'
 
     def merge(self, block):
-        self.instrs += block.instrs
-        for child_label in block.child:
-            self.child.append(child_label)
+        # block follows the final jmp of self, its only jump to block: that jmp and the label of block go
+        del self.instrs[-1]
+        self.instrs.extend(block.instrs[1:])
+        del self.child[block.label]
+        for c_label, jumps in block.child.items():
+            self.child[c_label] = self.child.get(c_label, 0) + jumps
+
+class BlockGraph:
+    """
+    The blocks of a CFG reached from its entry, as dataflow.FlowGraph numbers them for the analyses of ssa: labels[b]
+    is the label of block b, the blocks being numbered in reverse postorder (the entry is 0), number the reverse
+    mapping, and succs[b] and preds[b] the numbers of the successors and (reachable) predecessors of b.
+    """
+    def __init__(self, cfg):
+        self.labels = cfg.reverse_postorder()
+        self.number = {label: b for b, label in enumerate(self.labels)}
+        self.blocks = [cfg.block[label] for label in self.labels]
+        self.succs = [[self.number[c] for c in block.child] for block in self.blocks]
+        self.preds = [[self.number[p] for p in block.parent if p in self.number] for block in self.blocks]
+
+    def reverse_postorder(self):
+        return list(range(len(self.labels)))
 
 class CFG:
+    """
+    Basic blocks of a procedure (block: label -> Basicblock) and the analyses derived from its edges: reverse
+    postorder, dominators, dominance frontiers and loops. They are computed when first asked for and cached until
+    the edges change: every edit of the edges increments version.
+    """
     def __init__(self, tac_file, proc_name):
         self.name = proc_name[1:]
-        print("CREATIGN CFG")
-        #print(tac_file)
+        self.version = 0
+        self.cache = {}
         self.block_inference(tac_file)
-        print("Finished creating CFG, current state of block : ")
-        print(self.block)
-
-        
 
     # construct the basic blocks from the instructions
     def block_inference(self, tac_file):
-        #print(tac_file)
-    
+        """
+        Splits the instructions in basic blocks in a single forward pass: every block starts with a label (made up
+        for the entry and for the code following a jmp or a ret) and ends with a jmp or a ret (made explicit for the
+        fall-throughs and the end of the procedure). tac_file is left unchanged.
+        """
         self.block = dict()
+        self.version += 1
 
-        cond_jumps = {'je', 'jnz', 'jl', 'jle', 'jnl', 'jnle', 'jge', 'jg', 'jz'}
-
-        # Add an entry label before first instruction if needed
-        #print(f"\nLocation: block_inference function, tac_file = {tac_file}")
-        if (tac_file[0].opcode != 'label'):
-            lentry = "%.Lentry_" + self.name
-            print(f"Old tac_file[0] {tac_file[0]}")
-            tac_file.insert(0, Instruction('label', [lentry], None))
-            self.entry_label = lentry
-            #print("SELF.ENTRY_LABEL1 BELOW")
-            #print(self.entry_label)
-            print(f"new tac_file 0 : {tac_file[0]}")
-        else:
+        # instructions of the block being built, None after a jmp or a ret
+        if tac_file[0].opcode == 'label':
             self.entry_label = tac_file[0].args[0]
-            #print("SELF.ENTRY_LABEL2 BELOW")
-            #print(self.entry_label)
+            b_instr = None
+        else:
+            self.entry_label = "%.Lentry_" + self.name
+            b_instr = [Instruction('label', [self.entry_label], None)]
 
         count_label = 0
-        tac_add = []
+        for instr in tac_file:
+            if instr.opcode == 'label':
+                if b_instr is not None:
+                    # explicit jmp for the fall-through
+                    b_instr.append(Instruction('jmp', [instr.args[0]], None))
+                    self.add_block(b_instr)
+                b_instr = [instr]
+                continue
+            if b_instr is None:
+                # unreachable code after a jmp or a ret: a block of its own
+                b_instr = [Instruction('label', [f'.Ljmp_{self.name}_{count_label}'], None)]
+                count_label += 1
+            b_instr.append(instr)
+            if instr.opcode in ('jmp', 'ret'):
+                self.add_block(b_instr)
+                b_instr = None
+        if b_instr is not None:
+            b_instr.append(Instruction('ret', [], None))
+            self.add_block(b_instr)
+
+        # the edges go to the targets of the jumps
+        for label, block in self.block.items():
+            for instr in block.instrs:
+                if jump_target(instr) is not None:
+                    self.add_edge(label, jump_target(instr))
 
-        for i in range(len(tac_file)):
-            #print(tac_file[i])
+    def add_block(self, instrs):
+        new = Basicblock(instrs)
+        self.block[new.label] = new
 
-            # For jumps, add a label after the instruction if one doesn’t already exist
-            if (tac_file[i].opcode == 'jmp') and (i < (len(tac_file) - 1)) and (tac_file[i + 1].opcode != 'label'):
-                new = Instruction('label', [f'.Ljmp_{self.name}_{count_label}'], None)
-                count_label += 1
-                tac_add.append((i + 1, new))
-                #print("a")
-                #print(new)
-
-            #Add explicit jmps for fall-throughs.
-            if (i >= 1) and (tac_file[i].opcode == 'label') and (tac_file[i - 1].opcode != 'jmp'):
-                #print("b:", tac_file[i])
-                new = Instruction('jmp', [tac_file[i].args[0]], None)
-                tac_add.append((i, new))
-
-            #keep this or not?
-            if (i == len(tac_file)-1) and (tac_file[i].opcode != 'jmp') and (tac_file[i].opcode != 'ret'):
-                new = Instruction('ret', [], None)
-                tac_add.append((i+1, new))
-
-        for i in range(len(tac_add)):
-            (index, instr) = tac_add[i]
-            tac_file.insert(index+i, instr)
-
-        edges = []
-        b_instr = []
-
-        print("\n\n\n\nCREATING EDGES THAT DO NOT WORK\n =================== ")
-        print(f"current tac file = {tac_file}\n Entering loop...\n")
-
-        # Start a new block at each label
-        #print("start new block at each label in", tac_file)
-
-        for i in range(len(tac_file)):
-            #print(f"{tac_file[i]} : current edges, {edges}, current state of block {self.block}")
-            if "%.L0" in self.block.keys():
-                print("IT IS HERE DUMMY")
-
-
-
-            #accumulate instructions in the block until...
-            b_instr.append(tac_file[i])
-            #...encountering a jump
-            if tac_file[i].opcode == 'jmp':
-                # block until jmp instruction built
-                #print("printing block a")
-                new = Basicblock(b_instr)
-                self.block[new.label] = new
-                dest_label = tac_file[i].args[0]
-                #print("printing labels")
-                #print((new.label, dest_label))
-                if new.label == "%.Lentry_fun1": print(f"added new block : {self.block[new.label]}")
-                edges.append((new.label, dest_label))
-                #print(edges)
-                b_instr = []
-            #...a ret
-            elif tac_file[i].opcode == 'ret':
-                #print("printing block b")
-                new = Basicblock(b_instr)
-                self.block[new.label] = new
-                b_instr = []
-            #...or another label (cond jmps)
-            elif tac_file[i].opcode in cond_jumps:
-                #print("printing block c")
-                source = b_instr[0].args[0]
-                dest_label = tac_file[i].args[1]
-                #print("printing labels")
-                #print((source, dest_label))
-                edges.append((source, dest_label))
-                #print(edges)   
-        print("Finished firt loop...")
-                   
-        #print("edges before children added")
-        #print(edges) 
-        h_edges = edges
-        for (parent, child) in edges:
-            print(f"current edge : {(parent, child)}")
-            print(f"current state of block: {self.block}")
-            #print('before')
-            #print(self.block[parent])
-            self.block[parent].add_child(child)
-            #print('printing keys')
-            #print(self.block.keys())
-            if parent == "%.L0": print((parent, child)) 
-            self.block[child].add_parent(parent)
-        #print("edges after children added")
-        #print(edges)
-        
-
-        #print("block inference done")
-
-
-    def serialize(self, f=True):
+    def serialize(self, f=True, profile=None, placement=True):
         """
-        Turns CFG back into an ordinary TAC sequence
+        Turns CFG back into an ordinary TAC sequence: the blocks the entry reaches (Unreachable Code Elimination), in
+        depth first order from the entry. With f they are split after their conditional jumps and placed by layout
+        (with the edge counts of profile, when given; placement=False keeps the depth first order), and the jumps to
+        the next block are dropped: a jmp following a conditional jump to the next block goes away by inverting the
+        condition.
         """
-        #print(self.block)
-        #print(self.block[self.entry_label])
-        entry_b = self.block[self.entry_label]
-       # print('ENTRY_B BELOW')
-        #print(entry_b)
-        serialized_instrs = list(entry_b.instrs)
-        serialized_labels = set([self.entry_label])
-
-        print("Before calling UCE ===== \n")
-        print(f"entry block : {entry_b}, serialized_labels : {serialized_labels}")
-
-        def UCE(block):
-            """
-            Unreachable Code Elimination
-            - runs after every simplification, particularly jump threading
-            - all unreachable blocks are safely removed from the CFG
-            """
-            for child_label in block.child:
-                print(f"child label : {child_label}")
-                if child_label not in serialized_labels:
-                    print("Survived", child_label)
-                    # Add current block to schedule
-                    serialized_instrs.extend(self.block[child_label].instrs)
-                    serialized_labels.add(child_label)
-                    UCE(self.block[child_label])
-                    #print("HERE")
-
-        # Start with the block with the entry label
-        UCE(entry_b)
-
-        if f:
-            jmps_to_simplify = []   ## Fall-Through
-            for i in range(len(serialized_instrs) - 1):
-                current_instr = serialized_instrs[i]
-                if current_instr.opcode == 'jmp':
-                    next_instr = serialized_instrs[i + 1]
-                    if next_instr.opcode == 'label' and next_instr.args[0] == current_instr.args[0]:
-                        jmps_to_simplify.append(i)
-
-            if len(jmps_to_simplify) > 0:
-                #put them in right order before deleting
-                jmps_to_simplify.reverse()
-                for i in jmps_to_simplify:
-                    serialized_instrs.pop(i)
-
+        if not f:
+            return [instr for label in self.depth_first_order() for instr in self.block[label].instrs]
+
+        order = self.depth_first_order()
+        if placement:
+            self.split_branches()
+            order = self.layout(self.edge_weights(profile))
+        serialized_instrs = []
+        for label, next_label in zip(order, order[1:] + [None]):
+            instrs = self.block[label].instrs
+            last = instrs[-1]
+            if last.opcode == 'jmp' and last.args[0] == next_label:
+                ## Fall-Through
+                instrs = instrs[:-1]
+            elif (last.opcode == 'jmp' and len(instrs) > 2 and instrs[-2].opcode in negation and
+                  instrs[-2].args[1] == next_label):
+                # jX t, next; jmp L  ->  jnotX t, L, falling through to next
+                cond = instrs[-2]
+                instrs = instrs[:-2] + [Instruction(negation[cond.opcode], [cond.args[0], last.args[0]], None)]
+            serialized_instrs.extend(instrs)
         return serialized_instrs
 
-    def perform_UCE(self):
-        print("One go through perform UCE ========= \n")
-        serialized = self.serialize(False)
-        # for i in serialized:
-        #    print(str(i))
-        
-        self.block_inference(serialized)
-
-    def jump_thread(self):
-
-        def linear_seq_of_blocks(block, current_lin_seq):
-            if len(block.child) == 1:
-                child_label = list(block.child)[0]
-                block = self.block[child_label]
-                if (len(block.parent) == 1):
-                    current_lin_seq += [child_label]
-                    return linear_seq_of_blocks(block, current_lin_seq)
-            return current_lin_seq
-
-        old_labels = set()
-
-        for label, block in self.block.items():
-
-            # Jump Threading: Sequencing Unconditional Jumps
+    def depth_first_order(self):
+        """
+        Labels of the blocks the entry reaches, in preorder of a depth first walk with an explicit stack of the
+        successors left to visit.
+        """
+        def compute():
+            order = [self.entry_label]
+            seen = {self.entry_label}
+            stack = [iter(self.block[self.entry_label].child)]
+            while stack:
+                for child_label in stack[-1]:
+                    if child_label not in seen:
+                        order.append(child_label)
+                        seen.add(child_label)
+                        stack.append(iter(self.block[child_label].child))
+                        break
+                else:
+                    stack.pop()
+            return order
+        return self.analysis('depth_first_order', compute)
 
-            cond_jumps = {'je', 'jnz', 'jl', 'jle', 'jnl', 'jnle'}
+    def split_branches(self):
+        """
+        Splits the blocks the entry reaches after their conditional jumps, but one just before the final jmp, so that
+        layout may make any branch fall through: the instructions after the jump go to a new block reached by a jmp,
+        the first successor of the block, which keeps following it unless the layout finds better.
+        """
+        for label in self.depth_first_order():
+            instrs = self.block[label].instrs
+            cuts = [i + 1 for i, instr in enumerate(instrs[:-2]) if instr.opcode in dataflow.jumps]
+            if not cuts:
+                continue
+            for c_label, jumps in list(self.block[label].child.items()):
+                for _ in range(jumps):
+                    self.remove_edge(label, c_label)
+            labels = [label]
+            for k in range(1, len(cuts) + 1):
+                new_label = f'{label}_{k}'
+                while new_label in self.block:
+                    new_label += '_'
+                labels.append(new_label)
+            pieces = [instrs[start:end] for start, end in zip([0] + cuts, cuts + [len(instrs)])]
+            for k, piece in enumerate(pieces):
+                if k + 1 < len(pieces):
+                    piece.append(Instruction('jmp', [labels[k + 1]], None))
+                if k:
+                    self.add_block([Instruction('label', [labels[k]], None)] + piece)
+                else:
+                    self.block[label].instrs = piece
+            for k, piece_label in enumerate(labels):
+                piece = self.block[piece_label].instrs
+                if k + 1 < len(labels):
+                    self.add_edge(piece_label, labels[k + 1])
+                    piece = piece[:-1]
+                for instr in piece:
+                    if jump_target(instr) is not None:
+                        self.add_edge(piece_label, jump_target(instr))
+
+    def edge_weights(self, profile=None):
+        """
+        Expected number of executions of the edges (source, target) between the blocks the entry reaches: their
+        counts in profile ((source, target) -> count, see read_profile) when given, otherwise a static estimate. A
+        block in k nested loops runs 10 ** k times, shared among its successors; an edge leaving the innermost loop of
+        its source is cold and gets a tenth of its share, so that the back edges and the rest of the loop are hot.
+        """
+        labels = self.reverse_postorder()
+        if profile is not None:
+            return {(label, c_label): profile.get((label, c_label), 0)
+                    for label in labels for c_label in self.block[label].child}
+
+        forest = self.loop_forest()
+        depth = {}
+        for h in reversed(forest.headers):
+            depth[h] = 1 if forest.parent[h] is None else depth[forest.parent[h]] + 1
+        weights = {}
+        for label in labels:
+            children = self.block[label].child
+            h = forest.innermost.get(label)
+            share = 10 ** depth.get(h, 0) / len(children) if children else 0
+            for c_label in children:
+                exits = h is not None and c_label not in forest.body[h]
+                weights[(label, c_label)] = share / 10 if exits else share
+        return weights
+
+    def fall_through_targets(self, label):
+        # the successors block label can fall through to: the target of its final jmp, and of a conditional jump
+        # just before it (inverted by serialize)
+        instrs = self.block[label].instrs
+        targets = [jump_target(instrs[-1])] if instrs[-1].opcode == 'jmp' else []
+        if targets and len(instrs) > 2 and instrs[-2].opcode in negation:
+            targets.append(instrs[-2].args[1])
+        return targets
+
+    def layout(self, weights):
+        """
+        Order of the blocks the entry reaches minimizing the jumps taken, after Pettis and Hansen: going through the
+        edges that may become fall-throughs from the heaviest, the chains of blocks falling through to each other are
+        joined when the edge goes from the end of a chain to the start of another one. The chain of the entry comes
+        first, then the chain most tied by weights to the chains placed so far; ties keep the depth first order.
+        """
+        position = {label: i for i, label in enumerate(self.depth_first_order())}
+        chain = {label: [label] for label in position}
+        edges = [(source, target) for source in position for target in self.fall_through_targets(source)
+                 if target != source]
+        edges.sort(key=lambda edge: (-weights[edge], position[edge[0]], position[edge[1]]))
+        for source, target in edges:
+            head, tail = chain[source], chain[target]
+            if head is not tail and head[-1] == source and tail[0] == target and target != self.entry_label:
+                head.extend(tail)
+                for label in tail:
+                    chain[label] = head
+
+        # priority queue of the chains not placed yet: (-weight of their edges with the placed chains, position of
+        # their first block), stale entries being skipped
+        tied = Counter()
+        pending = [(0, position[label], label) for label in position if chain[label][0] == label]
+        heapq.heapify(pending)
+        order = []
+        placed = set()
+        first = self.entry_label
+        while True:
+            for label in chain[first]:
+                order.append(label)
+                placed.add(label)
+            for label in chain[first]:
+                for other in {**self.block[label].child, **self.block[label].parent}:
+                    if other in position and other not in placed:
+                        head = chain[other][0]
+                        tied[head] += weights.get((label, other), 0) + weights.get((other, label), 0)
+                        heapq.heappush(pending, (-tied[head], position[head], head))
+            while pending and (pending[0][2] in placed or -pending[0][0] != tied[pending[0][2]]):
+                heapq.heappop(pending)
+            if not pending:
+                return order
+            first = heapq.heappop(pending)[2]
+
+    def analysis(self, name, compute):
+        # value of compute() for the current edges, computed again only when the version changed since
+        version, value = self.cache.get(name, (None, None))
+        if version != self.version:
+            value = compute()
+            self.cache[name] = (self.version, value)
+        return value
+
+    def reverse_postorder(self):
+        """
+        Labels of the blocks the entry reaches, in reverse postorder of an iterative depth first search.
+        """
+        def compute():
+            order = []
+            seen = {self.entry_label}
+            stack = [(self.entry_label, iter(self.block[self.entry_label].child))]
+            while stack:
+                label, children = stack[-1]
+                for child_label in children:
+                    if child_label not in seen:
+                        seen.add(child_label)
+                        stack.append((child_label, iter(self.block[child_label].child)))
+                        break
+                else:
+                    stack.pop()
+                    order.append(label)
+            order.reverse()
+            return order
+        return self.analysis('reverse_postorder', compute)
+
+    def graph(self):
+        # the reachable blocks numbered for the analyses of ssa
+        return self.analysis('graph', lambda: BlockGraph(self))
+
+    def dominator_tree(self):
+        # ssa.DominatorTree of the reachable blocks, numbered as in graph()
+        return self.analysis('dominator_tree', lambda: ssa.DominatorTree(self.graph()))
+
+    def immediate_dominators(self):
+        """
+        Label of the immediate dominator of every reachable block (None for the entry).
+        """
+        def compute():
+            labels, idom = self.graph().labels, self.dominator_tree().idom
+            return {label: None if idom[b] is None else labels[idom[b]] for b, label in enumerate(labels)}
+        return self.analysis('immediate_dominators', compute)
 
-            lin_seq_of_block_labels = linear_seq_of_blocks(block, [label])[:-1]
+    def dominates(self, a, b):
+        # whether block a dominates block b (both reachable)
+        number = self.graph().number
+        return self.dominator_tree().dominates(number[a], number[b])
 
-            if len(lin_seq_of_block_labels) > 1:
-                modified = True
+    def dominance_frontiers(self):
+        """
+        Dominance frontier of every reachable block: the set of labels of the blocks where its dominance stops.
+        """
+        def compute():
+            labels, frontier = self.graph().labels, self.dominator_tree().frontier
+            return {label: {labels[f] for f in frontier[b]} for b, label in enumerate(labels)}
+        return self.analysis('dominance_frontiers', compute)
 
-                for i in range(len(lin_seq_of_block_labels) - 1):
-                    # Only continue if each of B_2,...,B_{n-2} have empty bodies
-                    blockseq = self.block[lin_seq_of_block_labels[i]].instrs[1:-1]
-                    if len(blockseq) != 0:
-                        modified = False
-                        break
+    def loop_forest(self):
+        """
+        ssa.LoopForest of the reachable blocks, by label: body[header] is the set of labels of the loop of header,
+        parent[header] the header of the loop just around it (or None), innermost[label] the header of the innermost
+        loop of the block, and headers lists the headers from the inner loops outwards.
+        """
+        def compute():
+            labels = self.graph().labels
+            forest = ssa.LoopForest(self.graph(), self.dominator_tree())
+            forest.body = {labels[h]: {labels[b] for b in body} for h, body in forest.body.items()}
+            forest.headers = [labels[h] for h in forest.headers]
+            forest.parent = {labels[h]: None if p is None else labels[p] for h, p in forest.parent.items()}
+            forest.innermost = {labels[b]: labels[h] for b, h in forest.innermost.items()}
+            return forest
+        return self.analysis('loop_forest', compute)
+
+    def add_edge(self, source, target):
+        self.version += 1
+        self.block[source].add_child(target)
+        self.block[target].add_parent(source)
+
+    def remove_edge(self, source, target):
+        # one jump less from source to target
+        self.version += 1
+        block = self.block[source]
+        block.child[target] -= 1
+        if not block.child[target]:
+            del block.child[target]
+            del self.block[target].parent[source]
+
+    def thread(self, block, i):
+        """
+        Final target of the jump block.instrs[i], skipping the empty blocks (a label and a jmp) and the tests of the
+        same condition: the conditional jump taken to a block starting with the same one takes it too, and so does
+        the fall-through of a conditional jump to a block making the same test and jumping on otherwise.
+        """
+        instr = block.instrs[i]
+        target = jump_target(instr)
+        test = instr.args[:1] if instr.opcode != 'jmp' else None
+        previous = block.instrs[i - 1] if instr.opcode == 'jmp' and i > 1 else None
+        seen = {target}
+        while True:
+            instrs = self.block[target].instrs
+            first = instrs[1]
+            if first.opcode == 'jmp':
+                following = first.args[0]
+            elif test is not None and first.opcode == instr.opcode and first.args[:1] == test:
+                following = first.args[1]
+            elif (previous is not None and previous.opcode in dataflow.jumps and len(instrs) == 3
+                  and first.opcode == previous.opcode and first.args[0] == previous.args[0]):
+                following = instrs[2].args[0]
+            else:
+                return target
+            if following in seen:
+                return target
+            seen.add(following)
+            target = following
 
-                # Change the jmp instruction in B1 to point to Bn instead, so that next(B1) = {Bn}
-                if modified:
-                    init_block = self.block[lin_seq_of_block_labels[0]]
-                    init_block.instrs[-1].args[0] = lin_seq_of_block_labels[-1]
-                    # Merge blocks into first_block
-                    for i in lin_seq_of_block_labels[1:-1]:
-                        init_block.merge(self.block[i])
-                        old_labels.add(i)
-
-            # Jump Threading: Turning Conditional into Unconditional Jumps
-
-            for child_label in block.child:
-                cond_temp = None
-                # If there is a conditional jump from block to the child block
-                for i in block.instrs:
-                    if (i.opcode in cond_jumps) and (i.args[1] == child_label):
-                        cond_temp = i.args[0]
-                        cond_jump = i.opcode
-
-                if not cond_temp:
-                    continue
-
-                # Verify that cond_temp isn't modified in the child block
-                modified = False
-                c_block = self.block[child_label]
-                for i in c_block.instrs:
-                    if i.result == cond_temp:
-                        modified = True
-                        break
-                if modified:
-                    continue
-
-                # Verify that a same cond_jump with the same cond_temp is in child block
-                for i in range(len(c_block.instrs) - 1):
-                    if (c_block.instrs[i].opcode == cond_jump) and (c_block.instrs[i].args[0] == cond_temp):
-                        nextlabel = c_block.instrs[i].args[1]
-                        c_block.instrs[i].opcode = 'nop'
-                        if c_block.instrs[i + 1].opcode == 'jmp':
-                            c_block.instrs[i + 1].args[0] = nextlabel
-
-        # Delete blocks after merge
-        for i in old_labels:
-            self.block.pop(i, None)
-
-    def coalesce(self):
+    def resolve(self, block):
         """
-        Coalescing of linear chains of blocks
-        Done after every other CFG simplification phase
+        When block is only reached through conditional jumps on the same test, the same test in block before its
+        temporary is written is known to be taken: it becomes a jmp and the rest of the block is dropped.
         """
-        old_label = None
-        for block in list(self.block.values()):
-            # only 1 child
-            if len(block.child) == 1:
-                child_label = list(block.child)[0]
-                child_block = self.block[child_label]
-                # if the child block has only 1 parent and if it's not the entry block
-                if (len(child_block.parent) == 1) and (child_label != self.entry_label):
-                    # if the end of the parent block is 'jmp'
-                    if block.instrs[-1].opcode == 'jmp':
-                        # delete that last jmp
-                        block.instrs[-1].opcode = 'nop'
-                        # Merge both blocks
-                        block.merge(child_block)
-                        # child label will be deleted
-                        old_label = child_label
-                        break
-        
-        if old_label:
-            self.block.pop(old_label)
-            for block in self.block.values():
-                # delete old labels from the child blocks
-                if old_label in block.child:
-                    block.child.remove(old_label)
-                # delete old labels from the parent blocks
-                if old_label in block.parent:
-                    block.parent.remove(old_label)
-            return (block.label, old_label)
-        else:
+        (source, ) = block.parent
+        source_instrs = self.block[source].instrs
+        if jump_target(source_instrs[-1]) == block.label:
             return False
-
-    def coalescing(self):
-        coalesced = set()
+        tests = {(instr.opcode, instr.args[0]) for instr in source_instrs if jump_target(instr) == block.label}
+        if len(tests) != 1:
+            return False
+        (opcode, temp), = tests
+        for i, instr in enumerate(block.instrs):
+            if instr.opcode == opcode and instr.args[0] == temp:
+                for dropped in block.instrs[i:]:
+                    if jump_target(dropped) is not None:
+                        self.remove_edge(block.label, jump_target(dropped))
+                block.instrs[i:] = [Instruction('jmp', [instr.args[1], None], None)]
+                self.add_edge(block.label, instr.args[1])
+                return True
+            if instr.result == temp:
+                return False
+        return False
+
+    def remove_block(self, label):
+        # removes a block and its edges (the jumps to it are gone)
+        self.version += 1
+        for child_label in self.block[label].child:
+            if child_label in self.block:
+                self.block[child_label].parent.pop(label, None)
+        del self.block[label]
+
+    def merge(self, label, child_label):
+        # coalesces the block child_label into the block label, whose final jmp is the only jump to it
+        self.version += 1
+        child = self.block.pop(child_label)
+        self.block[label].merge(child)
+        for grandchild in child.child:
+            del self.block[grandchild].parent[child_label]
+            self.block[grandchild].add_parent(label)
+
+    def remove_unreachable(self):
+        # removes the blocks (and cycles of blocks) the entry does not reach, returns whether there were any
+        reached = set(self.reverse_postorder())
+        unreached = [label for label in self.block if label not in reached]
+        for label in unreached:
+            self.remove_block(label)
+        return bool(unreached)
+
+    def simplify(self):
+        """
+        Worklist simplification of the CFG, its edges updated in place:
+        1. Unreachable code elimination: the blocks without predecessors (but the entry) are removed
+        2. Jump threading: the jumps to empty blocks and to tests of a known outcome go to their final target
+        3. Coalescing: a block only reached by the final jmp of its predecessor is merged into it
+        A block is simplified again whenever one of these changes its instructions or its edges. Returns whether
+        instructions reading temporaries were removed (more code may be dead).
+        """
+        removed = self.remove_unreachable()
+        # the blocks are first taken in reverse postorder
+        work = list(reversed(self.reverse_postorder()))
+        queued = set(work)
+
+        def push(*labels):
+            for label in labels:
+                if label in self.block and label not in queued:
+                    queued.add(label)
+                    work.append(label)
+
+        while work:
+            label = work.pop()
+            queued.discard(label)
+            block = self.block.get(label)
+            if block is None:
+                continue
+
+            if not block.parent and label != self.entry_label:
+                push(*block.child)
+                self.remove_block(label)
+                removed = True
+                continue
+
+            changed = False
+            if len(block.parent) == 1 and label != self.entry_label and label not in block.parent:
+                changed = self.resolve(block)
+                removed = removed or changed
+            start = 1
+            while True:
+                # the jumps from start on (those merged in after the first round) go to their final targets
+                for i in range(start, len(block.instrs)):
+                    old = jump_target(block.instrs[i])
+                    if old is None:
+                        continue
+                    target = self.thread(block, i)
+                    if target != old:
+                        instr = block.instrs[i]
+                        args = [target, None] if instr.opcode == 'jmp' else [instr.args[0], target]
+                        block.instrs[i] = Instruction(instr.opcode, args, None)
+                        self.remove_edge(label, old)
+                        self.add_edge(label, target)
+                        push(old, target)
+                        changed = True
+                # a conditional jump to the target of the final jmp is useless
+                while (len(block.instrs) > 2 and block.instrs[-2].opcode in dataflow.jumps
+                       and block.instrs[-2].args[1] == jump_target(block.instrs[-1])):
+                    self.remove_edge(label, block.instrs[-2].args[1])
+                    del block.instrs[-2]
+                    changed = removed = True
+
+                last = block.instrs[-1]
+                if last.opcode != 'jmp' or last.args[0] in (label, self.entry_label):
+                    break
+                child = self.block[last.args[0]]
+                if len(child.parent) != 1 or block.child[child.label] != 1:
+                    break
+                start = len(block.instrs) - 1
+                self.merge(label, child.label)
+                changed = True
+
+            if changed:
+                push(*block.child)
+            if len(block.parent) == 1:
+                # the only predecessor may now merge with block
+                push(*block.parent)
+            if len(block.instrs) == 2 and block.instrs[1].opcode == 'jmp':
+                # an empty block: its predecessors may jump past it
+                push(*block.parent)
+        return removed
+
+    def dead_code_elimination(self):
+        """
+        Dead code elimination: removes the pure instructions whose result is not live, until there are none left.
+        Returns the number of instructions removed.
+        """
+        removed = 0
         while True:
-            now_coalescing = self.coalesce()
-            self.perform_UCE()
-            #dead code cleaned
-            if now_coalescing and (now_coalescing not in coalesced):
-                coalesced.add(now_coalescing)
-            else:
-                break
+            graph = dataflow.FlowGraph.from_cfg(self)
+            live = dataflow.Liveness(graph)
+            dead = set()
+            for b, block in enumerate(graph.blocks):
+                # walking the block backward, the instructions that only feed dead ones are dead too
+                alive = live.temps.decode(live.live_out[b])
+                for i, instr in reversed(block):
+                    uses, defs = live.uses_defs[i]
+                    if instr.opcode in removable and defs and defs[0] not in alive:
+                        dead.add(id(instr))
+                        continue
+                    alive.difference_update(defs)
+                    alive.update(uses)
+            if not dead:
+                return removed
+            for block in self.block.values():
+                block.instrs = [instr for instr in block.instrs if id(instr) not in dead]
+            removed += len(dead)
 
-    def control_flow_optimization(self):
+    def control_flow_optimization(self, dce=True):
         """
-        1. Jump threading (conditional & unconditional)
-        2. UCE
-        3. Coalescing
+        1. Simplification (unreachable code elimination, jump threading and coalescing, see simplify)
+        2. Dead code elimination: blocks may become empty, so they are simplified again, and the simplification
+           may remove the last uses of temporaries: both are repeated until they remove nothing
         """
-        self.jump_thread()
-        print("\n\n\n\t\t\tERROR ENTRY POINT !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n\n\n\n\n\n\n")
-        print("current state of block : ", self.block)
-        self.perform_UCE()
-        self.coalescing()
-        #print("FINISHED CF optimization")
+        self.simplify()
+        while dce and self.dead_code_elimination() and self.simplify():
+            pass
 
 
 #-------------------------------------------------------------------------------
 #COMPLETE LOADING FILE
 
 import bx2tac
+import ssa
+import ssa_opt
+
+
+def optimize_proc(proc, dump_ssa=False, passes=None, dce=True, profile=None, layout=True):
+    """
+    SSA optimizations (by default those of -O1 in ssa_opt.passes) then control flow optimization of one procedure
+    (bx2tac.Procedure), returns the optimized Procedure. The UCE of the control flow optimization removes the
+    branches the SSA optimizations found dead. dump_ssa prints the SSA form of the procedure, dce=False leaves the
+    dead code. The blocks are laid out from the edge counts of profile (see read_profile) or static estimates,
+    layout=False keeps them in depth first order.
+    """
+    proc = ssa.optimize(proc, ssa_opt.passes[1] if passes is None else passes, dump_ssa)
+    tac = []
+    for instr in proc.body:
+        arg1 = None
+        arg2 = None
+        if (len(instr.args) == 1):
+            arg1 = instr.args[0]
+        elif (len(instr.args) == 2):
+            arg1 = instr.args[0]
+            arg2 = instr.args[1]
+        tac.append(bx2tac.Instruction(instr.opcode, [arg1, arg2], instr.result))
+
+    body = []
+    #If procedure body is empty there is nothing to optimize
+    if tac != []:
+        start = time.perf_counter()
+        cfg = CFG(tac, proc.name)
+        cfg.control_flow_optimization(dce)
+        body = cfg.serialize(True, profile, layout)
+        ssa.timings['control_flow_optimization'] += time.perf_counter() - start
+    return bx2tac.Procedure(proc.name[1:], proc.args, body)
+
+
+def optimize_program(procs, dump_ssa=False, passes=None, dce=True, profile=None, layout=True):
+    # profile: the edge counts of every procedure, as read_profile returns them
+    return [optimize_proc(proc, dump_ssa, passes, dce, None if profile is None else profile.get(proc.name, Counter()),
+                          layout)
+            for proc in procs]
+
+
+def profile_of(branches):
+    """
+    Edge counts of the layout from the branches counted by a run: (procedure, source, target, kind) -> count, as
+    written by the code of tac2x64 --count-branches or counted by tac_interp. Returns procedure -> Counter of
+    (source, target), summed over the kinds.
+    """
+    profile = {}
+    for (proc, source, target, _), count in branches.items():
+        profile.setdefault(proc, Counter())[(source, target)] += count
+    return profile
+
+
+def read_profile(filename):
+    # edge counts of the runs of programs compiled with bxcc --count-branches, from the lines "procedure source
+    # target kind count" they appended to filename (see tac2x64.branch_counters); ValueError on any other line
+    branches = Counter()
+    with open(filename) as fp:
+        for lineno, line in enumerate(fp, 1):
+            fields = line.split()
+            if len(fields) != 5 or not fields[4].isdigit():
+                raise ValueError(f'line {lineno}: expected "procedure source target kind count"')
+            proc, source, target, kind, count = fields
+            branches[(proc, source, target, kind)] += int(count)
+    return profile_of(branches)
 
 
 def optimization(filename):
-    gvars = []
-    procs = []
     with open(filename, 'r') as fp:
         js_obj = json.load(fp)
-
-    for decl in js_obj:
-        #print(decl)
-        if "proc" in decl:
-            tac = []
-            for line in decl["body"]: 
-                #print("LINE:", line, "\n")
-                arg1 = None
-                arg2 = None
-                if (len(line["args"]) == 1):
-                    arg1 = line["args"][0]
-                    #print(arg1)
-                elif (len(line["args"]) == 2):
-                    arg1 = line["args"][0]
-                    arg2 = line["args"][1]
-                    #print(arg1)
-                    #print(arg2)
-                tac.append(bx2tac.Instruction(line["opcode"], [arg1, arg2], line["result"]))
-
-            #print(f"CFG PRINTING, tac = {tac}")
-            if tac != []:
-                cfg = CFG(tac, decl["proc"])
-                #print(cfg, "!!!!!!!!!!!!!!!!!!!!!!!!")
-                print("\n\n\n\t\t\t\t\t\t\t\t\t\tERROR OCCURES IN THIS CFG ", decl["proc"])
-                print(tac)
-                cfg.control_flow_optimization()
-                proc_instrs = cfg.serialize()
-                body = []
-                for instr in proc_instrs:
-                    body.append(instr.js_obj)
-                procs.append({"proc": decl["proc"], "args": decl["args"], "body": body})
-            else:
-                pass
-                #If procedure body is empty
-                arg1, arg2 = None, None
-                body = []
-                procs.append({"proc": decl["proc"], "args": decl["args"], "body": body})
-
-
-        elif "var" in decl:
-            #result.append(AST.VarDecl(None, decl["var"], decl["init"], None))
-            gvars.append(decl)
+    gvars, procs = bx2tac.tac_from_json(js_obj)
+    procs = optimize_program(procs)
 
     # Write to file
-    #print("Optimization done - Writing file")
-    all = gvars+procs
-    with open(f'{filename[:-9]}.optimized_tac.json', 'w') as tac_file:
-        json.dump(all, tac_file)
-
-    # for decl in all:
-    #     print(decl)
-
-    #print(f'[[ Output {filename[:-9]}.optimized_tac.json ]]')
     tac_name = f'{filename[:-9]}.optimized_tac.json'
-    return tac_name
+    return bx2tac.write_tac(tac_name, gvars, procs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,123 @@
+"""
+Inlining of TAC procedures (bx2tac.Procedure), before their optimization (tac_cfopt): a call to a small procedure
+is replaced by a copy of its body, its temporaries and labels renamed apart from those of the caller. The
+procedures are inlined bottom up on the call graph, so that a callee is inlined with its own calls already
+inlined; the calls within a cycle of the call graph (recursion) are kept.
+"""
+import re
+from collections import Counter
+
+from bx2tac import Instruction, Procedure
+from dataflow import is_temp, strongly_connected
+
+# Largest callee (in instructions, its own calls inlined) inlined at each optimization level (-O)
+budgets = {
+    0: 0,
+    1: 40,
+    2: 40,
+}
+
+# Calls inlined, and recursive callees kept, since the start (or the last stats.clear())
+stats = Counter()
+
+
+def call_graph(procs):
+    # callees[p]: the procedures (indices in procs) called by procs[p]; the runtime functions are not procedures
+    index = {proc.name: p for p, proc in enumerate(procs)}
+    return [sorted({index[instr.args[0]] for instr in proc.body if instr.opcode == 'call' and instr.args[0] in index})
+            for proc in procs]
+
+
+def size(proc):
+    return sum(1 for instr in proc.body if instr.opcode not in ('label', 'nop'))
+
+
+def fresh_tags(proc):
+    # tags in<k>_ not starting any temporary (%in<k>_...) or label (%.Lin<k>_...) of proc
+    used = [int(k) for instr in proc.body for arg in instr.args + [instr.result] if isinstance(arg, str)
+            for k in re.findall(r'^%(?:\.L)?in(\d+)_', arg)]
+    k = max(used, default=-1) + 1
+    while True:
+        yield f'in{k}_'
+        k += 1
+
+
+def expand(callee, args, result, tag):
+    """
+    Instructions replacing a call to callee with the arguments args, writing result (None or %_ when the value is
+    discarded): copies of the arguments to the parameters, then the body, its returns jumping to the end.
+    """
+    def rename(arg):
+        if is_temp(arg):
+            return f'%{tag}{arg[1:]}'
+        if isinstance(arg, str) and arg.startswith('%.L'):
+            return f'%.L{tag}{arg[3:]}'
+        return arg
+
+    end = f'%.L{tag}end'
+    wanted = result not in (None, '%_')
+    code = [Instruction('copy', [arg, None], rename(param)) for param, arg in zip(callee.args, args)]
+    for instr in callee.body:
+        if instr.opcode != 'ret':
+            code.append(Instruction(instr.opcode, [rename(arg) for arg in instr.args], rename(instr.result)))
+            continue
+        # as in tac2x64, a ret without a value returns 0
+        if wanted and instr.args and instr.args[0] is not None:
+            code.append(Instruction('copy', [rename(instr.args[0]), None], result))
+        elif wanted:
+            code.append(Instruction('const', [0, None], result))
+        code.append(Instruction('jmp', [end, None], None))
+    if wanted:
+        code.append(Instruction('const', [0, None], result))
+    code.append(Instruction('label', [end, None], None))
+    return code
+
+
+def inline_calls(proc, callees):
+    """
+    Copy of proc where the calls to the procedures of callees (name -> Procedure) are replaced by their body. The
+    param instructions of a call come after the evaluation of its arguments, which may call other procedures: a
+    call is only inlined when all its param instructions follow the previous call.
+    """
+    tags = fresh_tags(proc)
+    body = []
+    pending = {}    # parameter number -> position of its param instruction in body
+    for instr in proc.body:
+        if instr.opcode == 'param':
+            pending[instr.args[0]] = len(body)
+        elif instr.opcode == 'call':
+            callee = callees.get(instr.args[0])
+            n = instr.args[1]
+            if callee is not None and n == len(callee.args) and all(k in pending for k in range(1, n + 1)):
+                args = [body[pending[k]].args[1] for k in range(1, n + 1)]
+                for k in range(1, n + 1):
+                    body[pending[k]] = None
+                body.extend(expand(callee, args, instr.result, next(tags)))
+                stats['calls inlined'] += 1
+                pending = {}
+                continue
+            pending = {}
+        body.append(instr)
+    return Procedure(proc.name[1:], list(proc.args), [instr for instr in body if instr is not None])
+
+
+def inline_program(procs, budget):
+    """
+    The procedures of a program where the calls to procedures of at most budget instructions are inlined (none
+    when budget is 0), the recursive calls excepted.
+    """
+    if not budget:
+        return procs
+    callees = call_graph(procs)
+    component = strongly_connected(callees)
+    done = {}
+    # the edges of the call graph go to higher components: the callees are done first
+    for p in sorted(range(len(procs)), key=lambda p: -component[p]):
+        small = {}
+        for c in callees[p]:
+            if component[c] == component[p]:
+                stats['recursive callees kept'] += 1
+            elif size(done[procs[c].name]) <= budget:
+                small[procs[c].name] = done[procs[c].name]
+        done[procs[p].name] = inline_calls(procs[p], small) if small else procs[p]
+    return [done[proc.name] for proc in procs]
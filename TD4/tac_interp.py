@@ -0,0 +1,121 @@
+"""
+Interpreter of TAC programs (bx2tac GlobalVar and Procedure objects) with the semantics of the assembly of tac2x64:
+64 bit arithmetic, the division of idivq, ret without a value returning 0, and the print functions of bx_runtime.c.
+It counts the instructions executed, to measure the optimizations (bench.py) and to check that they keep the
+behaviour of the programs (test.py).
+"""
+from collections import Counter
+
+from ssa_opt import fold, taken
+
+# Functions of bx_runtime.c: the line printed for their argument
+runtime = {
+    '@__bx_print_int': str,
+    '@__bx_print_bool': lambda b: 'false' if b == 0 else 'true',
+}
+
+
+class TACError(Exception):
+    """
+    The program divides by zero, reads a temporary never written, misses a param instruction, or runs longer than
+    the limit.
+    """
+
+
+def run(gvars, procs, limit=10 ** 7, branches=None):
+    """
+    Runs the procedure @main of a TAC program. Returns the lines it prints and the number of instructions executed
+    for every opcode (labels and nops are not counted: they are not instructions of the assembly). A Counter
+    branches receives the branches of the run as the code compiled with bxcc --count-branches counts them: (procedure,
+    source, target, kind) for the jmps (jump), the conditional jumps taken (branch) and the fall-throughs into a
+    label (fall), source being the last label passed.
+    """
+    memory = {gvar.var: gvar.init for gvar in gvars}
+    code = {proc.name: (proc, {instr.args[0]: i for i, instr in enumerate(proc.body) if instr.opcode == 'label'})
+            for proc in procs}
+    output = []
+    counts = Counter()
+    steps = 0
+    stack = []      # callers: (procedure, labels, temporaries, next instruction, temporary receiving the result,
+                    #           last label passed)
+    params = {}
+    proc, labels = code['@main']
+    body, temps, pc = proc.body, {}, 0
+    source, falls = '-', True
+
+    def read(arg):
+        if isinstance(arg, int):
+            return arg
+        if arg.startswith('@'):
+            return memory[arg]
+        if arg not in temps:
+            raise TACError(f'{arg} read before it is written')
+        return temps[arg]
+
+    while True:
+        if pc == len(body):
+            instr = None
+        else:
+            instr = body[pc]
+            pc += 1
+            if instr.opcode == 'label' and branches is not None:
+                if falls and pc > 1:
+                    branches[(proc.name, source, instr.args[0], 'fall')] += 1
+                source, falls = instr.args[0], True
+            if instr.opcode in ('label', 'nop'):
+                continue
+            counts[instr.opcode] += 1
+            steps += 1
+            if steps > limit:
+                raise TACError(f'more than {limit} instructions executed')
+        if instr is None or instr.opcode == 'ret':
+            # end of the procedure
+            value = read(instr.args[0]) if instr is not None and instr.args and instr.args[0] is not None else 0
+            if not stack:
+                return output, counts
+            proc, labels, temps, pc, result, source = stack.pop()
+            body, falls = proc.body, True
+            if result not in (None, '%_'):
+                temps[result] = value
+            continue
+
+        opcode, args = instr.opcode, [arg for arg in instr.args if arg is not None]
+        if opcode == 'jmp':
+            pc = labels[args[0]]
+            if branches is not None:
+                branches[(proc.name, source, args[0], 'jump')] += 1
+                falls = False
+        elif opcode in taken:
+            if taken[opcode](read(args[0])):
+                pc = labels[args[1]]
+                if branches is not None:
+                    branches[(proc.name, source, args[1], 'branch')] += 1
+                    falls = False
+        elif opcode == 'param':
+            params[args[0]] = read(args[1])
+        elif opcode == 'call':
+            if any(k not in params for k in range(1, args[1] + 1)):
+                # a call in the arguments of another one came between its param instructions
+                raise TACError(f'call {args[0]} without its {args[1]} param instructions')
+            values = [params[k] for k in range(1, args[1] + 1)]
+            params = {}
+            if args[0] in runtime:
+                output.append(runtime[args[0]](*values))
+                continue
+            stack.append((proc, labels, temps, pc, instr.result, source))
+            proc, labels = code[args[0]]
+            body, temps, pc = proc.body, dict(zip(proc.args, values)), 0
+            source, falls = '-', True
+        else:
+            if opcode == 'const':
+                value = args[0]
+            elif opcode == 'copy':
+                value = read(args[0])
+            else:
+                value = fold[opcode](*[read(arg) for arg in args])
+                if value is None:
+                    raise TACError(f'{opcode} traps')
+            if instr.result.startswith('@'):
+                memory[instr.result] = value
+            else:
+                temps[instr.result] = value
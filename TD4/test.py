@@ -0,0 +1,1079 @@
+"""
+Checks of the compiler passes that do not need gcc.
+Usage: python3 test.py
+"""
+import contextlib
+import io
+import json
+import re
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+from pathlib import Path
+
+from lex_pars import Lexer, FastLexer, Parser, Source, Diagnostics, TooManyErrors
+import lex_pars
+from bx2front import Reader
+from proc_cache import ProcCache
+from bx2tac import bx_to_tac
+from tac_cfopt import optimize_program
+import AST
+import bx2tac
+import tac_cfopt
+import regalloc
+import dataflow
+import ssa
+import ssa_opt
+import tac_inline
+import tac_interp
+
+
+def bx_files():
+    # Every .bx file of the repository (all the labs, examples and regressions)
+    return sorted(Path(__file__).resolve().parent.parent.rglob('*.bx'))
+
+
+def tokens_of(lexer_class, fn, data):
+    """
+    Token stream (type, value, lineno, lexpos) produced by a lexer engine, and what it printed on the way.
+    """
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        lexer = lexer_class(str(fn), data)
+        toks = []
+        while True:
+            t = lexer.lexer.token()
+            if t is None:
+                break
+            toks.append((t.type, t.value, t.lineno, t.lexpos))
+    return toks, out.getvalue()
+
+
+def test_fast_lexer():
+    """
+    FastLexer and the PLY lexer agree on every .bx file, including the error messages of the regressions.
+    """
+    files = bx_files()
+    edge_cases = ['', '//', 'x//c', '007 0x1 1a', 'a\r\nb', '<<=>>=!==&&&|||', '\n\n// c\n\t\v\fx',
+                  '99999999999999999999 $ #']
+    cases = [(fn, fn.read_text()) for fn in files] + [(f'<case {i}>', d) for i, d in enumerate(edge_cases)]
+    for fn, data in cases:
+        assert tokens_of(Lexer, fn, data) == tokens_of(FastLexer, fn, data), fn
+    print(f'fast lexer: {len(cases)} sources OK')
+
+
+def test_locate():
+    """
+    Source.locate (bisection in the newline index) agrees with counting newlines and searching backward, and a
+    type error in a binary operation is located at its operator.
+    """
+    for fn in bx_files():
+        data = fn.read_text()
+        source = Source(str(fn), data)
+        for lexpos in range(len(data) + 1):
+            expected = (data.count('\n', 0, lexpos) + 1, lexpos - data.rfind('\n', 0, lexpos))
+            assert source.locate(lexpos) == expected, (fn, lexpos)
+
+    # an operator is located at its token, even when its operands are expressions
+    program = 'def main() {\n    var z = 1 : int;\n\n    print((z) +\n          true);\n}\n'
+    diag = Diagnostics()
+    Reader('<locate>', program).read().type_check([], diag)
+    assert [sloc.position() for sloc, _ in diag.errors] == [(4, 15)], diag.errors
+    print('locate: OK')
+
+
+def test_diagnostics():
+    """
+    The type checker collects the independent errors of different procedures, each at its own line; max_errors
+    stops it with TooManyErrors, and report prints every error and their count. Lexing and parsing errors go to the
+    same report, without the errors the type checker would find in the broken AST.
+    """
+    program = """
+var g = true : int;
+def f(x : int) {
+    x = true;
+}
+def h() : int {
+    var b = 1 : bool;
+    return 0;
+}
+def main() {
+    while (1) { }
+}
+"""
+    ast = Reader('<diagnostics>', program).read()
+    diag = Diagnostics()
+    ast.type_check([], diag)
+    assert [sloc.position()[0] for sloc, _ in diag.errors] == [2, 4, 7, 11], diag.errors
+    assert all(sloc.source.provenance == '<diagnostics>' for sloc, _ in diag.errors)
+
+    capped = Diagnostics(2)
+    try:
+        Reader('<diagnostics>', program).read().type_check([], capped)
+        assert False, 'no TooManyErrors'
+    except TooManyErrors:
+        pass
+    assert len(capped.errors) == 2
+
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        diag.report()
+        capped.report()
+    lines = out.getvalue().splitlines()
+    assert '4 error(s)' in lines and '2 error(s) (limit reached)' in lines, lines
+    assert sum(line.startswith('ERROR ') for line in lines) == 6 and 'Line:7.Column:5:' in lines, lines
+
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        try:
+            Reader('<diagnostics>', 'def main() {\n    x = $;\n}\n').read_checked()
+            assert False, 'no SystemExit'
+        except SystemExit:
+            pass
+    lines = out.getvalue().splitlines()
+    assert lines[-1] == '2 error(s)' and not any('main' in line for line in lines), lines
+    print('diagnostics: OK')
+
+
+def ast_tree(node):
+    # nested tuples of an AST: the class, the fields and the location (provenance, line, position) of every node
+    if isinstance(node, list):
+        return [ast_tree(child) for child in node]
+    if isinstance(node, AST.Node):
+        sloc = node.sloc
+        fields = sorted((name, ast_tree(value)) for name, value in vars(node).items() if name != 'sloc')
+        return type(node).__name__, fields, (sloc.source.provenance, sloc.lineno, sloc.lexpos)
+    return node
+
+
+def test_parser_tables():
+    """
+    The LALR tables of the parser are generated by yacc on a cold build and written to parsetab_<signature>.json;
+    a new process loads them without yacc and parses identically. A corrupted file, or one of another signature, is
+    ignored and rewritten, and the tables of older grammars are removed.
+    """
+    data = """
+var g = 3 : int;
+def f(x : int) : bool { return x > g && !(x == 0); }
+def main() {
+    var i = -2 : int;
+    while (i < 10) { if (f(i)) { print(i * (i + 1) << 1); } else { i = i + 1; continue; } i = i + 2; }
+}
+"""
+    saved = Parser.cache_dir, Parser.tables, lex_pars.yacc.yacc
+    generated = []
+
+    def yacc(*args, **kwargs):
+        generated.append(args)
+        return saved[2](*args, **kwargs)
+
+    def build():
+        # AST of data, read by a parser built as a new process builds it: nothing in the process cache
+        Parser.tables = {}
+        with contextlib.redirect_stderr(io.StringIO()):
+            return ast_tree(Parser(Lexer('<tables>', data)).parse())
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            Parser.cache_dir = tmp
+            lex_pars.yacc.yacc = yacc
+            path = Path(Parser.table_path(Parser.signature()))
+            Path(tmp, 'parsetab_0123456789abcdef.json').write_text('{}')
+            expected = build()
+            assert path.exists() and len(generated) == 1
+            assert [fn.name for fn in Path(tmp).glob('parsetab_*')] == [path.name]
+            assert build() == expected and len(generated) == 1
+            other = json.dumps(dict(json.loads(path.read_text()), signature='0' * 64))
+            for stale in ('{"signature": "', other):
+                path.write_text(stale)
+                generated.clear()
+                assert build() == expected and len(generated) == 1
+                assert json.loads(path.read_text())['signature'] == Parser.signature()
+    finally:
+        Parser.cache_dir, Parser.tables, lex_pars.yacc.yacc = saved
+    print('parser tables: OK')
+
+
+def parsed(parser):
+    # AST tree read by a parser, and the errors it printed on the way
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        ast = parser.parse()
+    return ast_tree(ast), out.getvalue()
+
+
+def test_shared_parser():
+    """
+    The process-wide parser, reset for every source, reads the same AST (located in the right source) and reports
+    the same errors as a parser built for that source alone, with both lexer engines, even after a syntax error.
+    """
+    broken = 'def main() {\n    var x = (1 + : int;\n    print(x;\n}\n'
+    valid = 'def main() {\n    var x = 1 : int;\n    print(x + 2);\n}\n'
+    cases = [(str(fn), fn.read_text()) for fn in bx_files()] + [('<broken>', broken), ('<valid>', valid)]
+    saved = Parser.lexer_class
+    try:
+        for lexer_class in lex_pars.lexers.values():
+            Parser.lexer_class = lexer_class
+            for provenance, data in cases:
+                expected = parsed(Parser(lexer_class(provenance, data)))
+                assert parsed(Parser.shared(provenance, data)) == expected, (lexer_class, provenance)
+            assert 'ERROR' in parsed(Parser.shared('<broken>', broken))[1]
+            tree, errors = parsed(Parser.shared('<valid>', valid))
+            assert tree[2][0] == '<valid>' and not errors
+    finally:
+        Parser.lexer_class = saved
+    print(f'shared parser: {len(cases)} sources OK')
+
+
+def read_file(fn, stream):
+    """
+    Tokens of the file fn read by a Reader in (or out of) streaming mode, its TAC (None if it does not compile) and
+    what the compilation printed.
+    """
+    toks = []
+    with Reader.from_file(fn, stream) as reader, contextlib.redirect_stdout(io.StringIO()):
+        for t in iter(reader.lexer.lexer.token, None):
+            toks.append((t.type, t.value, t.lineno, t.lexpos))
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        try:
+            tac = bx2tac.tac_to_json(*bx_to_tac(fn, stream))
+        except SystemExit:
+            tac = None
+    # the messages may show the AST nodes, whose addresses differ from one reading to the other
+    return toks, tac, re.sub(' at 0x[0-9a-f]+', '', out.getvalue())
+
+
+def test_stream():
+    """
+    A memory mapped source reads as the same tokens and compiles to the same TAC (or the same errors) as the file
+    read in memory, and its error messages show the offending line. The mapping is closed once the file is read,
+    even when the lexer stopped in the middle of it.
+    """
+    files = bx_files()
+    for fn in files:
+        assert read_file(str(fn), True) == read_file(str(fn), False), fn
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = str(Path(tmp, 'error.bx'))
+        Path(fn).write_text('def main() {\n    var x = 1 : int;\n    print(x + true);\n}\n')
+        _, tac, out = read_file(fn, True)
+        assert tac is None and '    print(x + true);\n            ^' in out and 'Line:3.Column:13:' in out, out
+
+        with Reader.from_file(fn, True) as reader:
+            assert reader.lexer.token().type == 'DEF'
+        assert reader.data.closed
+        if Path('/proc/self/maps').exists():
+            read_file(fn, True)
+            assert fn not in Path('/proc/self/maps').read_text()
+    print(f'stream: {len(files)} sources OK')
+
+
+def bxcc(*args):
+    # Run the compiler driver in its own process
+    return subprocess.run([sys.executable, 'bxcc.py', *args], cwd=Path(__file__).resolve().parent,
+                          capture_output=True, text=True)
+
+
+def test_tac_json():
+    """
+    tac_from_json reads back what tac_to_json writes, before and after optimization. bxcc keeps the TAC in memory:
+    the tac.json files are only written with --keep_tac (both) or --stop_tac (the optimized one), with and without
+    the procedure cache.
+    """
+    programs = 0
+    for fn in bx_files():
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                gvars, procs = bx_to_tac(str(fn))
+        except SystemExit:
+            continue
+        for tac in (procs, optimize_program(procs)):
+            js_obj = bx2tac.tac_to_json(gvars, tac)
+            assert bx2tac.tac_to_json(*bx2tac.tac_from_json(json.loads(json.dumps(js_obj)))) == js_obj, fn
+        programs += 1
+
+    program = 'var g = 2 : int;\ndef main() {\n    print(g * 21);\n}\n'
+    expected = {(): {'p.s'},
+                ('--keep_tac',): {'p.s', 'p.tac.json', 'p.optimized_tac.json'},
+                ('--stop_tac',): {'p.optimized_tac.json'}}
+    for flags, outputs in expected.items():
+        for cached in (False, True):
+            with tempfile.TemporaryDirectory() as tmp:
+                fn = Path(tmp, 'p.bx')
+                fn.write_text(program)
+                args = [str(fn), '--stop_asm', *flags] + (['--cache-dir', str(Path(tmp, 'cache'))] if cached else [])
+                assert bxcc(*args).returncode == 0, args
+                written = {f.name for f in Path(tmp).iterdir() if f.is_file()} - {'p.bx'}
+                assert written == outputs, (args, written)
+    print(f'tac json: {programs} programs OK')
+
+
+def test_parallel_build():
+    """
+    A build over two processes reports the files in command line order, the errors of the failing file under its
+    name only, and still produces the assembly of the other files.
+    """
+    programs = {'a': 'def main() {\n    print(1);\n}\n',
+                'b': 'def main() {\n    print(2 + true);\n}\n',
+                'c': 'def f(x : int) : int {\n    return x * x;\n}\ndef main() {\n    print(f(3));\n}\n',
+                'd': 'var g = 4 : int;\ndef main() {\n    g = g - 1;\n    print(g);\n}\n'}
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for name, program in programs.items():
+            files.append(str(Path(tmp, f'{name}.bx')))
+            Path(files[-1]).write_text(program)
+        runs = [bxcc('-j', '2', '--stop_asm', *files) for _ in range(2)]
+        assert all(run.returncode == 1 for run in runs)
+        assert runs[0].stdout == runs[1].stdout, (runs[0].stdout, runs[1].stdout)
+        lines = runs[0].stdout.splitlines()
+        assert lines[0] == f'{files[1]}: FAILED' and lines[-1] == '3 of 4 files compiled, 1 failed', lines
+        assert all(line.startswith('    ') for line in lines[1:-1]), lines
+        # the snippet keeps its indentation, the caret stays under the operator
+        assert lines[1:4] == ['        print(2 + true);', ' ' * 16 + '^', '    Line:2.Column:13:'], lines
+        assert sorted(f.name for f in Path(tmp).glob('*.s')) == ['a.s', 'c.s', 'd.s']
+    print('parallel build: OK')
+
+
+def test_proc_cache():
+    """
+    A procedure key changes with its own text and with the signatures of what it uses, not with other procedures.
+    """
+    program = """
+var g = 0 : int;
+def f(n : int) { g = g + n; }
+def h() { print(1); }
+def main() { f(2); h(); }
+"""
+    def keys(data):
+        ast = Reader('<cache>', data).read_checked()
+        gvar_types = {decl.var.name: str(decl.type) for decl in ast.global_vars}
+        proc_sigs = {proc.name: proc.signature for proc in ast.procs}
+        return {proc.name: cache.key(proc, gvar_types, proc_sigs) for proc in ast.procs}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ProcCache(tmp)
+        base = keys(program)
+        edited = keys(program.replace('print(1)', 'print(2)'))
+        assert [name for name in base if base[name] != edited[name]] == ['h']
+        retyped = keys(program.replace('var g = 0 : int;', 'var g = 0 : int; var z = true : bool;'))
+        assert retyped == base
+        moved = keys('\n\n' + program)
+        assert moved == base
+        signature = keys(program.replace('def f(n : int)', 'def f(n, m : int)').replace('f(2)', 'f(2, 3)'))
+        assert signature['h'] == base['h'] and signature['main'] != base['main']
+    print('proc cache: OK')
+
+
+def compiled_procs():
+    """
+    Optimized TAC procedures of every .bx file of the repository that compiles.
+    """
+    procs = []
+    for fn in bx_files():
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                procs.extend(optimize_program(bx_to_tac(str(fn))[1]))
+        except (SystemExit, Exception):
+            continue
+    return procs
+
+
+def instruction_successors(body):
+    labels = {instr.args[0]: i for i, instr in enumerate(body) if instr.opcode == 'label'}
+    succs = []
+    for i, instr in enumerate(body):
+        if instr.opcode == 'jmp':
+            succs.append([labels[instr.args[0]]])
+        elif instr.opcode == 'ret':
+            succs.append([])
+        elif instr.opcode in dataflow.jumps:
+            succs.append([labels[instr.args[1]]] + ([i + 1] if i + 1 < len(body) else []))
+        else:
+            succs.append([i + 1] if i + 1 < len(body) else [])
+    return succs
+
+
+def naive_dataflow(body, transfer, forward, union, boundary, top):
+    """
+    Reference solution of a dataflow problem, with sets, one instruction at a time, iterated to the fixpoint.
+    Returns the values before every instruction (in execution order).
+    """
+    succs = instruction_successors(body)
+    preds = [[] for _ in body]
+    for i, ss in enumerate(succs):
+        for j in ss:
+            preds[j].append(i)
+    before, after = (preds, succs) if forward else (succs, preds)
+    ins = [set() for _ in body]
+    outs = [set(top) for _ in body]
+    changed = True
+    while changed:
+        changed = False
+        for i in (range(len(body)) if forward else reversed(range(len(body)))):
+            values = [outs[j] for j in before[i]]
+            if not values or (forward and i == 0):
+                value = set(boundary)
+                for v in values:
+                    value = value | v if union else value & v
+            else:
+                value = set.union(*values) if union else set.intersection(*values)
+            ins[i] = value
+            out = transfer(i, body[i], value)
+            if out != outs[i]:
+                outs[i] = out
+                changed = True
+    return ins if forward else outs
+
+
+def test_dataflow():
+    """
+    The bit vector analyses (per block) agree with naive per instruction analyses on every procedure, before and
+    after the control flow optimization.
+    """
+    procs = compiled_procs()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for fn in bx_files():
+            try:
+                procs.extend(bx_to_tac(str(fn))[1])
+            except (SystemExit, Exception):
+                continue
+    for proc in procs:
+        body = proc.body
+        if not body:
+            continue
+        graph = dataflow.FlowGraph(body)
+        starts = [block[0][0] for block in graph.blocks]
+
+        def live(i, instr, out):
+            uses, defs = dataflow.uses_defs(instr)
+            return (out - set(defs)) | set(uses)
+        live_in = naive_dataflow(body, live, False, True, set(), set())
+        liveness = dataflow.Liveness(graph)
+        assert [liveness.temps.decode(v) for v in liveness.live_in] == [live_in[i] for i in starts], proc.name
+        after = dataflow.liveness(body)
+        succs = instruction_successors(body)
+        assert all(after[i] == set().union(*[live_in[j] for j in succs[i]]) for i in range(len(body))), proc.name
+
+        def reach(i, instr, value):
+            defs = dataflow.uses_defs(instr)[1]
+            if not defs:
+                return value
+            return {j for j in value if dataflow.uses_defs(body[j])[1] != defs} | {i}
+        reach_in = naive_dataflow(body, reach, True, True, set(), set())
+        reaching = dataflow.ReachingDefinitions(graph)
+        assert [reaching.reaching(b) for b in range(len(starts))] == [reach_in[i] for i in starts], proc.name
+
+        exprs = {dataflow.AvailableExpressions.expression(instr) for instr in body if instr.opcode in dataflow.pure_ops}
+
+        def avail(i, instr, value):
+            if instr.opcode in dataflow.pure_ops:
+                value = value | {dataflow.AvailableExpressions.expression(instr)}
+            for d in dataflow.uses_defs(instr)[1]:
+                value = {e for e in value if d not in e[1]}
+            return value
+        avail_in = naive_dataflow(body, avail, True, False, set(), exprs)
+        available = dataflow.AvailableExpressions(graph)
+        assert [available.available(b) for b in range(len(starts))] == [avail_in[i] for i in starts], proc.name
+    print(f'dataflow: {len(procs)} procedures OK')
+
+
+def test_ssa():
+    """
+    to_ssa writes every temporary once, each use being dominated by the write it reads (for a phi, at the end of
+    the predecessor it comes from); from_ssa removes every phi, and the copies it adds only write versions.
+    """
+    procs = compiled_procs()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for fn in bx_files():
+            try:
+                procs.extend(bx_to_tac(str(fn))[1])
+            except (SystemExit, Exception):
+                continue
+    for proc in procs:
+        form = ssa.to_ssa(proc)
+        if not form.body:
+            continue
+        graph = dataflow.FlowGraph(form.body)
+        dom = ssa.DominatorTree(graph)
+        assert not graph.preds[0], proc.name
+        where = {}
+        for b, block in enumerate(graph.blocks):
+            for k, (_, instr) in enumerate(block):
+                if dataflow.is_temp(instr.result):
+                    assert instr.result not in where, (proc.name, instr.result)
+                    where[instr.result] = (b, k)
+        labels = {block[0][1].args[0]: b for b, block in enumerate(graph.blocks)}
+
+        def dominated(temp, b, k):
+            # the write of temp dominates position k of block b (temporaries never written are the entry values)
+            if temp not in where:
+                return True
+            db, dk = where[temp]
+            return dk < k if db == b else dom.dominates(db, b)
+        for b, block in enumerate(graph.blocks):
+            for k, (_, instr) in enumerate(block):
+                if instr.opcode == 'phi':
+                    assert sorted(labels[label] for label in instr.args[::2]) == sorted(graph.preds[b]), proc.name
+                    for label, temp in zip(instr.args[::2], instr.args[1::2]):
+                        p = labels[label]
+                        assert dominated(temp, p, len(graph.blocks[p])), (proc.name, instr)
+                else:
+                    for temp in dataflow.uses_defs(instr)[0]:
+                        assert dominated(temp, b, k), (proc.name, instr)
+
+        plain = ssa.from_ssa(form)
+        assert not any(instr.opcode == 'phi' for instr in plain.body), proc.name
+        written = {instr.result for instr in form.body} | set(form.args)
+        assert all(instr.result in written or instr.result.startswith('%ssa')
+                   for instr in plain.body if instr.opcode in ('copy', 'const')), proc.name
+        dataflow.FlowGraph(plain.body)
+
+    # parallel copies with a cycle (a swap) and a shared source
+    values = {'a': 1, 'b': 2, 'c': 3}
+    for dest, src in ssa.sequentialize([('a', 'b'), ('b', 'a'), ('c', 'a'), ('d', 4)], iter(['t']).__next__):
+        values[dest] = values[src] if isinstance(src, str) else src
+    assert (values['a'], values['b'], values['c'], values['d']) == (2, 1, 1, 4)
+    print(f'ssa: {len(procs)} procedures OK')
+
+
+def test_sccp():
+    """
+    Constant folding follows the x64 instructions, and a program computing constants is reduced to them.
+    """
+    fold = ssa_opt.fold
+    assert (fold['div'](-7, 2), fold['mod'](-7, 2), fold['mod'](7, -2)) == (-3, -1, 1)
+    assert fold['div'](1, 0) is None and fold['div'](-2 ** 63, -1) is None
+    assert (fold['mul'](2 ** 62, 4), fold['shl'](1, 65), fold['shr'](-7, 1)) == (0, 2, -4)
+    program = """
+def main() {
+    var x = 6, y = 0 : int;
+    while (y < 0) { y = y + x; }
+    if (x * 7 == 42 && y == 0) { print(x * 7); } else { print(0); }
+}
+"""
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = Path(tmp, 'constants.bx')
+        fn.write_text(program)
+        with contextlib.redirect_stdout(io.StringIO()):
+            [proc] = optimize_program(bx_to_tac(str(fn))[1])
+    opcodes = [instr.opcode for instr in proc.body if instr.opcode not in ('label', 'nop')]
+    assert opcodes == ['const', 'param', 'call', 'ret'], opcodes
+    assert proc.body[[instr.opcode for instr in proc.body].index('const')].args[0] == 42
+    print('sccp: OK')
+
+
+def test_dce():
+    """
+    No pure instruction of the optimized TAC writes a dead temporary, and the TAC of bx2tac only reads temporaries
+    it writes (or parameters).
+    """
+    procs = compiled_procs()
+    for proc in procs:
+        for instr, out in zip(proc.body, dataflow.liveness(proc.body)):
+            assert instr.opcode not in tac_cfopt.removable or instr.result not in dataflow.uses_defs(instr)[1] \
+                or instr.result in out, (proc.name, instr)
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        flag = Path(tmp, 'flag.bx')
+        flag.write_text('def main() { var b = true : bool; while (b) { b = false; } if (!b) { print(1); } }')
+        for fn in bx_files() + [flag]:
+            try:
+                raw = bx_to_tac(str(fn))[1]
+            except (SystemExit, Exception):
+                continue
+            for proc in raw:
+                written = set(proc.args) | {instr.result for instr in proc.body}
+                for instr in proc.body:
+                    assert set(dataflow.uses_defs(instr)[0]) <= written, (fn, proc.name, instr)
+    print(f'dce: {len(procs)} procedures OK')
+
+
+def check_edges(cfg):
+    # every block ends with its only jmp or ret, its successors count the jumps to them and know it as a predecessor
+    for label, block in cfg.block.items():
+        assert block.label == label and block.instrs[0].opcode == 'label' and block.instrs[0].args[0] == label
+        assert block.instrs[-1].opcode in ('jmp', 'ret'), (cfg.name, label)
+        assert not any(instr.opcode in ('jmp', 'ret') for instr in block.instrs[:-1]), (cfg.name, label)
+        targets = Counter(tac_cfopt.jump_target(instr) for instr in block.instrs)
+        del targets[None]
+        assert block.child == dict(targets), (cfg.name, label)
+        assert all(label in cfg.block[c_label].parent for c_label in block.child), (cfg.name, label)
+        assert all(label in cfg.block[p_label].child for p_label in block.parent), (cfg.name, label)
+
+
+def cfg_of(proc):
+    # CFG of a procedure, its instructions with two arguments as optimize_proc gives them
+    return tac_cfopt.CFG([bx2tac.Instruction(instr.opcode, (list(instr.args) + [None, None])[:2], instr.result)
+                          for instr in proc.body], proc.name)
+
+
+def test_simplify():
+    """
+    After the control flow optimization of every repository program (raw and in SSA optimized TAC), the edges of the
+    CFG match its jumps, no jump can be threaded further and no block can be merged into its predecessor; the
+    optimized programs print the same lines.
+    """
+    program = """
+def main() {
+    var x = 5, n = 0 : int;
+    while (n < 10) {
+        if (x > n && x > n) { print(n); }
+        if (x > n) { print(1); } else if (n > 7) { print(2); } else { print(0); }
+        n = n + 1;
+    }
+}
+"""
+    checked = 0
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        ladder = Path(tmp, 'ladder.bx')
+        ladder.write_text(program)
+        for fn in bx_files() + [ladder]:
+            try:
+                gvars, raw = bx_to_tac(str(fn))
+            except (SystemExit, Exception):
+                continue
+            for proc in raw + [ssa.optimize(proc, ssa_opt.passes[1]) for proc in raw]:
+                if not proc.body:
+                    continue
+                cfg = cfg_of(proc)
+                cfg.control_flow_optimization()
+                for label, block in cfg.block.items():
+                    targets = Counter(tac_cfopt.jump_target(instr) for instr in block.instrs)
+                    del targets[None]
+                    assert dict(targets) == block.child, (fn, label)
+                    assert set(block.parent) == {p for p, other in cfg.block.items() if label in other.child}
+                    for i, instr in enumerate(block.instrs):
+                        if tac_cfopt.jump_target(instr) is not None:
+                            assert cfg.thread(block, i) == tac_cfopt.jump_target(instr), (fn, label, instr)
+                    last = block.instrs[-1]
+                    if last.opcode == 'jmp' and last.args[0] not in (label, cfg.entry_label):
+                        assert len(cfg.block[last.args[0]].parent) > 1 or block.child[last.args[0]] > 1, (fn, label)
+                checked += 1
+            expected = tac_interp.run(gvars, raw)[0]
+            assert tac_interp.run(gvars, optimize_program(raw))[0] == expected, fn
+    assert expected == ['0', '1', '1', '1', '2', '1', '3', '1', '4', '1', '0', '0', '0', '2', '2'], expected
+    print(f'simplify: {checked} procedures OK')
+
+
+def test_block_inference():
+    """
+    Split in basic blocks and serialized again, without any optimization, the procedures of the repository print
+    the same lines (tac_interp), in depth first order as in the layout; the successors and predecessors of the
+    blocks agree with their jumps and with each other (test_simplify checks them after the optimization).
+    """
+    programs = 0
+    for fn in bx_files():
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                gvars, raw = bx_to_tac(str(fn))
+            expected = tac_interp.run(gvars, raw)[0]
+        except (SystemExit, Exception):
+            continue
+        for args in ((False,), (True, None, False), (True,)):
+            procs = []
+            for proc in raw:
+                body = []
+                if proc.body:
+                    cfg = cfg_of(proc)
+                    check_edges(cfg)
+                    body = cfg.serialize(*args)
+                procs.append(bx2tac.Procedure(proc.name[1:], proc.args, body))
+            assert tac_interp.run(gvars, procs)[0] == expected, (fn, args)
+        programs += 1
+    print(f'block inference: {programs} programs OK')
+
+
+def test_deep_cfg():
+    """
+    The CFG walks do not recurse: a procedure of 100k blocks in a chain (a ladder of tests, as generated code makes)
+    is ordered, serialized and optimized, and still prints the same line.
+    """
+    n = 100000
+    body = [bx2tac.Instruction('const', [0, None], '%zero')]
+    for k in range(n):
+        body += [bx2tac.Instruction('label', [f'%.Lr{k}', None], None),
+                 bx2tac.Instruction('jnz', ['%zero', '%.Lhit'], None),
+                 bx2tac.Instruction('jmp', [f'%.Lr{k + 1}', None], None)]
+    body += [bx2tac.Instruction('label', [f'%.Lr{n}', None], None),
+             bx2tac.Instruction('param', [1, '%zero'], None),
+             bx2tac.Instruction('call', ['@__bx_print_int', 1], None),
+             bx2tac.Instruction('ret', [], None),
+             bx2tac.Instruction('label', ['%.Lhit', None], None),
+             bx2tac.Instruction('ret', [], None)]
+    cfg = tac_cfopt.CFG(body, '@main')
+    order = cfg.reverse_postorder()
+    assert len(order) == len(cfg.block) == n + 3 and order[0] == cfg.entry_label
+    assert len(cfg.serialize(False)) == len(body) + 2
+    cfg.control_flow_optimization()
+    optimized = bx2tac.Procedure('main', [], cfg.serialize())
+    expected = tac_interp.run([], [bx2tac.Procedure('main', [], body)])[0]
+    output, counts = tac_interp.run([], [optimized])
+    assert output == expected == ['0'] and sum(counts.values()) < 10, counts
+    print(f'deep cfg: {n} blocks OK')
+
+
+def test_cfg_analyses():
+    """
+    The dominators, dominance frontiers and loops of the CFG of every repository program (before and after its
+    control flow optimization) agree with their definitions, and are only computed again when the edges change.
+    """
+    checked = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for fn in bx_files():
+            try:
+                raw = bx_to_tac(str(fn))[1]
+            except (SystemExit, Exception):
+                continue
+            for proc in raw:
+                if not proc.body:
+                    continue
+                cfg = cfg_of(proc)
+                for optimized in (False, True):
+                    if optimized:
+                        version, frontiers = cfg.version, cfg.dominance_frontiers()
+                        cfg.control_flow_optimization()
+                        assert cfg.version > version or cfg.dominance_frontiers() is frontiers
+                    check_cfg_analyses(cfg)
+                    assert cfg.dominance_frontiers() is cfg.dominance_frontiers()
+                    checked += 1
+    print(f'cfg analyses: {checked} CFGs OK')
+
+
+def check_cfg_analyses(cfg):
+    order = cfg.reverse_postorder()
+    if len(order) > 80:
+        return
+
+    def reached(without):
+        # blocks reached from the entry without going through the block without
+        if without == cfg.entry_label:
+            return set()
+        seen, work = {cfg.entry_label}, [cfg.entry_label]
+        while work:
+            for child in cfg.block[work.pop()].child:
+                if child != without and child not in seen:
+                    seen.add(child)
+                    work.append(child)
+        return seen
+
+    dominated = {a: set(order) - reached(a) | {a} for a in order}
+    idom = cfg.immediate_dominators()
+    for b in order:
+        assert all(cfg.dominates(a, b) == (b in dominated[a]) for a in order), (cfg.name, b)
+        strict = [a for a in order if b in dominated[a] and a != b]
+        assert (idom[b] is None) == (b == cfg.entry_label)
+        assert idom[b] is None or all(idom[b] in dominated[a] for a in strict), (cfg.name, b)
+    frontiers = cfg.dominance_frontiers()
+    for a in order:
+        expected = {f for f in order if any(p in dominated[a] for p in cfg.block[f].parent)
+                    and (f == a or f not in dominated[a])}
+        assert frontiers[a] == expected, (cfg.name, a, frontiers[a], expected)
+    forest = cfg.loop_forest()
+    for b in order:
+        for h in cfg.block[b].child:
+            if b in dominated[h]:
+                assert h in forest.headers and b in forest.body[h] and forest.innermost[h] == h, (cfg.name, b, h)
+    for h in forest.headers:
+        assert forest.parent[h] is None or forest.body[h] < forest.body[forest.parent[h]]
+
+
+def test_layout():
+    """
+    The block layout keeps the behaviour of the repository programs and of a loop with a biased branch, and leaves
+    no jmp to the next label. Counting the jumps taken with tac_interp, the static estimates take fewer than the depth
+    first order, and the profile of the run of the static layout fewer than the static estimates on the biased loop.
+    bxcc reports a missing or malformed profile as an error of its command line.
+    """
+    program = """
+def main() {
+    var i = 0, s = 0 : int;
+    while (i < 1000) {
+        if (i % 16 == 0) { s = s + 1; } else { s = s + i; }
+        if (s > 10000) { s = s - 10000; }
+        i = i + 1;
+    }
+    print(s);
+}
+"""
+    def taken(branches):
+        return sum(n for (_, _, _, kind), n in branches.items() if kind != 'fall')
+
+    totals = Counter()
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        biased = Path(tmp, 'biased.bx')
+        biased.write_text(program)
+        for fn in bx_files() + [biased]:
+            try:
+                gvars, raw = bx_to_tac(str(fn))
+            except (SystemExit, Exception):
+                continue
+            expected = tac_interp.run(gvars, raw)[0]
+            runs = {}
+            for layout in ('dfs', 'static', 'profile'):
+                profile = tac_cfopt.profile_of(runs['static']) if layout == 'profile' else None
+                procs = optimize_program(raw, profile=profile, layout=layout != 'dfs')
+                for proc in procs:
+                    for instr, next_instr in zip(proc.body, proc.body[1:]):
+                        assert not (instr.opcode == 'jmp' and next_instr.opcode == 'label' and
+                                    next_instr.args[0] == instr.args[0]), (fn, layout)
+                runs[layout] = Counter()
+                assert tac_interp.run(gvars, procs, branches=runs[layout])[0] == expected, (fn, layout)
+                totals[layout] += taken(runs[layout])
+    assert taken(runs['profile']) < taken(runs['static']) < taken(runs['dfs']), runs
+    assert totals['profile'] <= totals['static'] < totals['dfs'], totals
+
+    # an unreadable profile is an error of the command line
+    with tempfile.TemporaryDirectory() as tmp:
+        fn, profile = Path(tmp, 'p.bx'), Path(tmp, 'bx.profile')
+        fn.write_text('def main() {\n    print(1);\n}\n')
+        for contents, error in ((None, 'No such file or directory'), ('@main .L0 .L1 taken\n', 'line 1: expected')):
+            if contents is not None:
+                profile.write_text(contents)
+            run = bxcc('--stop_asm', '--profile', str(profile), str(fn))
+            assert run.returncode == 1 and run.stdout.startswith(f'Cannot read the profile {profile}: {error}'), run
+            assert not run.stderr and not Path(tmp, 'p.s').exists(), run
+    print(f'layout: {totals["dfs"]} jumps taken in depth first order, {totals["static"]} with static estimates, '
+          f'{totals["profile"]} with a profile OK')
+
+
+def test_copy_propagation():
+    """
+    The SSA form left by the copy propagation has no copy of a temporary, and the programs of the repository print
+    the same lines (tac_interp) at every level of SSA optimizations, while executing fewer copies at -O1.
+    """
+    programs = 0
+    for fn in bx_files():
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                gvars, raw = bx_to_tac(str(fn))
+            expected = tac_interp.run(gvars, raw)[0]
+        except (SystemExit, Exception):
+            continue
+        for proc in raw:
+            form = ssa_opt.copy_propagation(ssa.to_ssa(proc))
+            assert not any(instr.opcode == 'copy' and dataflow.is_temp(instr.args[0]) for instr in form.body)
+        copies = []
+        for level in sorted(ssa_opt.passes):
+            with contextlib.redirect_stdout(io.StringIO()):
+                procs = optimize_program(raw, passes=ssa_opt.passes[level])
+            output, counts = tac_interp.run(gvars, procs)
+            assert output == expected, (fn, level)
+            copies.append(counts['copy'])
+        assert copies[1] <= copies[0], (fn, copies)
+        programs += 1
+    print(f'copy propagation: {programs} programs OK')
+
+
+def test_gvn():
+    """
+    A product computed in a condition, in a branch and after the branch (operands swapped) is computed once, the
+    loads of a global are shared until a call, and the program prints the same lines.
+    """
+    program = """
+var g = 2 : int;
+def h() { g = g + 1; }
+def f(x, y : int) {
+    if (x * y > 10) { print(y * x); }
+    print(x * y + g + g);
+    h();
+    print(g + g);
+}
+def main() { f(3, 5); f(1, 2); }
+"""
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = Path(tmp, 'gvn.bx')
+        fn.write_text(program)
+        with contextlib.redirect_stdout(io.StringIO()):
+            gvars, raw = bx_to_tac(str(fn))
+            procs = optimize_program(raw)
+    opcodes = [(instr.opcode, instr.args[0] if instr.args else None) for instr in procs[1].body]
+    assert opcodes.count(('mul', '%x')) + opcodes.count(('mul', '%y')) == 1, opcodes
+    assert opcodes.count(('copy', '@g')) == 2, opcodes
+    assert tac_interp.run(gvars, procs)[0] == tac_interp.run(gvars, raw)[0] == ['15', '19', '6', '8', '8']
+    print('gvn: OK')
+
+
+def test_licm():
+    """
+    The invariant products of two nested loops run once per call, and their modulo by a constant too, but not the
+    division by a parameter that may be 0; the program prints the same lines.
+    """
+    program = """
+var g = 0 : int;
+def f(n, d : int) {
+    var i = 0, j = 0, s = 0 : int;
+    while (i < n) {
+        j = 0;
+        while (j < n) {
+            s = s + (n * 3 + d) + j;
+            g = g + n * 2;
+            j = j + 1;
+        }
+        if (d != 0) { s = s + n / d; }
+        s = s + n % 4;
+        i = i + 1;
+    }
+    print(s);
+    print(g);
+}
+def main() { f(3, 0); f(4, 2); f(0, 0); }
+"""
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = Path(tmp, 'licm.bx')
+        fn.write_text(program)
+        passes = ssa_opt.passes[1][:ssa_opt.passes[1].index(ssa_opt.licm) + 1]
+        with contextlib.redirect_stdout(io.StringIO()):
+            gvars, raw = bx_to_tac(str(fn))
+            procs = optimize_program(raw, passes=passes)
+    expected, before = tac_interp.run(gvars, raw)
+    output, after = tac_interp.run(gvars, procs)
+    assert output == expected == ['99', '54', '256', '182', '0', '182'], output
+    assert (after['mul'], after['mod'], after['div']) == (6, 3, before['div']), after
+    print('licm: OK')
+
+
+def test_strength_reduction():
+    """
+    Products, divisions and modulos by powers of two (of negative numbers and at the ends of the 64 bit range) and
+    products of induction variables (before or after their update, in the header or in the block of the update)
+    print the same lines without any division and with few multiplications.
+    """
+    program = """
+def p(x : int) {
+    print(x * 8); print(x / 8); print(x % 8); print(x / 2); print(x % 2);
+    print(4 * x); print(x / 4611686018427387904); print(x % 4611686018427387904);
+}
+def q(n, k : int) {
+    var i = 0, s = 0 : int;
+    while (i < n) { s = s + i * k + (i << 3); i = i + 1; }
+    while (n > 0) { s = s - k * n; n = n - 2; }
+    print(s);
+}
+def r(n : int) {
+    var i = 0 : int;
+    while (i * 2 < n) { i = i + 1; }
+    print(i);
+}
+def t(n : int) {
+    var i = 0, s = 0 : int;
+    while (i < n) { var j = i + 1 : int; s = s + j + i * 3; i = i + 1; }
+    print(s);
+}
+def main() {
+    p(0); p(1); p(-1); p(7); p(-7); p(8); p(-8); p(-9); p(9223372036854775807); p(-9223372036854775807 - 1);
+    q(100, 7); q(0, 3); q(-5, 2); q(11, -3);
+    r(10); r(11); t(10); t(0);
+}
+"""
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = Path(tmp, 'powers.bx')
+        fn.write_text(program)
+        with contextlib.redirect_stdout(io.StringIO()):
+            gvars, raw = bx_to_tac(str(fn))
+            procs = optimize_program(raw)
+    expected, before = tac_interp.run(gvars, raw)
+    output, after = tac_interp.run(gvars, procs)
+    assert output == expected, [(a, b) for a, b in zip(output, expected) if a != b]
+    assert expected[32:40] == ['-56', '0', '-7', '-3', '-1', '-28', '0', '-7'], expected
+    assert expected[-8:] == ['56400', '0', '0', '383', '5', '6', '190', '0'], expected
+    assert after['div'] == after['mod'] == 0 and after['mul'] * 10 < before['mul'], after
+    print('strength reduction: OK')
+
+
+def test_inline():
+    """
+    Inlining the small procedures, before and after the optimization, prints the same lines with fewer calls; the
+    calls between mutually recursive procedures are kept.
+    """
+    program = """
+var total = 0 : int;
+def sq(x : int) : int { return x * x; }
+def add(a, b : int) : int { return a + b; }
+def acc(n : int) { total = total + sq(n); }
+def fact(n : int) : int { if (n > 1) { return n * fact(n - 1); } return 1; }
+def even(n : int) : bool { if (n > 0) { return odd(n - 1); } return true; }
+def odd(n : int) : bool { if (n > 0) { return even(n - 1); } return false; }
+def main() {
+    var i = 0 : int;
+    while (i < 10) { acc(i); print(add(sq(i), i)); i = i + 1; }
+    print(total); print(fact(10)); print(even(7)); print(add(add(2, 3), 1));
+}
+"""
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = Path(tmp, 'inline.bx')
+        fn.write_text(program)
+        with contextlib.redirect_stdout(io.StringIO()):
+            gvars, raw = bx_to_tac(str(fn))
+            inlined = tac_inline.inline_program(raw, tac_inline.budgets[1])
+            procs = optimize_program(inlined)
+    expected, before = tac_interp.run(gvars, raw)
+    for variant in (inlined, procs):
+        output, after = tac_interp.run(gvars, variant)
+        assert output == expected, (output, expected)
+        assert after['call'] < before['call'], (after['call'], before['call'])
+    assert expected[-5:] == ['90', '285', '3628800', 'false', '6'], expected
+    by_name = {proc.name: proc for proc in inlined}
+    for name, callee in (('@fact', '@fact'), ('@even', '@odd'), ('@odd', '@even')):
+        assert any(instr.opcode == 'call' and instr.args[0] == callee for instr in by_name[name].body), name
+    assert not any(instr.opcode == 'call' and instr.args[0] in ('@sq', '@add', '@acc') for instr in by_name['@main'].body)
+    print(f"inlining: {before['call']} -> {after['call']} calls executed")
+
+
+def check_allocation(proc, alloc):
+    # No register holds two values at once: a temporary written by an instruction never shares its register
+    # with another one live after it, unless it is a copy of it
+    for instr, out in zip(proc.body, regalloc.liveness(proc.body)):
+        uses, defs = regalloc.uses_defs(instr)
+        source = uses[0] if instr.opcode == 'copy' and uses else None
+        for d in defs:
+            for t in out:
+                assert t in (d, source) or d not in alloc or alloc.get(t) != alloc[d], (proc.name, instr, d, t)
+    assert set(alloc.values()) <= set(regalloc.callee_saved + regalloc.caller_saved)
+
+
+def test_linear_scan():
+    procs = compiled_procs()
+    for proc in procs:
+        check_allocation(proc, regalloc.linear_scan(proc))
+    print(f'linear scan: {len(procs)} procedures OK')
+
+
+def test_graph_coloring():
+    procs = compiled_procs()
+    for proc in procs:
+        check_allocation(proc, regalloc.graph_coloring(proc))
+    print(f'graph coloring: {len(procs)} procedures OK')
+
+
+tests = [
+    test_fast_lexer,
+    test_locate,
+    test_diagnostics,
+    test_parser_tables,
+    test_shared_parser,
+    test_stream,
+    test_tac_json,
+    test_parallel_build,
+    test_proc_cache,
+    test_linear_scan,
+    test_graph_coloring,
+    test_dataflow,
+    test_ssa,
+    test_sccp,
+    test_dce,
+    test_simplify,
+    test_block_inference,
+    test_deep_cfg,
+    test_cfg_analyses,
+    test_layout,
+    test_copy_propagation,
+    test_gvn,
+    test_licm,
+    test_strength_reduction,
+    test_inline,
+]
+
+if __name__ == '__main__':
+    for test in tests:
+        test()